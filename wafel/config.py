@@ -13,6 +13,7 @@ version = (0, 6, 1)
 dev_mode: bool
 assets_directory: str
 lib_directory: str
+cache_directory: str
 log_file: str
 settings_file: str
 
@@ -21,7 +22,7 @@ def version_str(delim: str) -> str:
   return delim.join(map(str, version))
 
 def init() -> None:
-  global dev_mode, assets_directory, lib_directory, log_file, settings_file
+  global dev_mode, assets_directory, lib_directory, cache_directory, log_file, settings_file
   if getattr(sys, 'frozen', False):
     dev_mode = False
     root_dir = os.path.dirname(sys.executable)
@@ -32,6 +33,7 @@ def init() -> None:
     lib_directory = root_dir
 
   assets_directory = os.path.join(root_dir, 'assets')
+  cache_directory = os.path.join(root_dir, 'cache')
   log_file = os.path.join(root_dir, 'log.txt')
   settings_file = os.path.join(root_dir, 'settings.json')
 
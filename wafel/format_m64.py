@@ -49,10 +49,16 @@ def save_m64(filename: str, metadata: TasMetadata, pipeline: Pipeline, length: i
     f.write(bytes_to_buffer(metadata.authors.encode('utf-8'), 222))
     f.write(bytes_to_buffer(metadata.description.encode('utf-8'), 256))
 
-    for frame in range(length):
-      buttons = dcast(int, pipeline.read(Variable('input-buttons').with_frame(frame)))
-      stick_x = dcast(int, pipeline.read(Variable('input-stick-x').with_frame(frame)))
-      stick_y = dcast(int, pipeline.read(Variable('input-stick-y').with_frame(frame)))
+    input_variables = [
+      Variable('input-buttons'),
+      Variable('input-stick-x'),
+      Variable('input-stick-y'),
+    ]
+    columns = pipeline.read_range(input_variables, 0, length)
+    for buttons, stick_x, stick_y in zip(*columns):
+      buttons = dcast(int, buttons)
+      stick_x = dcast(int, stick_x)
+      stick_y = dcast(int, stick_y)
 
       f.write(struct.pack(b'>H', buttons & 0xFFFF))
       f.write(struct.pack(b'=B', stick_x & 0xFF))
@@ -39,6 +39,12 @@ class FrameSequence(Protocol):
   @abstractmethod
   def set_hotspot(self, name: str, frame: int) -> None: ...
 
+  @abstractmethod
+  def set_hotspot_range(self, name: str, frame_start: int, frame_end: int, weight: float = 1.0) -> None: ...
+
+  @abstractmethod
+  def set_preload_window(self, frames_before: int, frames_after: int) -> None: ...
+
 
 class CellDragHandler(Protocol):
   @abstractmethod
@@ -90,6 +96,8 @@ class FrameSheet:
 
     self.prev_selected_frame: Optional[int] = None
     self.scroll_delta = 0.0
+    self.prev_scroll_y = 0.0
+    self.preload_window: Optional[Tuple[int, int]] = None
 
 
   def _insert_variable(self, index: int, variable: Variable) -> None:
@@ -186,10 +194,9 @@ class FrameSheet:
     ig.columns(1)
 
 
-  def render_cell(self, frame: int, column: FrameSheetColumn) -> None:
+  def render_cell(self, frame: int, column: FrameSheetColumn, data: object) -> None:
     cell_variable = column.variable.with_frame(frame)
 
-    data = self.pipeline.read(cell_variable)
     formatter = EmptyFormatter() if data is None else self.formatters[cell_variable]
 
     changed_data, clear_edit, selected, pressed = ui.render_variable_cell(
@@ -227,6 +234,13 @@ class FrameSheet:
 
     timeline_operations: List[Callable[[], None]] = []
 
+    # Read the visible cells in one pass rather than one cell at a time
+    column_data = self.pipeline.read_range(
+      [column.variable for column in self.columns],
+      min_row,
+      max_row + 1,
+    )
+
     mouse_pos = (
       ig.get_mouse_pos().x - ig.get_window_position().x,
       ig.get_mouse_pos().y - ig.get_window_position().y + ig.get_scroll_y() + self.scroll_delta,
@@ -267,8 +281,8 @@ class FrameSheet:
 
       ig.next_column()
 
-      for column in self.columns:
-        self.render_cell(row, column)
+      for column, data in zip(self.columns, column_data):
+        self.render_cell(row, column, data[row - min_row])
 
         ig.set_column_width(-1, column.width)
         ig.next_column()
@@ -307,6 +321,19 @@ class FrameSheet:
     self.scroll_delta = new_scroll_y - curr_scroll_y
 
 
+  def update_preload_window(self, visible_rows: int) -> None:
+    # Load a screen's worth of rows in the direction of scrolling on each cache miss
+    scroll_y = ig.get_scroll_y()
+    if scroll_y < self.prev_scroll_y:
+      preload_window = (visible_rows, 0)
+    else:
+      preload_window = (0, visible_rows)
+    self.prev_scroll_y = scroll_y
+
+    if preload_window != self.preload_window:
+      self.sequence.set_preload_window(*preload_window)
+      self.preload_window = preload_window
+
   def render(self) -> None:
     self.render_headers()
     # TODO: Make the vertical scrollbar always visible?
@@ -314,7 +341,9 @@ class FrameSheet:
     ig.begin_child('Frame Sheet Rows', flags=ig.WINDOW_ALWAYS_VERTICAL_SCROLLBAR)
     self.update_scolling()
     min_frame = int(ig.get_scroll_y()) // self.row_height - 1
-    self.sequence.set_hotspot('frame-sheet-min', max(min_frame, 0))
+    max_frame = min_frame + int(ig.get_window_height()) // self.row_height + 2
+    self.sequence.set_hotspot_range('frame-sheet', max(min_frame, 0), max(max_frame, 1), 3)
+    self.update_preload_window(max_frame - min_frame)
 
     if self.dragging and not ig.is_mouse_down():
       self.drag_handler.release_drag()
@@ -64,6 +64,7 @@ class Summary:
   copies: float = 0.0
   updates: float = 0.0
   requests: float = 0.0
+  slots: float = 0.0
 
   @staticmethod
   def average(samples: List[Summary]) -> Summary:
@@ -74,6 +75,7 @@ class Summary:
       copies = sum(s.copies for s in samples) / len(samples),
       updates = sum(s.updates for s in samples) / len(samples),
       requests = sum(s.requests for s in samples) / len(samples),
+      slots = sum(s.slots for s in samples) / len(samples),
     )
 
 
@@ -83,6 +85,7 @@ class Timer:
   def __init__(self) -> None:
     self.samples: Dict[Tuple[str, ...], List[Summary]] = {}
     self.active: Dict[Tuple[str, ...], Summary] = {}
+    self.counted: Dict[Tuple[str, ...], Summary] = {}
     self.stack: List[str] = []
     self.get_num_copies = lambda: 0
     self.get_num_updates = lambda: 0
@@ -95,6 +98,7 @@ class Timer:
       copies = self.get_num_copies(),
       updates = self.get_num_updates(),
     )
+    self.counted[path] = Summary()
 
   def end(self) -> None:
     path = tuple(self.stack)
@@ -105,8 +109,27 @@ class Timer:
     sample.time = (time.time() - sample.time) * 1000
     sample.copies = self.get_num_copies() - sample.copies
     sample.updates = self.get_num_updates() - sample.updates
+
+    # Counted work is part of the enclosing timer too, like the measured counters
+    counted = self.counted.pop(path)
+    if len(self.stack) > 0:
+      parent = self.counted[tuple(self.stack)]
+      parent.copies += counted.copies
+      parent.updates += counted.updates
+      parent.slots += counted.slots
+
+    sample.copies += counted.copies
+    sample.updates += counted.updates
+    sample.slots += counted.slots
     self.samples[path].append(sample)
 
+  def count(self, copies: int = 0, updates: int = 0, slots: int = 0) -> None:
+    """Record work that isn't measured by get_num_copies/get_num_updates in the active timer."""
+    counted = self.counted[tuple(self.stack)]
+    counted.copies += copies
+    counted.updates += updates
+    counted.slots += slots
+
   def begin_frame(self) -> None:
     assert len(self.stack) == 0
     self.begin('frame')
@@ -142,7 +165,7 @@ class Timer:
   def format(self, summaries: Dict[Tuple[str, ...], Summary]) -> List[str]:
     from wafel.util import format_align
     return format_align(
-      '{0}%s%a - %s{1:.1f}%ams  %s{2}%a  %s{3}%a  %s{4}%a',
+      '{0}%s%a - %s{1:.1f}%ams  %s{2}%a  %s{3}%a  %s{4}%a  %s{5}%a',
       [
         (
           '  ' * (len(path) - 1) + path[-1],
@@ -150,6 +173,7 @@ class Timer:
           math.ceil(s.copies),
           math.ceil(s.updates),
           math.ceil(s.requests),
+          math.ceil(s.slots),
         )
         for path, s in summaries.items()
       ],
@@ -522,6 +522,12 @@ class MainView:
     ig.pop_id()
 
 
+# Background work is scheduled to finish within this time after the start of a UI frame
+TARGET_FRAME_TIME = 1/60
+
+# Balancing always gets at least this much time, even on slow frames
+MIN_BALANCE_TIME = 1/1000
+
 DEFAULT_TAS = TasMetadata('us', 'Untitled TAS', 'Unknown author(s)', 'Made using Wafel')
 
 
@@ -680,6 +686,7 @@ def run() -> None:
   model = Model()
   view = None
   error = None
+  frame_start = time.perf_counter()
 
   def do_render(id: str) -> None:
     nonlocal view
@@ -701,25 +708,66 @@ def run() -> None:
     last_fps_time = use_state_with('last-fps-time', lambda: time.time())
     frame_count = use_state('frame-count', 0)
     fps = use_state('fps', 0.0)
+    last_bytes_copied = use_state('last-bytes-copied', (0, 0, 0))
 
     if hasattr(model, 'pipeline'):
       frame_count.value += 1
       if time.time() > last_fps_time.value + 5:
         fps.value = frame_count.value / (time.time() - last_fps_time.value)
+        bytes_requested, bytes_compared, bytes_copied = model.pipeline.bytes_copied()
+        copied_per_frame = (bytes_copied - last_bytes_copied.value[2]) // frame_count.value
+        compared_per_frame = (bytes_compared - last_bytes_copied.value[1]) // frame_count.value
+        requested_per_frame = (bytes_requested - last_bytes_copied.value[0]) // frame_count.value
+        last_bytes_copied.value = (bytes_requested, bytes_compared, bytes_copied)
+        requests, request_bytes_requested, request_bytes_copied, max_request_bytes_copied = \
+          model.pipeline.take_request_stats()
+        full_copies, full_copy_time, partial_copies, partial_copy_time = \
+          model.pipeline.take_copy_timing()
+        refill_progress = model.pipeline.refill_progress()
+        cache_hits, cache_misses, cache_evictions = model.pipeline.data_cache_stats()
         last_fps_time.value = time.time()
         frame_count.value = 0
         log.info(
           f'mspf: {int(1000 / fps.value * 10) / 10} ({int(fps.value)} fps)'
           f' - cache={model.pipeline.data_cache_size() // 1024}KB'
+          f' ({cache_hits} hits, {cache_misses} misses, {cache_evictions} evicted)'
+          f' - copied={copied_per_frame // 1024}/{requested_per_frame // 1024}KB per frame'
+          f' ({compared_per_frame // 1024}KB compared)'
+          f' - {request_bytes_copied // max(requests, 1) // 1024}'
+          f'/{request_bytes_requested // max(requests, 1) // 1024}KB per request'
+          f' (max {max_request_bytes_copied // 1024}KB)'
+          f' - copy={int(full_copy_time / max(full_copies, 1) * 1e6)}us full ({full_copies}),'
+          f' {int(partial_copy_time / max(partial_copies, 1) * 1e6)}us partial ({partial_copies})'
+          f' - dedup={model.pipeline.dedup_ratio():.1f}x'
+          + (f' - refill={int(refill_progress * 100)}%' if refill_progress is not None else '')
         )
 
+      for message in model.pipeline.take_background_errors():
+        log.error(message)
+
+      # Spend whatever is left of the frame on housekeeping
+      deadline = frame_start + TARGET_FRAME_TIME
+      model.expire_prediction()
+
       log.timer.begin('balance')
-      model.pipeline.balance_distribution(1/120)
+      slots_placed, _, _, advances, copies = model.pipeline.balance_distribution(
+        max(deadline - time.perf_counter(), MIN_BALANCE_TIME)
+      )
+      if config.dev_mode:
+        log.timer.count(slots=slots_placed)
+      else:
+        log.timer.count(copies=copies, updates=advances, slots=slots_placed)
       log.timer.end()
 
+      refill_time = deadline - time.perf_counter()
+      if refill_time > 0:
+        log.timer.begin('refill')
+        model.pipeline.refill(refill_time)
+        log.timer.end()
+
   # TODO: Clean up (use local_state)
   def render(id: str) -> None:
-    nonlocal error
+    nonlocal error, frame_start
 
     if error is not None:
       message = error.strip()
@@ -753,6 +801,7 @@ def run() -> None:
         log.timer.get_num_copies = lambda: model.pipeline.num_copies() if config.dev_mode else 0
         log.timer.get_num_updates = lambda: model.pipeline.num_advances() if config.dev_mode else 0
 
+      frame_start = time.perf_counter()
       log.timer.begin_frame()
       ig.try_render(lambda: do_render(id))
     except:
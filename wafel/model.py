@@ -3,6 +3,7 @@ from ctypes import cdll
 import json
 import gc
 import os
+import time
 import weakref
 
 from wafel_core import Variable, Pipeline, ObjectBehavior
@@ -11,6 +12,22 @@ import wafel.config as config
 from wafel.util import *
 
 
+# Number of background game instances used to read long frame ranges
+WORKER_COUNT = min(4, max(0, (os.cpu_count() or 1) - 1))
+
+# How far ahead in seconds the selected frame's motion is extrapolated
+PREDICTION_HORIZON = 0.5
+
+# Weight of the latest sample in the selected frame velocity estimate
+VELOCITY_SMOOTHING = 0.3
+
+# The prediction is dropped if the selected frame doesn't change for this many seconds
+PREDICTION_TIMEOUT = 0.25
+
+# Predicted windows shorter than this many frames don't get a hotspot
+MIN_PREDICTION_FRAMES = 30
+
+
 class Model:
 
   def __init__(self) -> None:
@@ -31,10 +48,18 @@ class Model:
     self.game_version = game_version
 
     dll_path = os.path.join(config.lib_directory, 'libsm64', 'sm64_' + game_version + '.dll')
+    archive_directory = os.path.join(config.cache_directory, 'slots')
     if prev_pipeline:
-      self.pipeline = Pipeline.load_reusing_edits(dll_path, prev_pipeline)
+      self.pipeline = Pipeline.load_reusing_edits(
+        dll_path,
+        prev_pipeline,
+        archive_directory=archive_directory,
+        worker_count=WORKER_COUNT,
+      )
     else:
-      self.pipeline = Pipeline.load(dll_path)
+      self.pipeline = Pipeline.load(
+        dll_path, archive_directory=archive_directory, worker_count=WORKER_COUNT
+      )
 
     self.action_names = self.pipeline.action_names()
 
@@ -43,18 +68,64 @@ class Model:
 
     self.edit_callbacks: List[Callable[[], None]] = []
 
-    self.play_speed = 0.0
+    self._play_speed = 0.0
     self.playback_mode = False
 
-    def set_hotspot(frame: int) -> None:
-      self.pipeline.set_hotspot('selected-frame', frame)
-      self.pipeline.set_hotspot('selected-frame-lookahead', frame + 60)
-    self.on_selected_frame_change(set_hotspot)
-    set_hotspot(self._selected_frame)
+    self._prev_selected_frame = selected_frame
+    self._selected_frame_velocity = 0.0
+    self._last_selected_frame_change = time.perf_counter()
+    self._has_prediction = False
+
+    self.on_selected_frame_change(self._set_selected_frame_hotspots)
+    self.on_selected_frame_change(self._track_selected_frame_velocity)
+    self._set_selected_frame_hotspots(self._selected_frame)
+
+  def _set_selected_frame_hotspots(self, frame: int) -> None:
+    self.pipeline.set_hotspot('selected-frame', frame)
+    if self._play_speed < 0:
+      self.pipeline.set_hotspot_range('selected-frame-lookahead', max(frame - 60, 0), frame + 1)
+    else:
+      self.pipeline.set_hotspot_range('selected-frame-lookahead', frame, frame + 61)
+
+  def _track_selected_frame_velocity(self, frame: int) -> None:
+    now = time.perf_counter()
+    elapsed = now - self._last_selected_frame_change
+    prev_frame = self._prev_selected_frame
+    self._last_selected_frame_change = now
+    self._prev_selected_frame = frame
+
+    # A pause means that the previous motion is unrelated to this one
+    if elapsed > PREDICTION_TIMEOUT:
+      self._selected_frame_velocity = 0.0
+      return
+
+    velocity = (frame - prev_frame) / max(elapsed, 1e-3)
+    self._selected_frame_velocity += VELOCITY_SMOOTHING * (velocity - self._selected_frame_velocity)
+
+    # Place checkpoints where playback or a slider drag is headed before it gets there
+    distance = int(self._selected_frame_velocity * PREDICTION_HORIZON)
+    if abs(distance) < MIN_PREDICTION_FRAMES:
+      self._delete_prediction()
+      return
+    if distance > 0:
+      self.pipeline.set_hotspot_range('selected-frame-prediction', frame, frame + distance + 1)
+    else:
+      self.pipeline.set_hotspot_range('selected-frame-prediction', max(frame + distance, 0), frame + 1)
+    self._has_prediction = True
+
+  def _delete_prediction(self) -> None:
+    if self._has_prediction:
+      self.pipeline.delete_hotspot('selected-frame-prediction')
+      self._has_prediction = False
+
+  def expire_prediction(self) -> None:
+    """Drop the predicted hotspot once the selected frame stops moving."""
+    if time.perf_counter() - self._last_selected_frame_change > PREDICTION_TIMEOUT:
+      self._selected_frame_velocity = 0.0
+      self._delete_prediction()
 
   def _set_edits(self, edits: Dict[Variable, object]) -> None:
-    for variable, value in edits.items():
-      self.pipeline.write(variable, value)
+    self.pipeline.write_all(list(edits.items()))
     self._max_frame = max((variable.frame or 0 for variable in edits), default=0)
 
   # FrameSequence
@@ -96,6 +167,23 @@ class Model:
   def set_hotspot(self, name: str, frame: int) -> None:
     self.pipeline.set_hotspot(name, frame)
 
+  def set_hotspot_range(self, name: str, frame_start: int, frame_end: int, weight: float = 1.0) -> None:
+    self.pipeline.set_hotspot_range(name, frame_start, frame_end, weight)
+
+  def set_preload_window(self, frames_before: int, frames_after: int) -> None:
+    self.pipeline.set_preload_window(frames_before, frames_after)
+
+  @property
+  def play_speed(self) -> float:
+    return self._play_speed
+
+  @play_speed.setter
+  def play_speed(self, play_speed: float) -> None:
+    if play_speed != self._play_speed:
+      self._play_speed = play_speed
+      self.pipeline.set_play_speed(play_speed)
+      self._set_selected_frame_hotspots(self._selected_frame)
+
   def on_edit(self, callback: Callable[[], None]) -> None:
     self.edit_callbacks.append(callback)
 
@@ -26,6 +26,11 @@ class VariablePipeline(Protocol):
   @abstractmethod
   def read(self, variable: Variable) -> object: ...
 
+  @abstractmethod
+  def read_range(
+    self, variables: List[Variable], frame_start: int, frame_end: int
+  ) -> List[List[object]]: ...
+
   @abstractmethod
   def write(self, variable: Variable, value: object) -> None: ...
 
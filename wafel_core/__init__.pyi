@@ -5,13 +5,26 @@ from typing import *
 
 class Pipeline:
   @staticmethod
-  def load(dll_path: str) -> Pipeline: ...
+  def load(
+    dll_path: str,
+    slot_memory_budget: Optional[int] = None,
+    archive_directory: Optional[str] = None,
+    worker_count: int = 0,
+  ) -> Pipeline: ...
   @staticmethod
-  def load_reusing_edits(dll_path: str, prev_pipeline: Pipeline) -> Pipeline: ...
+  def load_reusing_edits(
+    dll_path: str,
+    prev_pipeline: Pipeline,
+    slot_memory_budget: Optional[int] = None,
+    archive_directory: Optional[str] = None,
+    worker_count: int = 0,
+  ) -> Pipeline: ...
   def dump_layout(self) -> str: ...
 
   def read(self, variable: Variable) -> object: ...
+  def read_range(self, variables: List[Variable], frame_start: int, frame_end: int) -> List[List[object]]: ...
   def write(self, variable: Variable, value: object) -> None: ...
+  def write_all(self, writes: List[Tuple[Variable, object]]) -> None: ...
   def reset(self, variable: Variable) -> None: ...
 
   def path_address(self, frame: int, path: str) -> Optional[Address]: ...
@@ -26,12 +39,29 @@ class Pipeline:
   def find_edit_range(self, variable: Variable) -> Optional[EditRange]: ...
 
   def set_hotspot(self, name: str, frame: int) -> None: ...
-  def balance_distribution(self, max_run_time_seconds: float) -> None: ...
+  def set_hotspot_range(self, name: str, frame_start: int, frame_end: int, weight: float = 1.0) -> None: ...
+  def delete_hotspot(self, name: str) -> None: ...
+  def set_preload_window(self, frames_before: int, frames_after: int) -> None: ...
+  def set_play_speed(self, play_speed: float) -> None: ...
+  def balance_distribution(self, max_run_time_seconds: float) -> Tuple[int, int, int, int, int]: ...
+  def refill(self, max_run_time_seconds: float) -> None: ...
+  def refill_progress(self) -> Optional[float]: ...
+  def cancel_refill(self) -> None: ...
 
   def cached_frames(self) -> List[int]: ...
   def num_advances(self) -> int: ...
   def num_copies(self) -> int: ...
+  def bytes_copied(self) -> Tuple[int, int, int]: ...
+  def take_request_stats(self) -> Tuple[int, int, int, int]: ...
+  def take_copy_timing(self) -> Tuple[int, float, int, float]: ...
+  def take_background_errors(self) -> List[str]: ...
+  def start_request_trace(self) -> None: ...
+  def compare_eviction_policies(self, num_slots: int) -> List[Tuple[str, int, int, float]]: ...
+  def dedup_ratio(self) -> float: ...
+  def cost_weights(self) -> Tuple[float, float]: ...
   def data_cache_size(self) -> int: ...
+  def set_data_cache_budget(self, byte_budget: int) -> None: ...
+  def data_cache_stats(self) -> Tuple[int, int, int]: ...
 
   def label(self, variable: Variable) -> Optional[str]: ...
   def is_int(self, variable: Variable) -> bool: ...
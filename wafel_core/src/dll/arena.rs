@@ -0,0 +1,202 @@
+//! Contiguous storage for buffer slots and delta slot pages.
+
+use std::{
+    io, ptr, slice,
+    sync::{Arc, Mutex},
+};
+use winapi::{
+    shared::minwindef::LPVOID,
+    um::{
+        memoryapi::{VirtualAlloc, VirtualFree},
+        winnt::{MEM_COMMIT, MEM_DECOMMIT, MEM_RELEASE, MEM_RESERVE, PAGE_READWRITE},
+    },
+};
+
+/// The number of blocks that are reserved together in one chunk.
+const BLOCKS_PER_CHUNK: usize = 16;
+
+/// Storage for fixed size blocks, carved out of large reserved regions of address space.
+///
+/// Each block is a page-aligned region, and each segment lies at a fixed offset within it.
+/// Buffer slots use one block per slot, and delta slots use one block per page.
+///
+/// A block's memory is committed when it is allocated and decommitted when it is released,
+/// so freed blocks are returned to the OS even while other blocks in their chunk are in use.
+#[derive(Debug)]
+pub struct SlotArena {
+    /// The offset and size of each segment within a block.
+    segments: Vec<(usize, usize)>,
+    block_size: usize,
+    chunks: Mutex<Chunks>,
+}
+
+#[derive(Debug, Default)]
+struct Chunks {
+    chunks: Vec<Option<ArenaChunk>>,
+    /// The indices of the chunks that have free blocks.
+    with_free: Vec<usize>,
+}
+
+#[derive(Debug)]
+struct ArenaChunk {
+    region: *mut u8,
+    free: Vec<usize>,
+}
+
+// The region is only accessed through the blocks allocated from it.
+unsafe impl Send for ArenaChunk {}
+
+impl SlotArena {
+    /// Create an arena for blocks containing segments of the given sizes.
+    ///
+    /// Each segment is aligned to `page_size` within the block.
+    pub fn new(segment_sizes: &[usize], page_size: usize) -> Self {
+        let mut segments = Vec::new();
+        let mut offset = 0;
+        for &size in segment_sizes {
+            segments.push((offset, size));
+            offset += align_up(size, page_size);
+        }
+        Self {
+            segments,
+            block_size: offset.max(page_size),
+            chunks: Mutex::new(Chunks::default()),
+        }
+    }
+
+    /// Allocate a zeroed block.
+    ///
+    /// A new chunk is reserved if all existing chunks are full.
+    pub fn allocate(self: &Arc<Self>) -> io::Result<ArenaSlot> {
+        let mut guard = self.chunks.lock().unwrap();
+        let chunks = &mut *guard;
+
+        let chunk_index = match chunks.with_free.last() {
+            Some(&chunk_index) => chunk_index,
+            None => {
+                let region = unsafe {
+                    VirtualAlloc(
+                        ptr::null_mut(),
+                        self.block_size * BLOCKS_PER_CHUNK,
+                        MEM_RESERVE,
+                        PAGE_READWRITE,
+                    )
+                };
+                if region.is_null() {
+                    return Err(io::Error::last_os_error());
+                }
+                let chunk = ArenaChunk {
+                    region: region as *mut u8,
+                    free: (0..BLOCKS_PER_CHUNK).rev().collect(),
+                };
+                let chunk_index = match chunks.chunks.iter().position(Option::is_none) {
+                    Some(index) => index,
+                    None => {
+                        chunks.chunks.push(None);
+                        chunks.chunks.len() - 1
+                    }
+                };
+                chunks.chunks[chunk_index] = Some(chunk);
+                chunks.with_free.push(chunk_index);
+                chunk_index
+            }
+        };
+
+        let chunk = chunks.chunks[chunk_index].as_mut().unwrap();
+        let block_index = *chunk.free.last().unwrap();
+        let pointer = unsafe { chunk.region.add(block_index * self.block_size) };
+        // Newly committed memory is zero-filled
+        let committed = unsafe {
+            VirtualAlloc(
+                pointer as LPVOID,
+                self.block_size,
+                MEM_COMMIT,
+                PAGE_READWRITE,
+            )
+        };
+        if committed.is_null() {
+            return Err(io::Error::last_os_error());
+        }
+        chunk.free.pop();
+        if chunk.free.is_empty() {
+            chunks.with_free.pop();
+        }
+
+        Ok(ArenaSlot {
+            arena: Arc::clone(self),
+            chunk: chunk_index,
+            index: block_index,
+            pointer,
+        })
+    }
+
+    /// Decommit a block and return it to its chunk, releasing the chunk if it is no longer
+    /// in use.
+    fn release(&self, chunk_index: usize, block_index: usize, pointer: *mut u8) {
+        let mut guard = self.chunks.lock().unwrap();
+        let chunks = &mut *guard;
+        unsafe {
+            VirtualFree(pointer as LPVOID, self.block_size, MEM_DECOMMIT);
+        }
+
+        let chunk = chunks.chunks[chunk_index]
+            .as_mut()
+            .expect("block released from unreserved chunk");
+        chunk.free.push(block_index);
+        match chunk.free.len() {
+            1 => chunks.with_free.push(chunk_index),
+            BLOCKS_PER_CHUNK => {
+                let region = chunk.region;
+                chunks.chunks[chunk_index] = None;
+                chunks.with_free.retain(|&index| index != chunk_index);
+                unsafe {
+                    VirtualFree(region as LPVOID, 0, MEM_RELEASE);
+                }
+            }
+            _ => {}
+        }
+    }
+}
+
+/// A block allocated from a `SlotArena`.
+#[derive(Debug)]
+pub struct ArenaSlot {
+    arena: Arc<SlotArena>,
+    chunk: usize,
+    index: usize,
+    pointer: *mut u8,
+}
+
+// The block's region is only accessed through the block, so Rust's borrow rules enforce
+// safe accesses.
+unsafe impl Send for ArenaSlot {}
+unsafe impl Sync for ArenaSlot {}
+
+impl ArenaSlot {
+    /// Return the arena that the block was allocated from.
+    pub fn arena(&self) -> &Arc<SlotArena> {
+        &self.arena
+    }
+
+    /// Return the bytes of a segment.
+    pub fn segment(&self, index: usize) -> Option<&[u8]> {
+        let &(offset, size) = self.arena.segments.get(index)?;
+        unsafe { Some(slice::from_raw_parts(self.pointer.add(offset), size)) }
+    }
+
+    /// Return the bytes of a segment.
+    pub fn segment_mut(&mut self, index: usize) -> Option<&mut [u8]> {
+        let &(offset, size) = self.arena.segments.get(index)?;
+        unsafe { Some(slice::from_raw_parts_mut(self.pointer.add(offset), size)) }
+    }
+}
+
+impl Drop for ArenaSlot {
+    fn drop(&mut self) {
+        self.arena.release(self.chunk, self.index, self.pointer);
+    }
+}
+
+fn align_up(size: usize, alignment: usize) -> usize {
+    (size + alignment - 1) / alignment * alignment
+}
@@ -20,6 +20,13 @@ pub enum DllErrorCause {
     MissingSegment { name: String },
     #[display(fmt = "overlapping DLL segments: {} and {}", name1, name2)]
     OverlappingSegments { name1: String, name2: String },
+    #[display(fmt = "failed to copy DLL for a new instance: {}", source)]
+    InstanceCopyError { source: io::Error },
+    #[display(fmt = "failed to allocate slot: {}", source)]
+    SlotAllocationError { source: io::Error },
+    #[display(fmt = "slot archive error: {}", _0)]
+    #[from]
+    SlotArchiveError(io::Error),
 }
 
 pub type LayoutError = WithContext<LayoutErrorCause>;
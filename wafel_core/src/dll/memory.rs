@@ -3,7 +3,9 @@
 #![allow(clippy::mutex_atomic)]
 
 use super::{
+    arena::{ArenaSlot, SlotArena},
     layout::{load_layout_from_dll, DllSegment},
+    write_tracker::WriteTracker,
     DllError, DllErrorCause,
 };
 use crate::{
@@ -20,16 +22,23 @@ use dlopen::raw::{AddressInfoObtainer, Library};
 use itertools::Itertools;
 use lazy_static::lazy_static;
 use std::{
-    collections::HashMap,
+    borrow::Cow,
+    collections::{hash_map::DefaultHasher, HashMap},
+    convert::TryInto,
     env,
     fmt::Display,
-    mem,
-    path::Path,
-    slice,
+    fs,
+    hash::Hasher,
+    io, iter,
+    mem::{self, ManuallyDrop},
+    ops::Range,
+    path::{Path, PathBuf},
+    process, slice,
     sync::{
-        atomic::{AtomicUsize, Ordering},
-        Mutex,
+        atomic::{AtomicU64, AtomicUsize, Ordering},
+        Arc, Mutex, Weak,
     },
+    time::{Duration, Instant},
 };
 use winapi::um::{dbghelp::SymCleanup, processthreadsapi::GetCurrentProcess};
 
@@ -37,22 +46,295 @@ lazy_static! {
     static ref NEXT_MEMORY_ID: Mutex<usize> = Mutex::new(1);
 }
 
+/// Used to give each private copy of a DLL a unique file name.
+static NEXT_INSTANCE_ID: AtomicUsize = AtomicUsize::new(0);
+
+/// The granularity at which delta slots share memory with other slots.
+const PAGE_SIZE: usize = 4096;
+
+/// The size of a pointer stored in slot memory.
+const POINTER_SIZE: usize = mem::size_of::<usize>();
+
+/// Set in a base slot page's version after the base slot is advanced, if the update
+/// function wrote to the page or its writes couldn't be tracked.
+///
+/// The remaining bits hold the version from before the advance, so that an unchanged page
+/// can keep it after being compared to another slot's copy.
+const MAYBE_MODIFIED: u64 = 1 << 63;
+
+/// A shared count of the bytes allocated for backup slots.
+#[derive(Debug, Clone, Default)]
+struct AllocationCounter(Arc<AtomicUsize>);
+
+impl AllocationCounter {
+    fn get(&self) -> usize {
+        self.0.load(Ordering::Relaxed)
+    }
+}
+
+/// A number of bytes tracked by an `AllocationCounter` for as long as this object is alive.
+#[derive(Debug)]
+struct Allocation {
+    counter: AllocationCounter,
+    size: usize,
+}
+
+impl Allocation {
+    fn new(counter: &AllocationCounter, size: usize) -> Self {
+        counter.0.fetch_add(size, Ordering::Relaxed);
+        Self {
+            counter: counter.clone(),
+            size,
+        }
+    }
+}
+
+impl Clone for Allocation {
+    fn clone(&self) -> Self {
+        Self::new(&self.counter, self.size)
+    }
+}
+
+impl Drop for Allocation {
+    fn drop(&mut self) {
+        self.counter.0.fetch_sub(self.size, Ordering::Relaxed);
+    }
+}
+
+/// Version numbers identifying the contents of each page of a slot.
+///
+/// Two pages with the same nonzero version are guaranteed to hold the same bytes, which lets
+/// `copy_slot` skip them. Version 0 means that the contents are unknown.
+///
+/// The versions are atomic so that they can be assigned while the slot is borrowed as the
+/// source of a copy.
+#[derive(Debug)]
+struct PageVersions(Vec<Vec<AtomicU64>>);
+
+impl PageVersions {
+    fn new(data_segments: &[DllSegment]) -> Self {
+        Self(
+            data_segments
+                .iter()
+                .map(|segment| {
+                    iter::repeat_with(|| AtomicU64::new(0))
+                        .take(num_pages(segment.virtual_size))
+                        .collect()
+                })
+                .collect(),
+        )
+    }
+
+    fn get(&self, segment: usize, page: usize) -> u64 {
+        self.0[segment][page].load(Ordering::Relaxed)
+    }
+
+    fn set(&self, segment: usize, page: usize, version: u64) {
+        self.0[segment][page].store(version, Ordering::Relaxed);
+    }
+
+    /// Return true if the page's contents are known and haven't been modified since.
+    fn is_known(&self, segment: usize, page: usize) -> bool {
+        let version = self.get(segment, page);
+        version != 0 && version & MAYBE_MODIFIED == 0
+    }
+
+    /// Mark a page as possibly modified.
+    fn mark_page_modified(&self, segment: usize, page: usize) {
+        self.0[segment][page].fetch_or(MAYBE_MODIFIED, Ordering::Relaxed);
+    }
+
+    /// Mark every page as possibly modified.
+    fn mark_modified(&self) {
+        for version in self.0.iter().flatten() {
+            version.fetch_or(MAYBE_MODIFIED, Ordering::Relaxed);
+        }
+    }
+}
+
 /// A backup buffer that can hold the data segments of the DLL.
+///
+/// The segments are stored contiguously in a region allocated from the memory's
+/// `SlotArena`.
 #[derive(Debug, Display)]
 #[display(fmt = "buf[{}]", id)]
 pub struct BufferSlot {
     memory_id: usize,
     id: usize,
-    segments: Vec<Vec<u8>>,
+    storage: ArenaSlot,
+    versions: PageVersions,
+    allocation: Allocation,
+    logical_size: Allocation,
 }
 
 impl BufferSlot {
     fn segment(&self, index: usize) -> Option<&[u8]> {
-        self.segments.get(index).map(|seg| seg.as_slice())
+        self.storage.segment(index)
     }
 
     fn segment_mut(&mut self, index: usize) -> Option<&mut [u8]> {
-        self.segments.get_mut(index).map(|seg| seg.as_mut_slice())
+        self.storage.segment_mut(index)
+    }
+}
+
+/// An immutable page of slot memory that can be shared between delta slots.
+///
+/// The page is stored in a block of the memory's page arena, so that its memory is returned
+/// to the OS as soon as the page is dropped.
+#[derive(Debug)]
+struct Page {
+    version: AtomicU64,
+    block: ArenaSlot,
+    len: usize,
+    allocation: Allocation,
+}
+
+impl Page {
+    /// Allocate a zeroed page of the given length.
+    fn zeroed(
+        arena: &Arc<SlotArena>,
+        counter: &AllocationCounter,
+        version: u64,
+        len: usize,
+    ) -> Self {
+        let block = arena.allocate().expect("failed to allocate page");
+        Self {
+            version: AtomicU64::new(version),
+            block,
+            len,
+            allocation: Allocation::new(counter, len),
+        }
+    }
+
+    fn new(
+        arena: &Arc<SlotArena>,
+        counter: &AllocationCounter,
+        version: u64,
+        bytes: &[u8],
+    ) -> Self {
+        let mut page = Self::zeroed(arena, counter, version, bytes.len());
+        page.bytes_mut().copy_from_slice(bytes);
+        page
+    }
+
+    fn version(&self) -> u64 {
+        self.version.load(Ordering::Relaxed)
+    }
+
+    fn bytes(&self) -> &[u8] {
+        &self.block.segment(0).unwrap()[..self.len]
+    }
+
+    fn bytes_mut(&mut self) -> &mut [u8] {
+        &mut self.block.segment_mut(0).unwrap()[..self.len]
+    }
+}
+
+impl Clone for Page {
+    fn clone(&self) -> Self {
+        // The clone is only made in order to be modified
+        Self::new(
+            self.block.arena(),
+            &self.allocation.counter,
+            0,
+            self.bytes(),
+        )
+    }
+}
+
+/// An index of pages by a hash of their contents, so that delta slots can share identical
+/// pages even when they differ from the keyframe.
+#[derive(Debug, Default)]
+struct PageIndex {
+    pages: HashMap<u64, Weak<Page>>,
+    /// The number of entries at which dropped pages are next removed from the index.
+    prune_len: usize,
+}
+
+impl PageIndex {
+    /// Return a live page with the given contents if there is one.
+    fn find(&self, hash: u64, bytes: &[u8]) -> Option<Arc<Page>> {
+        let page = self.pages.get(&hash)?.upgrade()?;
+        // Guard against hash collisions
+        if page.bytes() == bytes {
+            Some(page)
+        } else {
+            None
+        }
+    }
+
+    fn insert(&mut self, hash: u64, page: &Arc<Page>) {
+        self.pages.insert(hash, Arc::downgrade(page));
+        if self.pages.len() > self.prune_len {
+            self.pages.retain(|_, page| page.strong_count() > 0);
+            self.prune_len = (2 * self.pages.len()).max(1024);
+        }
+    }
+}
+
+/// A backup buffer that stores the data segments as a list of shared pages.
+///
+/// When the slot is copied into using `copy_slot_delta`, pages that are identical to the
+/// keyframe's pages are shared with the keyframe instead of being copied, so the slot only
+/// owns the pages that differ.
+#[derive(Debug, Display)]
+#[display(fmt = "delta[{}]", id)]
+pub struct DeltaSlot {
+    memory_id: usize,
+    id: usize,
+    segments: Vec<Vec<Arc<Page>>>,
+    logical_size: Allocation,
+}
+
+impl DeltaSlot {
+    fn page(&self, segment: usize, page: usize) -> Option<&[u8]> {
+        Some(self.segments.get(segment)?.get(page)?.bytes())
+    }
+
+    fn page_mut(&mut self, segment: usize, page: usize) -> Option<&mut [u8]> {
+        let page = Arc::make_mut(self.segments.get_mut(segment)?.get_mut(page)?);
+        page.version = AtomicU64::new(0);
+        Some(page.bytes_mut())
+    }
+}
+
+/// A page of a compressed slot.
+#[derive(Debug)]
+enum CompressedPage {
+    /// A page shared with other delta slots, which is left uncompressed.
+    Shared(Arc<Page>),
+    /// An LZ4 compressed page owned by the slot.
+    Compressed {
+        version: AtomicU64,
+        size: usize,
+        bytes: Box<[u8]>,
+        allocation: Allocation,
+    },
+}
+
+/// A backup buffer whose pages are compressed to save memory.
+///
+/// The slot can't be read directly, but can be used as the source of a copy. It is replaced
+/// by an uncompressed slot when it is copied into.
+#[derive(Debug, Display)]
+#[display(fmt = "compressed[{}]", id)]
+pub struct CompressedSlot {
+    memory_id: usize,
+    id: usize,
+    /// Whether the slot was a delta slot before it was compressed.
+    is_delta: bool,
+    segments: Vec<Vec<CompressedPage>>,
+    logical_size: Allocation,
+}
+
+impl CompressedSlot {
+    fn page_bytes(&self, segment: usize, page: usize) -> Option<Cow<'_, [u8]>> {
+        match self.segments.get(segment)?.get(page)? {
+            CompressedPage::Shared(page) => Some(Cow::Borrowed(page.bytes())),
+            CompressedPage::Compressed { size, bytes, .. } => Some(Cow::Owned(
+                lz4_flex::decompress(bytes, *size).expect("corrupt compressed page"),
+            )),
+        }
     }
 }
 
@@ -64,6 +346,7 @@ pub struct BaseSlot {
     base_pointer: BasePointer,
     base_size: usize,
     data_segments: Vec<DllSegment>,
+    versions: PageVersions,
 }
 
 impl BaseSlot {
@@ -94,6 +377,10 @@ pub enum Slot {
     Base(BaseSlot),
     /// Buffer slot, allocated by user.
     Buffer(BufferSlot),
+    /// Buffer slot stored as pages shared with a keyframe, allocated by user.
+    Delta(DeltaSlot),
+    /// Buffer or delta slot that has been compressed.
+    Compressed(CompressedSlot),
 }
 
 impl Slot {
@@ -101,20 +388,101 @@ impl Slot {
         match self {
             Slot::Base(slot) => slot.memory_id,
             Slot::Buffer(slot) => slot.memory_id,
+            Slot::Delta(slot) => slot.memory_id,
+            Slot::Compressed(slot) => slot.memory_id,
         }
     }
 
+    /// Return the segment as a contiguous slice, or None for a delta or compressed slot.
     unsafe fn segment(&self, index: usize) -> Option<&[u8]> {
         match self {
             Slot::Base(slot) => slot.segment(index),
             Slot::Buffer(slot) => slot.segment(index),
+            Slot::Delta(_) | Slot::Compressed(_) => None,
         }
     }
 
+    /// Return the segment as a contiguous slice, or None for a delta or compressed slot.
     unsafe fn segment_mut(&mut self, index: usize) -> Option<&mut [u8]> {
         match self {
             Slot::Base(slot) => slot.segment_mut(index),
             Slot::Buffer(slot) => slot.segment_mut(index),
+            Slot::Delta(_) | Slot::Compressed(_) => None,
+        }
+    }
+
+    /// Return the bytes of a page within a segment, or None for a compressed slot.
+    ///
+    /// The last page of a segment may be shorter than `PAGE_SIZE`.
+    unsafe fn page(&self, segment: usize, page: usize) -> Option<&[u8]> {
+        match self {
+            Slot::Delta(slot) => slot.page(segment, page),
+            Slot::Compressed(_) => None,
+            _ => self.segment(segment)?.chunks(PAGE_SIZE).nth(page),
+        }
+    }
+
+    /// Return the bytes of a page within a segment, decompressing it if necessary.
+    unsafe fn page_bytes(&self, segment: usize, page: usize) -> Option<Cow<'_, [u8]>> {
+        match self {
+            Slot::Compressed(slot) => slot.page_bytes(segment, page),
+            _ => self.page(segment, page).map(Cow::Borrowed),
+        }
+    }
+
+    /// Return the bytes of a page within a segment.
+    ///
+    /// The page's version is reset since its contents may change. For delta slots, this
+    /// unshares the page if it is shared with another slot.
+    unsafe fn page_mut(&mut self, segment: usize, page: usize) -> Option<&mut [u8]> {
+        match self {
+            Slot::Base(slot) => slot.versions.set(segment, page, 0),
+            Slot::Buffer(slot) => slot.versions.set(segment, page, 0),
+            Slot::Delta(slot) => return slot.page_mut(segment, page),
+            Slot::Compressed(_) => return None,
+        }
+        self.segment_mut(segment)?.chunks_mut(PAGE_SIZE).nth(page)
+    }
+
+    /// Return the version of a page, or 0 if unknown.
+    fn page_version(&self, segment: usize, page: usize) -> u64 {
+        match self {
+            Slot::Base(slot) => slot.versions.get(segment, page),
+            Slot::Buffer(slot) => slot.versions.get(segment, page),
+            Slot::Delta(slot) => slot.segments[segment][page].version(),
+            Slot::Compressed(slot) => match &slot.segments[segment][page] {
+                CompressedPage::Shared(page) => page.version(),
+                CompressedPage::Compressed { version, .. } => version.load(Ordering::Relaxed),
+            },
+        }
+    }
+
+    fn set_page_version(&self, segment: usize, page: usize, version: u64) {
+        match self {
+            Slot::Base(slot) => slot.versions.set(segment, page, version),
+            Slot::Buffer(slot) => slot.versions.set(segment, page, version),
+            Slot::Delta(slot) => slot.segments[segment][page]
+                .version
+                .store(version, Ordering::Relaxed),
+            Slot::Compressed(slot) => match &slot.segments[segment][page] {
+                CompressedPage::Shared(page) => page.version.store(version, Ordering::Relaxed),
+                CompressedPage::Compressed {
+                    version: page_version,
+                    ..
+                } => page_version.store(version, Ordering::Relaxed),
+            },
+        }
+    }
+
+    /// Return the shared page at the given location if this is a delta slot.
+    fn shared_page(&self, segment: usize, page: usize) -> Option<&Arc<Page>> {
+        match self {
+            Slot::Delta(slot) => slot.segments.get(segment)?.get(page),
+            Slot::Compressed(slot) => match slot.segments.get(segment)?.get(page)? {
+                CompressedPage::Shared(page) => Some(page),
+                CompressedPage::Compressed { .. } => None,
+            },
+            _ => None,
         }
     }
 }
@@ -135,6 +503,22 @@ pub struct RelocatableAddress {
 #[derive(Debug, Clone, Copy)]
 struct BasePointer(*mut u8);
 
+/// Measured latency of slot copies.
+///
+/// A copy is full if every page of the destination was out of date, and partial if some
+/// pages could be skipped.
+#[derive(Debug, Clone, Copy, Default)]
+pub struct CopyTiming {
+    /// The number of full copies.
+    pub full_copies: usize,
+    /// The total time spent on full copies.
+    pub full_copy_time: Duration,
+    /// The number of partial copies.
+    pub partial_copies: usize,
+    /// The total time spent on partial copies.
+    pub partial_copy_time: Duration,
+}
+
 // The DLL's memory is always accessed via a Slot object (read-write) or
 // a static address (read-only), so Rust's borrow rules enforce safe accesses.
 unsafe impl Send for BasePointer {}
@@ -149,14 +533,39 @@ unsafe impl Sync for BasePointer {}
 pub struct Memory {
     id: usize,
     /// The loaded DLL
-    library: Library,
+    library: ManuallyDrop<Library>,
+    /// The path of the private copy of the DLL, if loaded using `load_instance`.
+    instance_path: Option<PathBuf>,
     base_pointer: BasePointer,
     base_size: usize,
     /// Info on the segments that are included in backup slots (.data and .bss).
     data_segments: Vec<DllSegment>,
     layout: DataLayout,
+    /// Storage for buffer slots.
+    arena: Arc<SlotArena>,
+    /// Storage for the pages of delta slots.
+    page_arena: Arc<SlotArena>,
     next_buffer_id: AtomicUsize,
+    next_page_version: AtomicU64,
+    /// The number of bytes allocated for backup slots.
+    slot_bytes: AllocationCounter,
+    /// The number of bytes that backup slots would use without sharing or compression.
+    logical_slot_bytes: AllocationCounter,
+    /// Pages owned by delta slots, for sharing identical pages.
+    page_index: Mutex<PageIndex>,
+    /// Debug stat counting the bytes covered by slot copies.
+    num_bytes_requested: AtomicUsize,
+    /// Debug stat counting the bytes of possibly modified pages that slot copies compared
+    /// to find out whether they changed.
+    num_bytes_compared: AtomicUsize,
+    /// Debug stat counting the bytes that slot copies actually moved.
+    num_bytes_copied: AtomicUsize,
+    /// Debug stat measuring the latency of slot copies.
+    copy_timing: Mutex<CopyTiming>,
     update_function: unsafe extern "C" fn(),
+    /// Tracks the base slot pages that the update function writes to, or None if the pages
+    /// can't be protected, in which case every page is assumed to be modified.
+    write_tracker: Option<WriteTracker>,
     data_path_cache: DataPathCache,
 }
 
@@ -242,15 +651,41 @@ impl Memory {
             *next_memory_id = next_memory_id.checked_add(1).unwrap();
             let id = *next_memory_id;
 
+            let segment_sizes: Vec<usize> = data_segments
+                .iter()
+                .map(|segment| segment.virtual_size)
+                .collect();
+            let segment_regions: Vec<(*mut u8, usize)> = data_segments
+                .iter()
+                .map(|segment| {
+                    (
+                        base_pointer.0.wrapping_add(segment.virtual_address),
+                        segment.virtual_size,
+                    )
+                })
+                .collect();
+
             let memory = Self {
                 id,
-                library,
+                library: ManuallyDrop::new(library),
+                instance_path: None,
                 base_pointer,
                 base_size,
                 data_segments: data_segments.clone(),
                 layout: layout.data_layout,
+                arena: Arc::new(SlotArena::new(&segment_sizes, PAGE_SIZE)),
+                page_arena: Arc::new(SlotArena::new(&[PAGE_SIZE], PAGE_SIZE)),
                 next_buffer_id: AtomicUsize::new(1),
+                next_page_version: AtomicU64::new(1),
+                slot_bytes: AllocationCounter::default(),
+                logical_slot_bytes: AllocationCounter::default(),
+                page_index: Mutex::new(PageIndex::default()),
+                num_bytes_requested: AtomicUsize::new(0),
+                num_bytes_compared: AtomicUsize::new(0),
+                num_bytes_copied: AtomicUsize::new(0),
+                copy_timing: Mutex::new(CopyTiming::default()),
                 update_function,
+                write_tracker: WriteTracker::new(&segment_regions, PAGE_SIZE),
                 data_path_cache: DataPathCache::new(),
             };
 
@@ -258,6 +693,7 @@ impl Memory {
                 memory_id: memory.id,
                 base_pointer,
                 base_size,
+                versions: PageVersions::new(&data_segments),
                 data_segments,
             });
 
@@ -266,6 +702,49 @@ impl Memory {
         result.map_err(|error| error.context(format!("{}", dll_path)).into())
     }
 
+    /// Load a private copy of a DLL, so that several instances of the same DLL can be loaded
+    /// at once.
+    ///
+    /// The DLL is copied to a temporary file, which is removed when the memory is dropped.
+    /// Slots can't be copied between instances, since slot memory contains pointers into the
+    /// DLL that it was taken from. Use `slot_data` and `load_slot_data` instead.
+    ///
+    /// # Safety
+    /// See `load`. Each instance is a separate DLL, so instances can be used independently.
+    pub unsafe fn load_instance(
+        dll_path: impl AsRef<Path> + Display,
+        init_function: &str,
+        update_function: &str,
+    ) -> Result<(Self, Slot), Error> {
+        let instance_id = NEXT_INSTANCE_ID.fetch_add(1, Ordering::SeqCst);
+        let file_name = dll_path
+            .as_ref()
+            .file_name()
+            .map(|name| name.to_string_lossy().into_owned())
+            .unwrap_or_default();
+        let instance_path = env::temp_dir().join("wafel-instances").join(format!(
+            "{}-{}-{}",
+            process::id(),
+            instance_id,
+            file_name
+        ));
+
+        let copy_result: Result<(), io::Error> = try {
+            fs::create_dir_all(instance_path.parent().unwrap())?;
+            fs::copy(dll_path.as_ref(), &instance_path)?;
+        };
+        if let Err(source) = copy_result {
+            let error: DllError = DllErrorCause::InstanceCopyError { source }.into();
+            return Err(error.context(format!("{}", dll_path)).into());
+        }
+
+        let instance_path_str = instance_path.to_string_lossy().into_owned();
+        let (mut memory, base_slot) =
+            Self::load(instance_path_str, init_function, update_function)?;
+        memory.instance_path = Some(instance_path);
+        Ok((memory, base_slot))
+    }
+
     fn validate_slot(&self, slot: &Slot) -> Result<(), Error> {
         if slot.memory_id() != self.id {
             Err(MemoryErrorCause::SlotFromDifferentMemory.into())
@@ -315,11 +794,14 @@ impl Memory {
     ) -> Result<*const T, Error> {
         self.validate_slot(slot)?;
         unsafe {
-            let segment = slot
-                .segment(address.segment)
+            // PAGE_SIZE is a multiple of every primitive's alignment, so values never
+            // straddle a page boundary
+            let page = slot
+                .page(address.segment, address.offset / PAGE_SIZE)
                 .ok_or_else(|| MemoryErrorCause::InvalidAddress)?;
-            self.validate_offset::<T>(address.offset, segment.len())?;
-            Ok(&segment[address.offset] as *const u8 as *const T)
+            let offset = address.offset % PAGE_SIZE;
+            self.validate_offset::<T>(offset, page.len())?;
+            Ok(&page[offset] as *const u8 as *const T)
         }
     }
 
@@ -334,11 +816,12 @@ impl Memory {
     ) -> Result<*mut T, Error> {
         self.validate_slot(slot)?;
         unsafe {
-            let segment = slot
-                .segment_mut(address.segment)
+            let page = slot
+                .page_mut(address.segment, address.offset / PAGE_SIZE)
                 .ok_or_else(|| MemoryErrorCause::InvalidAddress)?;
-            self.validate_offset::<T>(address.offset, segment.len())?;
-            Ok(&mut segment[address.offset] as *mut u8 as *mut T)
+            let offset = address.offset % PAGE_SIZE;
+            self.validate_offset::<T>(offset, page.len())?;
+            Ok(&mut page[offset] as *mut u8 as *mut T)
         }
     }
 
@@ -356,6 +839,274 @@ impl Memory {
             })
             .collect()
     }
+
+    /// Return the number of bytes that slot copies have covered, the number of bytes they
+    /// compared because the update function may have modified them, and the number of
+    /// bytes that they actually moved.
+    ///
+    /// The difference between the first and last is the work saved by skipping pages whose
+    /// contents already match.
+    pub fn bytes_copied(&self) -> (usize, usize, usize) {
+        (
+            self.num_bytes_requested.load(Ordering::Relaxed),
+            self.num_bytes_compared.load(Ordering::Relaxed),
+            self.num_bytes_copied.load(Ordering::Relaxed),
+        )
+    }
+
+    /// Return the latency of slot copies since the last call, split into full and partial
+    /// copies.
+    pub fn take_copy_timing(&self) -> CopyTiming {
+        mem::take(&mut *self.copy_timing.lock().unwrap())
+    }
+
+    /// Return the ratio between the size that backup slots would have without sharing or
+    /// compression, and the number of bytes actually allocated for them.
+    pub fn dedup_ratio(&self) -> f64 {
+        self.logical_slot_bytes.get() as f64 / self.slot_bytes.get().max(1) as f64
+    }
+
+    /// The total size of the data segments that are stored in backup slots.
+    fn data_size(&self) -> usize {
+        self.data_segments
+            .iter()
+            .map(|segment| segment.virtual_size)
+            .sum()
+    }
+
+    /// The size of the data returned by `slot_data`.
+    fn slot_data_size(&self) -> usize {
+        mem::size_of::<u64>() + self.data_size() + self.relocations_size()
+    }
+
+    /// The size of the bitmap in `slot_data` marking which words are relocated pointers.
+    fn relocations_size(&self) -> usize {
+        let num_words: usize = self
+            .data_segments
+            .iter()
+            .map(|segment| segment.virtual_size / POINTER_SIZE)
+            .sum();
+        (num_words + 7) / 8
+    }
+
+    /// Return the version of a page, assigning a new version if it is unknown.
+    ///
+    /// If the page may have been modified since its version was assigned, it keeps the old
+    /// version when its contents still match `previous`, which must be a page with the old
+    /// version. This way an advance of the base slot only invalidates the pages that the
+    /// update function actually changed.
+    ///
+    /// # Safety
+    /// `slot` must not be modified while this method is running.
+    unsafe fn page_version(
+        &self,
+        slot: &Slot,
+        segment: usize,
+        page: usize,
+        previous: Option<(u64, &[u8])>,
+    ) -> u64 {
+        let version = slot.page_version(segment, page);
+        if version & MAYBE_MODIFIED == 0 && version != 0 {
+            return version;
+        }
+
+        let old_version = version & !MAYBE_MODIFIED;
+        if let Some((previous_version, previous_bytes)) = previous {
+            if old_version != 0 && previous_version == old_version {
+                self.num_bytes_compared
+                    .fetch_add(previous_bytes.len(), Ordering::Relaxed);
+                if slot.page(segment, page) == Some(previous_bytes) {
+                    slot.set_page_version(segment, page, old_version);
+                    return old_version;
+                }
+            }
+        }
+
+        let version = self.next_page_version.fetch_add(1, Ordering::Relaxed);
+        slot.set_page_version(segment, page, version);
+        version
+    }
+
+    /// Return the version of `dst`'s copy of a page along with its bytes, for passing to
+    /// `page_version`.
+    ///
+    /// # Safety
+    /// `dst` must not be modified while the bytes are live.
+    unsafe fn previous_page<'a>(
+        &self,
+        dst: &'a Slot,
+        segment: usize,
+        page: usize,
+    ) -> Option<(u64, &'a [u8])> {
+        Some((dst.page_version(segment, page), dst.page(segment, page)?))
+    }
+
+    /// Replace a compressed slot with an empty uncompressed slot of the same kind.
+    ///
+    /// This is done before a slot is overwritten, since compressed slots can't be written to.
+    fn reset_compressed_slot(&self, slot: &mut Slot) -> Result<(), Error> {
+        if let Slot::Compressed(compressed) = slot {
+            *slot = if compressed.is_delta {
+                self.create_delta_slot()?
+            } else {
+                self.create_backup_slot()?
+            };
+        }
+        Ok(())
+    }
+
+    /// Copy a segment of `src` into a contiguous slot, skipping pages that are already
+    /// up to date.
+    ///
+    /// Consecutive out of date pages are copied together.
+    ///
+    /// # Safety
+    /// `src` must not be modified while this method is running.
+    unsafe fn copy_segment(&self, dst: &mut Slot, src: &Slot, segment: usize) {
+        let size = self.data_segments[segment].virtual_size;
+        // Either slot may be a base slot whose pages were possibly modified, in which case
+        // its pages are compared to the other slot's
+        let previous: &Slot = dst;
+        let versions: Vec<u64> = (0..num_pages(size))
+            .map(|page| {
+                self.page_version(
+                    src,
+                    segment,
+                    page,
+                    self.previous_page(previous, segment, page),
+                )
+            })
+            .collect();
+        let stale: Vec<bool> = versions
+            .iter()
+            .enumerate()
+            .map(|(page, &version)| {
+                let src_page = src.page(segment, page).map(|bytes| (version, bytes));
+                self.page_version(previous, segment, page, src_page) != version
+            })
+            .collect();
+        self.num_bytes_requested.fetch_add(size, Ordering::Relaxed);
+
+        for (is_stale, pages) in &(0..versions.len()).group_by(|&page| stale[page]) {
+            if !is_stale {
+                continue;
+            }
+            let pages: Vec<usize> = pages.collect();
+            let pages = pages[0]..pages[pages.len() - 1] + 1;
+
+            let bytes = self.copy_pages(dst, src, segment, pages.clone());
+            for page in pages {
+                dst.set_page_version(segment, page, versions[page]);
+            }
+            self.num_bytes_copied.fetch_add(bytes, Ordering::Relaxed);
+        }
+    }
+
+    /// Copy a range of pages within a segment, returning the number of bytes copied.
+    ///
+    /// # Safety
+    /// `src` must not be modified while this method is running.
+    unsafe fn copy_pages(
+        &self,
+        dst: &mut Slot,
+        src: &Slot,
+        segment: usize,
+        pages: Range<usize>,
+    ) -> usize {
+        let size = self.data_segments[segment].virtual_size;
+        let bytes = pages.start * PAGE_SIZE..(pages.end * PAGE_SIZE).min(size);
+
+        if src.segment(segment).is_some() && dst.segment(segment).is_some() {
+            let src_bytes = &src.segment(segment).unwrap()[bytes.clone()];
+            dst.segment_mut(segment).unwrap()[bytes.clone()].copy_from_slice(src_bytes);
+        } else {
+            for page in pages {
+                dst.page_mut(segment, page)
+                    .unwrap()
+                    .copy_from_slice(&src.page_bytes(segment, page).unwrap());
+            }
+        }
+        bytes.len()
+    }
+
+    /// Copy a segment of `src` into a delta slot.
+    ///
+    /// Pages are shared with `src` if it is a delta slot, and otherwise with `keyframe` when
+    /// their contents match. Pages that are already up to date are kept.
+    ///
+    /// # Safety
+    /// `src` and `keyframe` must not be modified while this method is running.
+    unsafe fn copy_segment_to_delta(
+        &self,
+        dst: &mut DeltaSlot,
+        src: &Slot,
+        keyframe: Option<&Slot>,
+        segment: usize,
+    ) {
+        let num_pages = dst.segments[segment].len();
+        let pages = (0..num_pages)
+            .map(|page| {
+                if let Some(shared) = src.shared_page(segment, page) {
+                    return shared.clone();
+                }
+
+                let existing = &dst.segments[segment][page];
+                let version = self.page_version(
+                    src,
+                    segment,
+                    page,
+                    Some((existing.version(), existing.bytes())),
+                );
+                let bytes = src.page_bytes(segment, page).unwrap();
+                self.num_bytes_requested
+                    .fetch_add(bytes.len(), Ordering::Relaxed);
+
+                if existing.version() == version {
+                    return existing.clone();
+                }
+                if let Some(shared) =
+                    keyframe.and_then(|keyframe| keyframe.shared_page(segment, page))
+                {
+                    if shared.version() == version || shared.bytes() == &*bytes {
+                        src.set_page_version(segment, page, shared.version());
+                        return shared.clone();
+                    }
+                }
+
+                // Share an identical page from any other slot
+                let hash = page_hash(&bytes);
+                let mut page_index = self.page_index.lock().unwrap();
+                if let Some(shared) = page_index.find(hash, &bytes) {
+                    src.set_page_version(segment, page, shared.version());
+                    return shared;
+                }
+
+                self.num_bytes_copied
+                    .fetch_add(bytes.len(), Ordering::Relaxed);
+                let new_page = Arc::new(Page::new(
+                    &self.page_arena,
+                    &self.slot_bytes,
+                    version,
+                    &bytes,
+                ));
+                page_index.insert(hash, &new_page);
+                new_page
+            })
+            .collect();
+        dst.segments[segment] = pages;
+    }
+}
+
+impl Drop for Memory {
+    fn drop(&mut self) {
+        unsafe {
+            ManuallyDrop::drop(&mut self.library);
+        }
+        // A DLL file can only be removed after it is unloaded
+        if let Some(instance_path) = &self.instance_path {
+            fs::remove_file(instance_path).ok();
+        }
+    }
 }
 
 impl MemoryTrait for Memory {
@@ -556,39 +1307,306 @@ impl MemoryTrait for Memory {
 
     fn create_backup_slot(&self) -> Result<Self::Slot, Error> {
         let id = self.next_buffer_id.fetch_add(1, Ordering::SeqCst);
+        let storage = self
+            .arena
+            .allocate()
+            .map_err(|source| DllErrorCause::SlotAllocationError { source })?;
         Ok(Slot::Buffer(BufferSlot {
+            memory_id: self.id,
+            id,
+            storage,
+            versions: PageVersions::new(&self.data_segments),
+            allocation: Allocation::new(&self.slot_bytes, self.data_size()),
+            logical_size: Allocation::new(&self.logical_slot_bytes, self.data_size()),
+        }))
+    }
+
+    fn create_delta_slot(&self) -> Result<Self::Slot, Error> {
+        let id = self.next_buffer_id.fetch_add(1, Ordering::SeqCst);
+        let zero_page = Arc::new(Page::zeroed(
+            &self.page_arena,
+            &self.slot_bytes,
+            0,
+            PAGE_SIZE,
+        ));
+        Ok(Slot::Delta(DeltaSlot {
             memory_id: self.id,
             id,
             segments: self
                 .data_segments
                 .iter()
-                .map(|segment| vec![0; segment.virtual_size])
+                .map(|segment| {
+                    (0..segment.virtual_size)
+                        .step_by(PAGE_SIZE)
+                        .map(|start| match segment.virtual_size - start {
+                            size if size >= PAGE_SIZE => zero_page.clone(),
+                            size => {
+                                Arc::new(Page::zeroed(&self.page_arena, &self.slot_bytes, 0, size))
+                            }
+                        })
+                        .collect()
+                })
                 .collect(),
+            logical_size: Allocation::new(&self.logical_slot_bytes, self.data_size()),
         }))
     }
 
+    fn compress_slot(&self, slot: &mut Self::Slot) -> Result<bool, Error> {
+        self.validate_slot(slot)?;
+        let (id, is_delta) = match slot {
+            Slot::Buffer(slot) => (slot.id, false),
+            Slot::Delta(slot) => (slot.id, true),
+            Slot::Base(_) | Slot::Compressed(_) => return Ok(false),
+        };
+
+        let segments = self
+            .data_segments
+            .iter()
+            .enumerate()
+            .map(|(segment, info)| {
+                (0..num_pages(info.virtual_size))
+                    .map(|page| match slot.shared_page(segment, page) {
+                        // Compressing a page that other slots share would use more memory
+                        Some(shared) if Arc::strong_count(shared) > 1 => {
+                            CompressedPage::Shared(shared.clone())
+                        }
+                        _ => {
+                            let bytes = unsafe { slot.page(segment, page).unwrap() };
+                            let compressed = lz4_flex::compress(bytes).into_boxed_slice();
+                            CompressedPage::Compressed {
+                                version: AtomicU64::new(slot.page_version(segment, page)),
+                                size: bytes.len(),
+                                allocation: Allocation::new(&self.slot_bytes, compressed.len()),
+                                bytes: compressed,
+                            }
+                        }
+                    })
+                    .collect()
+            })
+            .collect();
+
+        *slot = Slot::Compressed(CompressedSlot {
+            memory_id: self.id,
+            id,
+            is_delta,
+            segments,
+            logical_size: Allocation::new(&self.logical_slot_bytes, self.data_size()),
+        });
+        Ok(true)
+    }
+
+    fn backup_slot_bytes(&self) -> usize {
+        self.slot_bytes.get()
+    }
+
+    fn num_bytes_requested(&self) -> usize {
+        self.num_bytes_requested.load(Ordering::Relaxed)
+    }
+
+    fn num_bytes_copied(&self) -> usize {
+        self.num_bytes_copied.load(Ordering::Relaxed)
+    }
+
     fn copy_slot(&self, dst: &mut Self::Slot, src: &Self::Slot) -> Result<(), Error> {
+        self.copy_slot_delta(dst, src, None)
+    }
+
+    fn copy_slot_delta(
+        &self,
+        dst: &mut Self::Slot,
+        src: &Self::Slot,
+        keyframe: Option<&Self::Slot>,
+    ) -> Result<(), Error> {
         self.validate_slot(dst)?;
         self.validate_slot(src)?;
+        if let Some(keyframe) = keyframe {
+            self.validate_slot(keyframe)?;
+        }
+        self.reset_compressed_slot(dst)?;
+
+        let start_time = Instant::now();
+        let start_bytes_requested = self.num_bytes_requested.load(Ordering::Relaxed);
+        let start_bytes_copied = self.num_bytes_copied.load(Ordering::Relaxed);
         for i in 0..self.data_segments.len() {
             unsafe {
-                let dst_segment = dst.segment_mut(i).unwrap();
-                let src_segment = src.segment(i).unwrap();
-                dst_segment.copy_from_slice(src_segment);
+                if let Slot::Delta(dst) = dst {
+                    self.copy_segment_to_delta(dst, src, keyframe, i);
+                } else {
+                    self.copy_segment(dst, src, i);
+                }
+            }
+        }
+        let elapsed = start_time.elapsed();
+
+        // The counters are shared between threads, so this is only approximate when slots
+        // are copied concurrently
+        let bytes_requested = self
+            .num_bytes_requested
+            .load(Ordering::Relaxed)
+            .wrapping_sub(start_bytes_requested);
+        let bytes_copied = self
+            .num_bytes_copied
+            .load(Ordering::Relaxed)
+            .wrapping_sub(start_bytes_copied);
+        let mut timing = self.copy_timing.lock().unwrap();
+        if bytes_copied >= bytes_requested {
+            timing.full_copies += 1;
+            timing.full_copy_time += elapsed;
+        } else {
+            timing.partial_copies += 1;
+            timing.partial_copy_time += elapsed;
+        }
+        Ok(())
+    }
+
+    /// Return the address that the DLL was loaded at, followed by the contents of a slot
+    /// and a bitmap of the words that point into the DLL.
+    ///
+    /// These pointers are stored relative to the DLL's base address, so that the data can
+    /// be loaded into a copy of the DLL at a different address. Since there is no record of
+    /// which words hold pointers at runtime, any word whose value lies within the DLL's image
+    /// is assumed to be a pointer. An integer or float that happens to lie in this range is
+    /// corrupted when the data is loaded at a different address.
+    fn slot_data(&self, slot: &Self::Slot) -> Result<Vec<u8>, Error> {
+        self.validate_slot(slot)?;
+        let base_address = self.base_pointer.0 as usize;
+        let image = base_address..base_address + self.base_size;
+
+        let mut data = Vec::with_capacity(self.slot_data_size());
+        data.extend_from_slice(&(base_address as u64).to_le_bytes());
+        let mut relocations = vec![0u8; self.relocations_size()];
+        let mut word_index = 0;
+        for (i, segment) in self.data_segments.iter().enumerate() {
+            let segment_start = data.len();
+            for page in 0..num_pages(segment.virtual_size) {
+                data.extend_from_slice(&unsafe { slot.page_bytes(i, page).unwrap() });
+            }
+            for word in data[segment_start..].chunks_exact_mut(POINTER_SIZE) {
+                let value = usize::from_ne_bytes(word[..].try_into().unwrap());
+                if image.contains(&value) {
+                    word.copy_from_slice(&(value - base_address).to_ne_bytes());
+                    relocations[word_index / 8] |= 1 << (word_index % 8);
+                }
+                word_index += 1;
+            }
+        }
+        data.extend(relocations);
+        Ok(data)
+    }
+
+    fn slot_fingerprint(&self, slot: &Self::Slot) -> Result<u64, Error> {
+        self.validate_slot(slot)?;
+        let mut hasher = DefaultHasher::new();
+        for (i, segment) in self.data_segments.iter().enumerate() {
+            for page in 0..num_pages(segment.virtual_size) {
+                hasher.write(&unsafe { slot.page_bytes(i, page).unwrap() });
             }
         }
+        Ok(hasher.finish())
+    }
+
+    fn load_slot_data(&self, slot: &mut Self::Slot, data: &[u8]) -> Result<(), Error> {
+        self.validate_slot(slot)?;
+        let expected_size = self.slot_data_size();
+        if data.len() != expected_size {
+            return Err(MemoryErrorCause::SlotDataSizeMismatch {
+                expected: expected_size,
+                actual: data.len(),
+            }
+            .into());
+        }
+        self.reset_compressed_slot(slot)?;
+
+        let base_address = self.base_pointer.0 as usize;
+        let data = &data[mem::size_of::<u64>()..];
+        let (segment_data, relocations) = data.split_at(self.data_size());
+        let mut offset = 0;
+        let mut word_index = 0;
+        for (i, segment) in self.data_segments.iter().enumerate() {
+            let mut bytes = segment_data[offset..offset + segment.virtual_size].to_vec();
+            for word in bytes.chunks_exact_mut(POINTER_SIZE) {
+                if relocations[word_index / 8] & (1 << (word_index % 8)) != 0 {
+                    let value = usize::from_ne_bytes(word[..].try_into().unwrap());
+                    word.copy_from_slice(&value.wrapping_add(base_address).to_ne_bytes());
+                }
+                word_index += 1;
+            }
+            for (page, page_bytes) in bytes.chunks(PAGE_SIZE).enumerate() {
+                unsafe { slot.page_mut(i, page).unwrap() }.copy_from_slice(page_bytes);
+            }
+            offset += segment.virtual_size;
+        }
         Ok(())
     }
 
+    fn slot_data_address(&self, data: &[u8]) -> Result<Address, Error> {
+        let expected_size = self.slot_data_size();
+        if data.len() != expected_size {
+            return Err(MemoryErrorCause::SlotDataSizeMismatch {
+                expected: expected_size,
+                actual: data.len(),
+            }
+            .into());
+        }
+        let header = &data[..mem::size_of::<u64>()];
+        let address = u64::from_le_bytes(header.try_into().unwrap());
+        Ok(Address(address as usize))
+    }
+
+    /// Return the address that the DLL was loaded at.
+    ///
+    /// Slot memory contains pointers into the DLL, so slots can only be copied between
+    /// DLLs loaded at the same address. `slot_data` stores these pointers relative to this
+    /// address instead.
+    fn base_address(&self) -> Address {
+        Address(self.base_pointer.0 as usize)
+    }
+
     fn advance_base_slot(&self, base_slot: &mut Self::Slot) -> Result<(), Error> {
-        self.validate_base_slot(base_slot)?;
-        unsafe {
-            (self.update_function)();
+        let base_slot = self.validate_base_slot(base_slot)?;
+        let versions = &base_slot.versions;
+        // Pages whose version is already unknown or possibly modified will be compared to
+        // a copy anyway, so only the others need to be watched
+        let written_pages = match &self.write_tracker {
+            Some(tracker) => unsafe {
+                tracker.track(
+                    |segment, page| versions.is_known(segment, page),
+                    || (self.update_function)(),
+                )
+            },
+            None => {
+                unsafe {
+                    (self.update_function)();
+                }
+                None
+            }
+        };
+        // A written page may still hold the same bytes, so it is compared to a copy the next
+        // time it is copied
+        match written_pages {
+            Some(written_pages) => {
+                for (segment, page) in written_pages {
+                    versions.mark_page_modified(segment, page);
+                }
+            }
+            None => versions.mark_modified(),
         }
         Ok(())
     }
 }
 
+/// A hash of a page's contents, used to find identical pages.
+fn page_hash(bytes: &[u8]) -> u64 {
+    let mut hasher = DefaultHasher::new();
+    hasher.write(bytes);
+    hasher.finish()
+}
+
+/// The number of pages needed to hold a segment of the given size.
+fn num_pages(size: usize) -> usize {
+    (size + PAGE_SIZE - 1) / PAGE_SIZE
+}
+
 fn read_symbol<T>(library: &Library, name: &str) -> Result<*const T, DllError> {
     read_symbol_direct(library, name).map_err(|error| {
         DllErrorCause::SymbolReadError {
@@ -8,6 +8,8 @@
 pub use error::*;
 pub use memory::*;
 
+mod arena;
 mod error;
 mod layout;
 mod memory;
+mod write_tracker;
@@ -0,0 +1,198 @@
+//! Detection of the pages that a DLL function writes to.
+
+use itertools::Itertools;
+use lazy_static::lazy_static;
+use std::{
+    cell::Cell,
+    ops::Range,
+    ptr,
+    sync::atomic::{AtomicBool, Ordering},
+};
+use winapi::{
+    shared::minwindef::{DWORD, LPVOID},
+    um::{
+        errhandlingapi::AddVectoredExceptionHandler,
+        memoryapi::VirtualProtect,
+        minwinbase::EXCEPTION_ACCESS_VIOLATION,
+        winnt::{EXCEPTION_POINTERS, LONG, PAGE_READONLY, PAGE_READWRITE},
+    },
+    vc::excpt::{EXCEPTION_CONTINUE_EXECUTION, EXCEPTION_CONTINUE_SEARCH},
+};
+
+/// The value of an access violation's first parameter when it was caused by a write.
+const WRITE_ACCESS: usize = 1;
+
+lazy_static! {
+    static ref HANDLER_INSTALLED: bool =
+        unsafe { !AddVectoredExceptionHandler(0, Some(handle_exception)).is_null() };
+}
+
+thread_local! {
+    /// The tracker whose pages are currently protected on this thread.
+    static ACTIVE_TRACKER: Cell<*const WriteTracker> = Cell::new(ptr::null());
+}
+
+/// Records which pages of a set of memory regions are written to while a function runs.
+///
+/// The watched pages are made read-only before the function is called. The first write to
+/// each one raises an access violation, which a vectored exception handler catches to
+/// record the page and make it writable again. Pages that aren't written to cost nothing
+/// beyond the two protection changes.
+#[derive(Debug)]
+pub struct WriteTracker {
+    page_size: usize,
+    /// The start address of each region.
+    regions: Vec<usize>,
+    /// Whether each page of each region was written to during the current call to `track`.
+    written: Vec<Vec<AtomicBool>>,
+}
+
+impl WriteTracker {
+    /// Create a tracker for the given regions, given as a start pointer and a size.
+    ///
+    /// Returns None if the regions aren't page aligned or the exception handler can't be
+    /// installed.
+    ///
+    /// # Safety
+    /// The regions must be valid writable memory for as long as the tracker is used. Each
+    /// page is written to once so that copy-on-write pages become private.
+    pub unsafe fn new(regions: &[(*mut u8, usize)], page_size: usize) -> Option<Self> {
+        if regions
+            .iter()
+            .any(|&(pointer, _)| pointer as usize % page_size != 0)
+        {
+            return None;
+        }
+        if !*HANDLER_INSTALLED {
+            return None;
+        }
+
+        for &(pointer, size) in regions {
+            for offset in (0..size).step_by(page_size) {
+                let byte = pointer.add(offset);
+                ptr::write_volatile(byte, ptr::read_volatile(byte));
+            }
+        }
+
+        Some(Self {
+            page_size,
+            regions: regions
+                .iter()
+                .map(|&(pointer, _)| pointer as usize)
+                .collect(),
+            written: regions
+                .iter()
+                .map(|&(_, size)| {
+                    (0..size)
+                        .step_by(page_size)
+                        .map(|_| AtomicBool::new(false))
+                        .collect()
+                })
+                .collect(),
+        })
+    }
+
+    /// Call `func` while watching the pages for which `is_watched(region, page)` is true,
+    /// and return the watched pages that it wrote to.
+    ///
+    /// Returns None if the pages couldn't be protected, in which case any page may have
+    /// been written to. `func` is called exactly once either way.
+    ///
+    /// # Safety
+    /// `func` must not write to the watched pages from another thread, and nothing else
+    /// may access them while it runs.
+    pub unsafe fn track(
+        &self,
+        is_watched: impl Fn(usize, usize) -> bool,
+        func: impl FnOnce(),
+    ) -> Option<Vec<(usize, usize)>> {
+        let mut protected: Vec<(usize, Range<usize>)> = Vec::new();
+        let mut protect_failed = false;
+        'regions: for (region, pages) in self.written.iter().enumerate() {
+            for (watched, run) in &(0..pages.len()).group_by(|&page| is_watched(region, page)) {
+                if !watched {
+                    continue;
+                }
+                let run: Vec<usize> = run.collect();
+                let run = run[0]..run[run.len() - 1] + 1;
+                if !self.protect(region, run.clone(), PAGE_READONLY) {
+                    protect_failed = true;
+                    break 'regions;
+                }
+                protected.push((region, run));
+            }
+        }
+
+        if protected.is_empty() || protect_failed {
+            for (region, run) in protected {
+                self.protect(region, run, PAGE_READWRITE);
+            }
+            func();
+            return if protect_failed {
+                None
+            } else {
+                Some(Vec::new())
+            };
+        }
+
+        ACTIVE_TRACKER.with(|active| active.set(self));
+        func();
+        ACTIVE_TRACKER.with(|active| active.set(ptr::null()));
+
+        let mut written_pages = Vec::new();
+        for (region, run) in protected {
+            self.protect(region, run.clone(), PAGE_READWRITE);
+            for page in run {
+                if self.written[region][page].swap(false, Ordering::Relaxed) {
+                    written_pages.push((region, page));
+                }
+            }
+        }
+        Some(written_pages)
+    }
+
+    /// Set the protection of a run of pages, returning false on failure.
+    unsafe fn protect(&self, region: usize, pages: Range<usize>, protection: DWORD) -> bool {
+        let address = self.regions[region] + pages.start * self.page_size;
+        let mut old_protection = 0;
+        VirtualProtect(
+            address as LPVOID,
+            pages.len() * self.page_size,
+            protection,
+            &mut old_protection,
+        ) != 0
+    }
+
+    /// Record a write to the given address and make its page writable, returning false if
+    /// the address isn't in a tracked region.
+    unsafe fn record_write(&self, address: usize) -> bool {
+        for (region, &start) in self.regions.iter().enumerate() {
+            let page = address.wrapping_sub(start) / self.page_size;
+            if address >= start && page < self.written[region].len() {
+                self.written[region][page].store(true, Ordering::Relaxed);
+                return self.protect(region, page..page + 1, PAGE_READWRITE);
+            }
+        }
+        false
+    }
+}
+
+unsafe extern "system" fn handle_exception(info: *mut EXCEPTION_POINTERS) -> LONG {
+    let record = &*(*info).ExceptionRecord;
+    if record.ExceptionCode != EXCEPTION_ACCESS_VIOLATION
+        || record.NumberParameters < 2
+        || record.ExceptionInformation[0] != WRITE_ACCESS
+    {
+        return EXCEPTION_CONTINUE_SEARCH;
+    }
+
+    // Exceptions can be raised during thread teardown, when the thread local is gone
+    let tracker = ACTIVE_TRACKER
+        .try_with(|active| active.get())
+        .unwrap_or(ptr::null());
+    if !tracker.is_null() && (*tracker).record_write(record.ExceptionInformation[1]) {
+        EXCEPTION_CONTINUE_EXECUTION
+    } else {
+        EXCEPTION_CONTINUE_SEARCH
+    }
+}
@@ -299,9 +299,87 @@ pub trait Memory: Sized {
     /// Allocate a new backup slot.
     fn create_backup_slot(&self) -> Result<Self::Slot, Error>;
 
+    /// Allocate a new backup slot that stores its contents as a diff against a keyframe.
+    ///
+    /// The default implementation allocates a regular backup slot.
+    fn create_delta_slot(&self) -> Result<Self::Slot, Error> {
+        self.create_backup_slot()
+    }
+
+    /// Compress a backup slot to reduce its memory usage, returning false if the slot can't
+    /// be compressed.
+    ///
+    /// A compressed slot can't be read from or written to, but can still be used as the
+    /// source of `copy_slot`. Copying into a compressed slot decompresses it.
+    ///
+    /// The default implementation doesn't support compression.
+    fn compress_slot(&self, _slot: &mut Self::Slot) -> Result<bool, Error> {
+        Ok(false)
+    }
+
+    /// Return the number of bytes currently allocated for backup slots.
+    fn backup_slot_bytes(&self) -> usize;
+
+    /// Return the total number of bytes that slot copies have covered, i.e. the bytes they
+    /// would have moved without skipping unchanged pages.
+    ///
+    /// The default implementation doesn't track copies and returns 0.
+    fn num_bytes_requested(&self) -> usize {
+        0
+    }
+
+    /// Return the total number of bytes that slot copies have moved, for measuring the cost
+    /// of copies.
+    ///
+    /// The default implementation doesn't track copies and returns 0.
+    fn num_bytes_copied(&self) -> usize {
+        0
+    }
+
     /// Copy the contents of one slot into another.
     fn copy_slot(&self, dst: &mut Self::Slot, src: &Self::Slot) -> Result<(), Error>;
 
+    /// Copy the contents of one slot into another, sharing storage with `keyframe` where
+    /// their contents match.
+    ///
+    /// Sharing only happens when `dst` and `keyframe` were both created using
+    /// `create_delta_slot`. The default implementation ignores `keyframe`.
+    fn copy_slot_delta(
+        &self,
+        dst: &mut Self::Slot,
+        src: &Self::Slot,
+        _keyframe: Option<&Self::Slot>,
+    ) -> Result<(), Error> {
+        self.copy_slot(dst, src)
+    }
+
+    /// Return the contents of a slot as bytes, for use with `load_slot_data`.
+    ///
+    /// The data can also be loaded into another instance of the same program, possibly
+    /// loaded at a different address.
+    fn slot_data(&self, slot: &Self::Slot) -> Result<Vec<u8>, Error>;
+
+    /// Overwrite the contents of a slot using bytes returned by `slot_data`.
+    ///
+    /// If the data was taken from an instance of the program at a different address, the
+    /// pointers in it are relocated on a best effort basis, so the result should only be
+    /// trusted once relocation from that instance is known to work.
+    fn load_slot_data(&self, slot: &mut Self::Slot, data: &[u8]) -> Result<(), Error>;
+
+    /// Return the base address of the program instance that `data` was taken from using
+    /// `slot_data`.
+    fn slot_data_address(&self, data: &[u8]) -> Result<Address, Error>;
+
+    /// Return the address that the program is loaded at.
+    ///
+    /// Slot data from an instance at the same address can be loaded without relocation.
+    fn base_address(&self) -> Address;
+
+    /// Return a hash of the contents of a slot.
+    ///
+    /// Slots with equal contents have equal fingerprints.
+    fn slot_fingerprint(&self, slot: &Self::Slot) -> Result<u64, Error>;
+
     /// Advance a base slot one frame.
     fn advance_base_slot(&self, base_slot: &mut Self::Slot) -> Result<(), Error>;
 }
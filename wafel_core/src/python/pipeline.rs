@@ -13,15 +13,34 @@ use crate::{
     sm64::trace_ray_to_surface,
     sm64::{
         frame_log, load_dll_pipeline, object_behavior, object_path, read_surfaces_to_scene,
-        ObjectSlot, Pipeline,
+        ObjectSlot, Pipeline, Variable, WorkerPool,
     },
-    timeline::{SlotState, State},
+    timeline::{EvictionPolicy, SlotState, SlotStorage, State},
 };
 use lazy_static::lazy_static;
 use pyo3::{prelude::*, types::PyBytes};
-use std::{collections::HashMap, sync::Mutex};
+use std::{cell::RefCell, collections::HashMap, mem, sync::Mutex};
+use winapi::um::sysinfoapi::{GlobalMemoryStatusEx, MEMORYSTATUSEX};
 
-const NUM_BACKUP_SLOTS: usize = 30;
+/// The fraction of physical memory that backup slots may use by default.
+const DEFAULT_SLOT_MEMORY_FRACTION: f64 = 0.25;
+
+/// The fraction of currently available memory that backup slots may use by default.
+const DEFAULT_SLOT_MEMORY_AVAILABLE_FRACTION: f64 = 0.5;
+
+/// The fraction of physical memory that is kept available by freeing backup slots when the
+/// system runs low on memory.
+const RESERVED_MEMORY_FRACTION: f64 = 0.1;
+
+/// Backup slots share unchanged pages with a keyframe, so most of them only cost a fraction of
+/// a full copy.
+const BACKUP_SLOT_STORAGE: SlotStorage = SlotStorage::Delta {
+    keyframe_interval: 400,
+};
+
+/// Ranges shorter than this are read on the main pipeline, since splitting them between
+/// workers costs more than it saves.
+const MIN_PARALLEL_READ_FRAMES: u32 = 1000;
 
 lazy_static! {
     static ref VALID_PIPELINES: Mutex<Vec<Py<PyPipeline>>> = Mutex::new(Vec::new());
@@ -41,10 +60,14 @@ pub struct PyPipeline {
 struct ValidPipeline {
     pipeline: Pipeline<dll::Memory>,
     symbols_by_address: HashMap<Address, String>,
+    dll_path: String,
+    worker_count: usize,
+    /// The worker pool, which is started on the first long range read.
+    workers: RefCell<Option<WorkerPool>>,
 }
 
 impl PyPipeline {
-    fn new(pipeline: Pipeline<dll::Memory>) -> PyResult<Self> {
+    fn new(pipeline: Pipeline<dll::Memory>, dll_path: &str, worker_count: usize) -> PyResult<Self> {
         let memory = pipeline.timeline().memory();
         let symbols_by_address = memory
             .all_symbol_address()
@@ -56,6 +79,9 @@ impl PyPipeline {
             valid: Some(ValidPipeline {
                 pipeline,
                 symbols_by_address,
+                dll_path: dll_path.to_owned(),
+                worker_count,
+                workers: RefCell::new(None),
             }),
         })
     }
@@ -80,12 +106,33 @@ impl PyPipeline {
     /// To help ensure DLL safety and avoid memory leaks, this method also invalidates
     /// all existing pipelines that were created using this method.
     ///
+    /// Backup slots are allocated within `slot_memory_budget` bytes. If it is not given,
+    /// the budget is based on the system's physical and available memory.
+    ///
+    /// If `archive_directory` is given, snapshots are saved there so that later sessions
+    /// don't need to simulate from the start.
+    ///
+    /// If `worker_count` is nonzero, that many private copies of the DLL are loaded on
+    /// background threads the first time a long frame range is read, and used to read long
+    /// ranges in parallel. Workers don't use any of the slot memory budget.
+    ///
     /// # Safety
     ///
     /// See `dll::Memory::load`. As long as the DLL is only loaded via this method,
     /// this method is safe.
     #[staticmethod]
-    pub unsafe fn load(py: Python<'_>, dll_path: &str) -> PyResult<Py<Self>> {
+    #[args(
+        slot_memory_budget = "None",
+        archive_directory = "None",
+        worker_count = "0"
+    )]
+    pub unsafe fn load(
+        py: Python<'_>,
+        dll_path: &str,
+        slot_memory_budget: Option<usize>,
+        archive_directory: Option<&str>,
+        worker_count: usize,
+    ) -> PyResult<Py<Self>> {
         let mut valid_pipelines = VALID_PIPELINES.lock().unwrap();
 
         // Drop all known existing dll::Memory instances for safety
@@ -93,8 +140,15 @@ impl PyPipeline {
             pipeline_py.borrow_mut(py).invalidate();
         }
 
-        let pipeline = load_dll_pipeline(dll_path, NUM_BACKUP_SLOTS)?;
-        let pipeline_py = Py::new(py, PyPipeline::new(pipeline)?)?;
+        let slot_memory_budget = slot_memory_budget.unwrap_or_else(default_slot_memory_budget);
+
+        let pipeline = load_dll_pipeline(
+            dll_path,
+            slot_memory_budget,
+            BACKUP_SLOT_STORAGE,
+            archive_directory,
+        )?;
+        let pipeline_py = Py::new(py, PyPipeline::new(pipeline, dll_path, worker_count)?)?;
 
         valid_pipelines.push(pipeline_py.clone());
 
@@ -109,10 +163,18 @@ impl PyPipeline {
     ///
     /// See `PyPipeline::load`.
     #[staticmethod]
+    #[args(
+        slot_memory_budget = "None",
+        archive_directory = "None",
+        worker_count = "0"
+    )]
     pub unsafe fn load_reusing_edits(
         py: Python<'_>,
         dll_path: &str,
         prev_pipeline: Py<PyPipeline>,
+        slot_memory_budget: Option<usize>,
+        archive_directory: Option<&str>,
+        worker_count: usize,
     ) -> PyResult<Py<Self>> {
         let edits = prev_pipeline
             .borrow_mut(py)
@@ -121,7 +183,13 @@ impl PyPipeline {
             .pipeline
             .into_edits()?;
 
-        let py_pipeline = Self::load(py, dll_path)?;
+        let py_pipeline = Self::load(
+            py,
+            dll_path,
+            slot_memory_budget,
+            archive_directory,
+            worker_count,
+        )?;
         py_pipeline
             .borrow_mut(py)
             .get_mut()
@@ -151,6 +219,60 @@ impl PyPipeline {
         Ok(py_object)
     }
 
+    /// Read variables on every frame in `frame_start..frame_end`.
+    ///
+    /// Returns a list of values for each variable. This is faster than reading the values
+    /// one at a time. Long ranges are split between workers if the pipeline has any, and
+    /// are read on this pipeline alone if the workers fail.
+    pub fn read_range(
+        &self,
+        py: Python<'_>,
+        variables: Vec<PyVariable>,
+        frame_start: u32,
+        frame_end: u32,
+    ) -> PyResult<Vec<Vec<PyObject>>> {
+        let variables: Vec<Variable> = variables
+            .into_iter()
+            .map(|variable| variable.variable)
+            .collect();
+        let valid = self.get();
+        let frames = frame_start..frame_end;
+        let columns = if valid.worker_count > 0
+            && frame_end.saturating_sub(frame_start) >= MIN_PARALLEL_READ_FRAMES
+        {
+            let mut workers = valid.workers.borrow_mut();
+            if workers.is_none() {
+                let power_on_data = valid.pipeline.timeline().power_on_data()?;
+                // Safety: the DLL was already loaded by `load`, and workers load private
+                // copies of it
+                *workers = Some(unsafe {
+                    WorkerPool::new(
+                        &valid.dll_path,
+                        valid.worker_count,
+                        BACKUP_SLOT_STORAGE,
+                        power_on_data,
+                    )
+                });
+            }
+            workers
+                .as_ref()
+                .unwrap()
+                .read_range(&valid.pipeline, &variables, frames)?
+        } else {
+            valid.pipeline.read_range(&variables, frames)?
+        };
+
+        let mut py_columns = Vec::new();
+        for column in columns {
+            let py_column = column
+                .iter()
+                .map(|value| value_to_py_object(py, value))
+                .collect::<PyResult<Vec<PyObject>>>()?;
+            py_columns.push(py_column);
+        }
+        Ok(py_columns)
+    }
+
     /// Write a variable.
     ///
     /// If the variable is a data variable, the value will be truncated and written
@@ -166,6 +288,22 @@ impl PyPipeline {
         Ok(())
     }
 
+    /// Write several variables at once, given as (variable, value) pairs.
+    ///
+    /// This is faster than calling `write` for each variable.
+    pub fn write_all(
+        &mut self,
+        py: Python<'_>,
+        writes: Vec<(PyVariable, PyObject)>,
+    ) -> PyResult<()> {
+        let writes = writes
+            .into_iter()
+            .map(|(variable, value)| Ok((variable.variable, py_object_to_value(py, &value)?)))
+            .collect::<PyResult<Vec<(Variable, Value)>>>()?;
+        self.get_mut().pipeline.write_all(&writes)?;
+        Ok(())
+    }
+
     /// Reset a variable.
     pub fn reset(&mut self, variable: &PyVariable) -> PyResult<()> {
         self.get_mut().pipeline.reset(&variable.variable)?;
@@ -240,15 +378,95 @@ impl PyPipeline {
             .set_hotspot(name, frame);
     }
 
+    /// Set a hotspot covering the frames `frame_start..frame_end`, allowing for faster
+    /// scrolling within them.
+    ///
+    /// Slots are divided between hotspots in proportion to their weights.
+    #[args(weight = "1.0")]
+    pub fn set_hotspot_range(&mut self, name: &str, frame_start: u32, frame_end: u32, weight: f32) {
+        self.get_mut().pipeline.timeline_mut().set_hotspot_range(
+            name,
+            frame_start..frame_end,
+            weight,
+        );
+    }
+
+    /// Delete a hotspot, if it exists.
+    pub fn delete_hotspot(&mut self, name: &str) {
+        self.get_mut().pipeline.timeline_mut().delete_hotspot(name);
+    }
+
+    /// Set the number of frames around a data cache miss that are loaded along with it.
+    pub fn set_preload_window(&mut self, frames_before: u32, frames_after: u32) {
+        self.get_mut()
+            .pipeline
+            .timeline_mut()
+            .set_preload_window(frames_before, frames_after);
+    }
+
+    /// Set the playback speed, allowing for faster playback in the given direction.
+    pub fn set_play_speed(&mut self, play_speed: f32) {
+        self.get_mut()
+            .pipeline
+            .timeline_mut()
+            .set_play_speed(play_speed);
+    }
+
     /// Perform housekeeping to improve scrolling near hotspots.
-    pub fn balance_distribution(&mut self, max_run_time_seconds: f32) -> PyResult<()> {
+    ///
+    /// No new work is started after `max_run_time_seconds`, so this can be given the slack
+    /// remaining in the current UI frame.
+    ///
+    /// Backup slots are freed first if the system is running low on available memory.
+    ///
+    /// Returns the number of slots placed, target frames left without a slot, slots
+    /// compressed, frame advances, and slot copies.
+    pub fn balance_distribution(
+        &mut self,
+        max_run_time_seconds: f32,
+    ) -> PyResult<(usize, usize, usize, usize, usize)> {
+        let timeline = self.get_mut().pipeline.timeline_mut();
+        if let Some((total, available)) = physical_memory() {
+            let reserve = (total as f64 * RESERVED_MEMORY_FRACTION) as usize;
+            timeline.reserve_memory(available, reserve);
+        }
+        let stats = timeline.balance_distribution(std::time::Duration::from_secs_f32(
+            max_run_time_seconds.max(0.0),
+        ))?;
+        Ok((
+            stats.slots_placed,
+            stats.slots_unplaced,
+            stats.slots_compressed,
+            stats.advances,
+            stats.copies,
+        ))
+    }
+
+    /// Recreate checkpoints that were invalidated by the last edits.
+    ///
+    /// At most `max_run_time_seconds` is spent per call, so this can be called once per UI
+    /// frame until `refill_progress` returns None.
+    pub fn refill(&mut self, max_run_time_seconds: f32) -> PyResult<()> {
         self.get_mut()
             .pipeline
             .timeline_mut()
-            .balance_distribution(std::time::Duration::from_secs_f32(max_run_time_seconds))?;
+            .refill(std::time::Duration::from_secs_f32(
+                max_run_time_seconds.max(0.0),
+            ))?;
         Ok(())
     }
 
+    /// Return the fraction of the current refill that is complete, or None if no refill is
+    /// in progress.
+    pub fn refill_progress(&self) -> Option<f32> {
+        self.get().pipeline.timeline().refill_progress()
+    }
+
+    /// Stop recreating invalidated checkpoints until the next edit.
+    pub fn cancel_refill(&mut self) {
+        self.get_mut().pipeline.timeline_mut().cancel_refill();
+    }
+
     /// Return the set of currently loaded frames for debugging purposes.
     pub fn cached_frames(&self) -> Vec<u32> {
         self.get().pipeline.timeline().cached_frames()
@@ -264,11 +482,117 @@ impl PyPipeline {
         self.get().pipeline.timeline().num_copies()
     }
 
+    /// Return the number of bytes that slot copies have covered, the number of bytes they
+    /// compared to check whether the update function changed them, and the number of bytes
+    /// they actually moved after skipping unchanged pages.
+    pub fn bytes_copied(&self) -> (usize, usize, usize) {
+        self.get().pipeline.timeline().memory().bytes_copied()
+    }
+
+    /// Start recording frame requests for `compare_eviction_policies`.
+    pub fn start_request_trace(&mut self) {
+        self.get_mut().pipeline.timeline_mut().start_request_trace();
+    }
+
+    /// Stop recording frame requests, and replay them under each slot eviction policy with
+    /// `num_slots` backup slots.
+    ///
+    /// Returns the policy name, the number of frame advances and slot copies, and the
+    /// estimated time in seconds for each policy.
+    pub fn compare_eviction_policies(
+        &mut self,
+        num_slots: usize,
+    ) -> Vec<(String, usize, usize, f64)> {
+        let timeline = self.get_mut().pipeline.timeline_mut();
+        let trace = timeline.take_request_trace();
+        EvictionPolicy::ALL
+            .iter()
+            .map(|&policy| {
+                let cost = timeline.replay_request_trace(&trace, num_slots, policy);
+                (policy.to_string(), cost.advances, cost.copies, cost.time)
+            })
+            .collect()
+    }
+
+    /// Return the number and total duration in seconds of full slot copies since the last
+    /// call, followed by the same for partial copies that skipped up to date pages.
+    pub fn take_copy_timing(&self) -> (usize, f64, usize, f64) {
+        let timing = self.get().pipeline.timeline().memory().take_copy_timing();
+        (
+            timing.full_copies,
+            timing.full_copy_time.as_secs_f64(),
+            timing.partial_copies,
+            timing.partial_copy_time.as_secs_f64(),
+        )
+    }
+
+    /// Return the number of frame requests since the last call, the total number of bytes
+    /// that slot copies covered to serve them, and the total and largest number of bytes
+    /// that slot copies moved to serve a request.
+    ///
+    /// Without skipping unchanged pages, the bytes moved would equal the bytes covered.
+    pub fn take_request_stats(&self) -> (usize, usize, usize, usize) {
+        let stats = self.get().pipeline.timeline().take_request_stats();
+        (
+            stats.requests,
+            stats.bytes_requested,
+            stats.bytes_copied,
+            stats.max_bytes_copied,
+        )
+    }
+
+    /// Return messages for the errors that occurred in the background since the last call.
+    ///
+    /// These come from writing to the slot archive and from range read workers. Neither
+    /// affects the results of other methods, since failed work is redone on the pipeline.
+    pub fn take_background_errors(&self) -> Vec<String> {
+        let valid = self.get();
+        let archive_errors = valid.pipeline.timeline().take_archive_errors();
+        let worker_errors = valid
+            .workers
+            .borrow()
+            .as_ref()
+            .map_or_else(Vec::new, |workers| workers.take_errors());
+
+        let archive_messages = archive_errors
+            .into_iter()
+            .map(|error| format!("Slot archive error: {}", error));
+        let worker_messages = worker_errors
+            .into_iter()
+            .map(|error| format!("Range read worker error: {}", error));
+        archive_messages.chain(worker_messages).collect()
+    }
+
+    /// Return the ratio between the size that backup slots would have without page sharing
+    /// or compression, and the memory they actually use.
+    pub fn dedup_ratio(&self) -> f64 {
+        self.get().pipeline.timeline().memory().dedup_ratio()
+    }
+
+    /// Return the measured time in seconds of a slot copy and of a frame advance.
+    pub fn cost_weights(&self) -> (f64, f64) {
+        self.get().pipeline.timeline().cost_weights()
+    }
+
     /// Return the size of the data cache in bytes.
     pub fn data_cache_size(&self) -> usize {
         self.get().pipeline.timeline().data_size_cache()
     }
 
+    /// Set the maximum size of the data cache in bytes.
+    pub fn set_data_cache_budget(&mut self, byte_budget: usize) {
+        self.get_mut()
+            .pipeline
+            .timeline_mut()
+            .set_data_cache_budget(byte_budget);
+    }
+
+    /// Return the number of data cache hits, misses, and evicted values.
+    pub fn data_cache_stats(&self) -> (usize, usize, usize) {
+        let stats = self.get().pipeline.timeline().data_cache_stats();
+        (stats.hits, stats.misses, stats.evictions)
+    }
+
     /// Return the label for the variable if it has one.
     pub fn label(&self, variable: &PyVariable) -> PyResult<Option<&str>> {
         let label = self
@@ -452,9 +776,11 @@ impl PyPipeline {
         let timeline = self.get().pipeline.timeline();
         let pos_path = timeline.memory().global_path("gMarioState->pos")?;
 
+        let positions = timeline.read_range(&[pos_path], frame_start..frame_end)?;
+
         let mut nodes = Vec::new();
-        for frame in frame_start..frame_end {
-            let pos_coords = timeline.frame(frame)?.path_read(&pos_path)?.as_f32_3()?;
+        for pos in &positions[0] {
+            let pos_coords = pos.as_f32_3()?;
             nodes.push(scene::ObjectPathNode {
                 pos: Point3f::from_slice(&pos_coords).into(),
                 quarter_steps: Vec::new(),
@@ -467,3 +793,28 @@ impl PyPipeline {
         })
     }
 }
+
+/// Return a backup slot budget that leaves headroom for the rest of the system.
+///
+/// This is the smaller of a fraction of physical memory and a fraction of the memory that is
+/// currently available, so that the budget shrinks on machines that are already under load.
+fn default_slot_memory_budget() -> usize {
+    match physical_memory() {
+        Some((total, available)) => {
+            let total = total as f64 * DEFAULT_SLOT_MEMORY_FRACTION;
+            let available = available as f64 * DEFAULT_SLOT_MEMORY_AVAILABLE_FRACTION;
+            total.min(available) as usize
+        }
+        None => 1024 * 1024 * 1024,
+    }
+}
+
+/// Return the total and currently available physical memory of the system in bytes.
+fn physical_memory() -> Option<(usize, usize)> {
+    let mut status: MEMORYSTATUSEX = unsafe { mem::zeroed() };
+    status.dwLength = mem::size_of::<MEMORYSTATUSEX>() as u32;
+    if unsafe { GlobalMemoryStatusEx(&mut status) } == 0 {
+        return None;
+    }
+    Some((status.ullTotalPhys as usize, status.ullAvailPhys as usize))
+}
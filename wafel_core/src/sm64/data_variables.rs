@@ -166,16 +166,37 @@ impl DataVariables {
         let path = self.path(state, variable)?;
         match path {
             Some(path) => {
-                let mut value = state.path_read(&path)?;
+                let value = state.path_read(&path)?;
+                self.apply_flag(spec, value)
+            }
+            None => Ok(Value::Null),
+        }
+    }
 
-                if let Some(flag) = spec.flag {
-                    let flag_set = (value.as_int()? & flag) != 0;
-                    value = Value::Int(flag_set as IntValue);
-                }
+    /// Get the path for the given variable if it doesn't depend on the state.
+    ///
+    /// Returns None for object and surface variables.
+    pub fn global_path(&self, variable: &Variable) -> Result<Option<&GlobalDataPath>, Error> {
+        let spec = self.variable_spec(&variable.name)?;
+        match &spec.path {
+            Path::Global(path) => Ok(Some(path)),
+            Path::Object(_) | Path::Surface(_) => Ok(None),
+        }
+    }
 
-                Ok(value)
+    /// Convert a value read from the variable's path into the variable's value.
+    pub fn variable_value(&self, variable: &Variable, path_value: Value) -> Result<Value, Error> {
+        let spec = self.variable_spec(&variable.name)?;
+        self.apply_flag(spec, path_value)
+    }
+
+    fn apply_flag(&self, spec: &DataVariableSpec, value: Value) -> Result<Value, Error> {
+        match spec.flag {
+            Some(flag) => {
+                let flag_set = (value.as_int()? & flag) != 0;
+                Ok(Value::Int(flag_set as IntValue))
             }
-            None => Ok(Value::Null),
+            None => Ok(value),
         }
     }
 
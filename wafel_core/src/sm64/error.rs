@@ -36,6 +36,10 @@ pub enum SM64ErrorCause {
     UnsizedSurfacePoolPointer,
     #[display(fmt = "object pool array does not have a stride")]
     UnsizedObjectPoolArray,
+    #[display(fmt = "worker thread stopped unexpectedly")]
+    WorkerFailed,
+    #[display(fmt = "game state can't be relocated into a worker's copy of the DLL")]
+    WorkerRelocationFailed,
 }
 
 #[derive(Debug, Display, Error, From)]
@@ -6,6 +6,7 @@ pub use pipeline::*;
 pub use range_edit::*;
 pub use util::*;
 pub use variable::*;
+pub use worker_pool::*;
 
 mod data_variables;
 mod error;
@@ -15,3 +16,4 @@ mod pipeline;
 mod range_edit;
 mod util;
 mod variable;
+mod worker_pool;
@@ -4,10 +4,19 @@ use super::{
     EditRange, RangeEdits, Variable,
 };
 use crate::{
+    data_path::GlobalDataPath,
     dll,
     error::Error,
     memory::{Memory, Value},
-    timeline::{Controller, InvalidatedFrames, SlotStateMut, Timeline},
+    timeline::{
+        Controller, InvalidatedFrames, SlotArchive, SlotStateMut, SlotStorage, StableHasher,
+        Timeline,
+    },
+};
+use std::{
+    fs,
+    hash::{Hash, Hasher},
+    ops::Range,
 };
 
 /// SM64 controller implementation.
@@ -34,6 +43,10 @@ impl<M: Memory> Controller<M> for SM64Controller {
         }
         Ok(())
     }
+
+    fn edits_hash(&self, frame: u32) -> Option<u64> {
+        Some(self.edits.hash_up_to(frame))
+    }
 }
 
 /// An abstraction for reading and writing variables.
@@ -65,12 +78,76 @@ impl<M: Memory> Pipeline<M> {
         })
     }
 
+    /// Get the current edits.
+    pub fn edits(&self) -> &RangeEdits {
+        &self.timeline.controller().edits
+    }
+
     /// Read a variable.
     pub fn read(&self, variable: &Variable) -> Result<Value, Error> {
         let state = self.timeline.frame(variable.try_frame()?)?;
         self.data_variables().get(&state, &variable.without_frame())
     }
 
+    /// Read the given variables on every frame in `frames`, returning one column of values
+    /// per variable.
+    ///
+    /// This is faster than reading each value separately, since frames that aren't cached
+    /// are only loaded once.
+    pub fn read_range(
+        &self,
+        variables: &[Variable],
+        frames: Range<u32>,
+    ) -> Result<Vec<Vec<Value>>, Error> {
+        self.read_range_with(variables, frames, |_, paths, frames| {
+            self.timeline.read_range(paths, frames)
+        })
+    }
+
+    /// Like `read_range`, but using `read_paths` to read the global data paths.
+    ///
+    /// `read_paths` is given the variables that have global paths along with their paths,
+    /// and should return one column of path values per path.
+    pub(super) fn read_range_with(
+        &self,
+        variables: &[Variable],
+        frames: Range<u32>,
+        read_paths: impl FnOnce(
+            &[Variable],
+            &[GlobalDataPath],
+            Range<u32>,
+        ) -> Result<Vec<Vec<Value>>, Error>,
+    ) -> Result<Vec<Vec<Value>>, Error> {
+        let data_variables = self.data_variables();
+
+        let mut path_variables = Vec::new();
+        let mut paths = Vec::new();
+        for variable in variables {
+            if let Some(path) = data_variables.global_path(variable)? {
+                path_variables.push(variable.clone());
+                paths.push(path.clone());
+            }
+        }
+        let mut path_columns = read_paths(&path_variables, &paths, frames.clone())?.into_iter();
+
+        variables
+            .iter()
+            .map(|variable| match data_variables.global_path(variable)? {
+                Some(_) => path_columns
+                    .next()
+                    .expect("missing path column")
+                    .into_iter()
+                    .map(|value| data_variables.variable_value(variable, value))
+                    .collect(),
+                // Object and surface paths depend on the state, so read them individually
+                None => frames
+                    .clone()
+                    .map(|frame| self.read(&variable.with_frame(frame)))
+                    .collect(),
+            })
+            .collect()
+    }
+
     /// Write a variable.
     pub fn write(&mut self, variable: &Variable, value: &Value) -> Result<(), Error> {
         let column = variable.without_frame();
@@ -81,6 +158,26 @@ impl<M: Memory> Pipeline<M> {
         Ok(())
     }
 
+    /// Write several variables at once.
+    ///
+    /// This is faster than writing them one at a time, since the timeline only processes
+    /// the combined edit.
+    pub fn write_all(&mut self, writes: &[(Variable, Value)]) -> Result<(), Error> {
+        let writes = writes
+            .iter()
+            .map(|(variable, value)| Ok((variable.without_frame(), variable.try_frame()?, value)))
+            .collect::<Result<Vec<_>, Error>>()?;
+        self.timeline.with_controller_mut(|controller| {
+            let mut invalidated = InvalidatedFrames::None;
+            for (column, frame, value) in writes {
+                invalidated =
+                    invalidated.union(controller.edits.write(&column, frame, value.clone()));
+            }
+            invalidated
+        });
+        Ok(())
+    }
+
     /// Reset a variable.
     pub fn reset(&mut self, variable: &Variable) -> Result<(), Error> {
         let column = variable.without_frame();
@@ -159,15 +256,60 @@ impl<M: Memory> Pipeline<M> {
 
 /// Build a Pipeline using the dll path.
 ///
+/// If `archive_directory` is given, snapshots of the simulation are saved there and reused
+/// by later pipelines for the same DLL.
+///
 /// # Safety
 ///
 /// See `dll::Memory::load`.
 pub unsafe fn load_dll_pipeline(
     dll_path: &str,
-    num_backup_slots: usize,
+    slot_memory_budget: usize,
+    storage: SlotStorage,
+    archive_directory: Option<&str>,
 ) -> Result<Pipeline<dll::Memory>, Error> {
-    let (mut memory, base_slot) = dll::Memory::load(dll_path, "sm64_init", "sm64_update")?;
+    let (memory, base_slot) = dll::Memory::load(dll_path, "sm64_init", "sm64_update")?;
+    let mut pipeline = build_dll_pipeline(memory, base_slot, slot_memory_budget, storage)?;
+
+    if let Some(archive_directory) = archive_directory {
+        // Archived slots are only valid for the same DLL contents. Pointers into the DLL are
+        // stored relative to its base address, and snapshots taken at a different address are
+        // used if that instance's archived power-on state relocates correctly.
+        let dll_contents = fs::read(dll_path).map_err(dll::DllErrorCause::from)?;
+        let mut hasher = StableHasher::new();
+        dll_contents.hash(&mut hasher);
+
+        let archive = SlotArchive::open(archive_directory, hasher.finish())
+            .map_err(dll::DllErrorCause::from)?;
+        pipeline.timeline.set_archive(archive)?;
+    }
 
+    Ok(pipeline)
+}
+
+/// Build a Pipeline using a private copy of the DLL.
+///
+/// Unlike `load_dll_pipeline`, this can be called multiple times for the same DLL, for
+/// example to simulate on several threads. See `dll::Memory::load_instance`.
+///
+/// # Safety
+///
+/// See `dll::Memory::load_instance`.
+pub unsafe fn load_dll_pipeline_instance(
+    dll_path: &str,
+    slot_memory_budget: usize,
+    storage: SlotStorage,
+) -> Result<Pipeline<dll::Memory>, Error> {
+    let (memory, base_slot) = dll::Memory::load_instance(dll_path, "sm64_init", "sm64_update")?;
+    build_dll_pipeline(memory, base_slot, slot_memory_budget, storage)
+}
+
+fn build_dll_pipeline(
+    mut memory: dll::Memory,
+    base_slot: dll::Slot,
+    slot_memory_budget: usize,
+    storage: SlotStorage,
+) -> Result<Pipeline<dll::Memory>, Error> {
     load_object_fields(
         memory.data_layout_mut(),
         include_bytes!("../../assets/object_fields.json"),
@@ -179,8 +321,7 @@ pub unsafe fn load_dll_pipeline(
 
     let data_variables = DataVariables::all(&memory)?;
     let controller = SM64Controller::new(data_variables);
-    let timeline = Timeline::new(memory, base_slot, controller, num_backup_slots)?;
-    let pipeline = Pipeline::new(timeline);
+    let timeline = Timeline::new(memory, base_slot, controller, slot_memory_budget, storage)?;
 
-    Ok(pipeline)
+    Ok(Pipeline::new(timeline))
 }
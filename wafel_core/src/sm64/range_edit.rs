@@ -1,11 +1,17 @@
 //! Implementation of range editing (drag and drop in the frame sheet).
 
 use super::Variable;
-use crate::{memory::Value, timeline::InvalidatedFrames};
+use crate::{
+    memory::Value,
+    timeline::{InvalidatedFrames, StableHasher},
+};
+use itertools::Itertools;
 use std::{
+    cell::RefCell,
     cmp::Ordering,
     collections::{HashMap, HashSet},
-    hash::Hash,
+    hash::{Hash, Hasher},
+    mem,
     ops::Range,
 };
 
@@ -25,11 +31,14 @@ pub struct EditRange {
 }
 
 /// Manages all of the active edit ranges.
-#[derive(Debug, Default)]
+#[derive(Debug, Clone, Default)]
 pub struct RangeEdits {
     ranges: HashMap<Variable, Ranges>,
     drag_state: Option<DragState>,
     next_range_id: usize,
+    /// Hashes returned by `hash_up_to`, along with the hash of all edits that they were
+    /// computed for.
+    prefix_hashes: RefCell<(u64, HashMap<u32, u64>)>,
 }
 
 impl RangeEdits {
@@ -57,8 +66,10 @@ impl RangeEdits {
     pub fn write(&mut self, column: &Variable, frame: u32, value: Value) -> InvalidatedFrames {
         let invalidated = self.rollback_drag();
 
-        let ranges = self.ranges.entry(column.without_frame()).or_default();
+        let column = column.without_frame();
+        let ranges = self.ranges.entry(column.clone()).or_default();
         invalidated.union(ranges.set_value_or_create_range(
+            &column,
             frame,
             value,
             range_id_generator(&mut self.next_range_id),
@@ -74,7 +85,8 @@ impl RangeEdits {
                 let range = range.clone();
                 let mut invalidated = self.rollback_drag();
 
-                let ranges = self.ranges.entry(column.without_frame()).or_default();
+                let column = column.without_frame();
+                let ranges = self.ranges.entry(column.clone()).or_default();
 
                 // Simulate a reset by dragging the cell up or down.
                 let mut preview = RangeEditPreview::new(
@@ -83,7 +95,7 @@ impl RangeEdits {
                     range_id_generator(&mut self.next_range_id),
                 );
                 invalidated = invalidated.union(preview.reset_source(ranges));
-                preview.commit(ranges);
+                preview.commit(&column, ranges);
 
                 invalidated
             }
@@ -94,8 +106,8 @@ impl RangeEdits {
     /// Insert a frame, shifting all lower rows downward.
     pub fn insert_frame(&mut self, frame: u32) -> InvalidatedFrames {
         let invalidated = self.rollback_drag();
-        for range in self.ranges.values_mut() {
-            range.insert(frame, 1);
+        for (column, range) in self.ranges.iter_mut() {
+            range.insert(column, frame, 1);
         }
         invalidated.union(InvalidatedFrames::StartingAt(frame))
     }
@@ -103,8 +115,8 @@ impl RangeEdits {
     /// Delete a frame, shifting all lower frames upward.
     pub fn delete_frame(&mut self, frame: u32) -> InvalidatedFrames {
         let invalidated = self.rollback_drag();
-        for range in self.ranges.values_mut() {
-            range.remove(frame, 1);
+        for (column, range) in self.ranges.iter_mut() {
+            range.remove(column, frame, 1);
         }
         invalidated.union(InvalidatedFrames::StartingAt(frame))
     }
@@ -159,12 +171,69 @@ impl RangeEdits {
     /// End the drag operation, committing range changes.
     pub fn release_drag(&mut self) -> InvalidatedFrames {
         if let Some(DragState { column, preview }) = self.drag_state.take() {
-            let ranges = self.ranges.entry(column.without_frame()).or_default();
-            preview.commit(ranges);
+            let ranges = self.ranges.entry(column.clone()).or_default();
+            preview.commit(&column, ranges);
         }
         InvalidatedFrames::None
     }
 
+    /// Return a hash of the edits on frames up to and including `frame`.
+    ///
+    /// If a drag is in progress, the hash includes the previewed ranges. The hash is stable
+    /// between sessions, so it can be used to key archived slots.
+    ///
+    /// The hash of all edits (`frame = u32::MAX`) is kept up to date as ranges change, so it
+    /// takes time proportional to the number of edited columns. Other hashes are cached
+    /// until the edits change.
+    pub fn hash_up_to(&self, frame: u32) -> u64 {
+        let edits_hash = self.hash_all();
+        if frame == u32::MAX {
+            return edits_hash;
+        }
+
+        let mut prefix_hashes = self.prefix_hashes.borrow_mut();
+        if prefix_hashes.0 != edits_hash {
+            *prefix_hashes = (edits_hash, HashMap::new());
+        }
+        *prefix_hashes
+            .1
+            .entry(frame)
+            .or_insert_with(|| self.compute_hash_up_to(frame))
+    }
+
+    fn hash_all(&self) -> u64 {
+        let mut sum = 0u64;
+        for (column, ranges) in &self.ranges {
+            sum = sum.wrapping_add(ranges.hash);
+            if let Some(drag_state) = &self.drag_state {
+                if &drag_state.column == column {
+                    sum = sum.wrapping_add(drag_state.preview.hash_change(column, ranges));
+                }
+            }
+        }
+        finish_hash(sum)
+    }
+
+    fn compute_hash_up_to(&self, frame: u32) -> u64 {
+        let mut sum = 0u64;
+        for (column, ranges) in &self.ranges {
+            let column_ranges: Vec<&EditRange> = match &self.drag_state {
+                Some(drag_state) if &drag_state.column == column => {
+                    drag_state.preview.ranges(ranges).collect()
+                }
+                _ => ranges.ranges.values().collect(),
+            };
+            for range in column_ranges {
+                if !range.frames.is_empty() && range.frames.start <= frame {
+                    let end = range.frames.end.min(frame.saturating_add(1));
+                    sum =
+                        sum.wrapping_add(range_hash(column, range.frames.start..end, &range.value));
+                }
+            }
+        }
+        finish_hash(sum)
+    }
+
     fn rollback_drag(&mut self) -> InvalidatedFrames {
         if let Some(DragState { preview, .. }) = self.drag_state.take() {
             preview.rollback()
@@ -174,6 +243,46 @@ impl RangeEdits {
     }
 }
 
+/// The hash of a single edit range, which is summed over ranges so that it can be updated
+/// one range at a time.
+fn range_hash(column: &Variable, frames: Range<u32>, value: &Value) -> u64 {
+    let mut hasher = StableHasher::new();
+    column.hash(&mut hasher);
+    frames.start.hash(&mut hasher);
+    frames.end.hash(&mut hasher);
+    hash_value(value, &mut hasher);
+    hasher.finish()
+}
+
+fn finish_hash(range_hash_sum: u64) -> u64 {
+    let mut hasher = StableHasher::new();
+    range_hash_sum.hash(&mut hasher);
+    hasher.finish()
+}
+
+fn hash_value(value: &Value, state: &mut impl Hasher) {
+    mem::discriminant(value).hash(state);
+    match value {
+        Value::Null => {}
+        Value::Int(n) => n.hash(state),
+        Value::Float(r) => r.to_bits().hash(state),
+        Value::String(s) => s.hash(state),
+        Value::Address(address) => address.hash(state),
+        Value::Struct { fields } => {
+            for (name, field) in fields.iter().sorted_by_key(|(name, _)| *name) {
+                name.hash(state);
+                hash_value(field, state);
+            }
+        }
+        Value::Array(elements) => {
+            elements.len().hash(state);
+            for element in elements {
+                hash_value(element, state);
+            }
+        }
+    }
+}
+
 fn range_id_generator<'a>(next_range_id: &'a mut usize) -> impl FnMut() -> EditRangeId + 'a {
     move || {
         let range_id = EditRangeId(*next_range_id);
@@ -182,7 +291,7 @@ fn range_id_generator<'a>(next_range_id: &'a mut usize) -> impl FnMut() -> EditR
     }
 }
 
-#[derive(Debug)]
+#[derive(Debug, Clone)]
 struct DragState {
     column: Variable,
     preview: RangeEditPreview,
@@ -192,6 +301,8 @@ struct DragState {
 struct Ranges {
     ranges: HashMap<EditRangeId, EditRange>,
     ranges_by_frame: HashMap<u32, EditRangeId>,
+    /// The wrapping sum of `range_hash` over the non-empty ranges.
+    hash: u64,
 }
 
 impl Ranges {
@@ -212,8 +323,19 @@ impl Ranges {
             .map(|range_id| self.range(range_id))
     }
 
+    fn rehash(&mut self, column: &Variable) {
+        self.hash = self
+            .ranges
+            .values()
+            .filter(|range| !range.frames.is_empty())
+            .fold(0, |sum, range| {
+                sum.wrapping_add(range_hash(column, range.frames.clone(), &range.value))
+            });
+    }
+
     fn set_value_or_create_range(
         &mut self,
+        column: &Variable,
         frame: u32,
         value: Value,
         mut gen_range_id: impl FnMut() -> EditRangeId,
@@ -221,11 +343,21 @@ impl Ranges {
         match self.find_range_id(frame) {
             Some(range_id) => {
                 let range = self.ranges.get_mut(&range_id).unwrap();
+                self.hash = self
+                    .hash
+                    .wrapping_sub(range_hash(column, range.frames.clone(), &range.value))
+                    .wrapping_add(range_hash(column, range.frames.clone(), &value));
                 range.value = value;
-                InvalidatedFrames::StartingAt(range.frames.start)
+                InvalidatedFrames::Edited {
+                    start: range.frames.start,
+                    end: range.frames.end,
+                }
             }
             None => {
                 let range_id = gen_range_id();
+                self.hash = self
+                    .hash
+                    .wrapping_add(range_hash(column, frame..frame + 1, &value));
                 self.ranges.insert(
                     range_id,
                     EditRange {
@@ -235,12 +367,15 @@ impl Ranges {
                     },
                 );
                 self.ranges_by_frame.insert(frame, range_id);
-                InvalidatedFrames::StartingAt(frame)
+                InvalidatedFrames::Edited {
+                    start: frame,
+                    end: frame + 1,
+                }
             }
         }
     }
 
-    fn insert(&mut self, start_frame: u32, count: usize) {
+    fn insert(&mut self, column: &Variable, start_frame: u32, count: usize) {
         let shift = |frame| {
             if frame >= start_frame {
                 frame + count as u32
@@ -264,9 +399,10 @@ impl Ranges {
                 self.ranges_by_frame.insert(frame, *range_id);
             }
         }
+        self.rehash(column);
     }
 
-    fn remove(&mut self, start_frame: u32, count: usize) {
+    fn remove(&mut self, column: &Variable, start_frame: u32, count: usize) {
         let shift = |frame| {
             if frame >= start_frame + count as u32 {
                 Some(frame - count as u32)
@@ -298,6 +434,7 @@ impl Ranges {
                 }
             })
             .collect();
+        self.rehash(column);
     }
 
     fn validate(&self) {
@@ -314,7 +451,7 @@ impl Ranges {
     }
 }
 
-#[derive(Debug)]
+#[derive(Debug, Clone)]
 struct RangeEditPreview {
     drag_source: u32,
     source_value: Value,
@@ -493,6 +630,33 @@ impl RangeEditPreview {
         self.invalidated_frames
     }
 
+    /// Return the ranges that result from applying the preview to `parent`.
+    fn ranges<'a>(&'a self, parent: &'a Ranges) -> impl Iterator<Item = &'a EditRange> + 'a {
+        parent
+            .ranges
+            .iter()
+            .filter(move |(range_id, _)| !self.ranges_override.contains_key(range_id))
+            .map(|(_, range)| range)
+            .chain(self.ranges_override.values())
+    }
+
+    /// Return the amount that applying the preview adds to `parent.hash`.
+    fn hash_change(&self, column: &Variable, parent: &Ranges) -> u64 {
+        let mut change = 0u64;
+        for (range_id, range) in &self.ranges_override {
+            if let Some(parent_range) = parent.try_range(*range_id) {
+                let parent_hash =
+                    range_hash(column, parent_range.frames.clone(), &parent_range.value);
+                change = change.wrapping_sub(parent_hash);
+            }
+            if !range.frames.is_empty() {
+                change =
+                    change.wrapping_add(range_hash(column, range.frames.clone(), &range.value));
+            }
+        }
+        change
+    }
+
     fn range<'a>(&'a self, parent: &'a Ranges, range_id: EditRangeId) -> &'a EditRange {
         self.ranges_override
             .get(&range_id)
@@ -569,7 +733,9 @@ impl RangeEditPreview {
         }
     }
 
-    fn commit(self, parent: &mut Ranges) {
+    fn commit(self, column: &Variable, parent: &mut Ranges) {
+        parent.hash = parent.hash.wrapping_add(self.hash_change(column, parent));
+
         for (&frame, &range_id) in &self.ranges_by_frame_override {
             match range_id {
                 Some(range_id) => {
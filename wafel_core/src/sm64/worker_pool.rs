@@ -0,0 +1,357 @@
+//! Parallel range reads using separate instances of the game.
+
+use super::{load_dll_pipeline_instance, Pipeline, RangeEdits, SM64ErrorCause, Variable};
+use crate::{
+    data_path::GlobalDataPath,
+    dll,
+    error::Error,
+    memory::{Address, Memory, Value},
+    timeline::SlotStorage,
+};
+use std::{
+    cell::RefCell,
+    mem,
+    ops::Range,
+    sync::{
+        atomic::{AtomicBool, Ordering},
+        mpsc::{self, Receiver, SendError, Sender},
+        Arc,
+    },
+    thread::{self, JoinHandle},
+};
+
+/// A set of background threads, each simulating its own copy of the game.
+///
+/// Workers don't keep any backup slots of their own. Instead each chunk of a range read
+/// starts at a checkpoint from the main pipeline, which is copied into the worker's base
+/// slot, and the values that are read are sent back and stored in the main pipeline's data
+/// cache.
+///
+/// Each worker checks at startup that checkpoints can be relocated into its copy of the DLL,
+/// so that it never needs to simulate from power-on. If a worker fails, its chunk is read on
+/// the main pipeline instead, and the error is kept until `take_errors` is called.
+#[derive(Debug)]
+pub struct WorkerPool {
+    workers: Vec<(Sender<Job>, JoinHandle<()>)>,
+    errors: RefCell<Vec<Error>>,
+}
+
+/// The receiver for a job's result, along with the job's `claimed` flag.
+type PendingJob = (Receiver<Result<Vec<Vec<Value>>, Error>>, Arc<AtomicBool>);
+
+#[derive(Debug)]
+struct Job {
+    edits: RangeEdits,
+    /// Variables with global paths. The paths are looked up in the worker's own DLL.
+    variables: Vec<Variable>,
+    frames: Range<u32>,
+    /// The state on `frames.start`, as returned by `Timeline::checkpoint_data`.
+    checkpoint: Vec<u8>,
+    base_address: Address,
+    /// Set by whichever of the worker and the main thread starts reading the chunk first.
+    claimed: Arc<AtomicBool>,
+    result: Sender<Result<Vec<Vec<Value>>, Error>>,
+}
+
+impl WorkerPool {
+    /// Start `count` workers, each loading its own copy of the DLL at `dll_path`.
+    ///
+    /// `power_on_data` is the power-on state of the main pipeline, as returned by
+    /// `Timeline::power_on_data`.
+    ///
+    /// # Safety
+    ///
+    /// See `dll::Memory::load_instance`.
+    pub unsafe fn new(
+        dll_path: &str,
+        count: usize,
+        storage: SlotStorage,
+        power_on_data: Vec<u8>,
+    ) -> Self {
+        let power_on_data = Arc::new(power_on_data);
+        let workers = (0..count)
+            .map(|_| {
+                let dll_path = dll_path.to_owned();
+                let power_on_data = Arc::clone(&power_on_data);
+                let (sender, receiver) = mpsc::channel::<Job>();
+                let handle = thread::spawn(move || {
+                    let mut pipeline = match load_worker(&dll_path, storage, &power_on_data) {
+                        Ok(pipeline) => pipeline,
+                        Err(error) => {
+                            // Report the error through the first job, which then falls back
+                            // to the main pipeline along with every later one
+                            if let Ok(job) = receiver.recv() {
+                                job.result.send(Err(error)).ok();
+                            }
+                            return;
+                        }
+                    };
+                    let mut edits_hash = pipeline.edits().hash_up_to(u32::MAX);
+                    for job in receiver {
+                        // The main thread may have read the chunk while the job was queued
+                        if job.claimed.swap(true, Ordering::AcqRel) {
+                            continue;
+                        }
+                        let job_hash = job.edits.hash_up_to(u32::MAX);
+                        if job_hash != edits_hash {
+                            pipeline.set_edits(job.edits);
+                            edits_hash = job_hash;
+                        }
+                        let result = pipeline
+                            .timeline_mut()
+                            .load_checkpoint(job.frames.start, &job.checkpoint)
+                            .and_then(|_| {
+                                read_relocated(
+                                    &pipeline,
+                                    &job.variables,
+                                    job.frames,
+                                    job.base_address,
+                                )
+                            });
+                        job.result.send(result).ok();
+                    }
+                });
+                (sender, handle)
+            })
+            .collect();
+        Self {
+            workers,
+            errors: RefCell::new(Vec::new()),
+        }
+    }
+
+    /// Return the errors from workers that failed since the last call.
+    pub fn take_errors(&self) -> Vec<Error> {
+        mem::take(&mut *self.errors.borrow_mut())
+    }
+
+    /// Read the given variables on every frame in `frames`, returning one column of values
+    /// per variable.
+    ///
+    /// The range is split at checkpoints of `pipeline`. The first chunk is read on the
+    /// current thread, and each later chunk is simulated by a worker starting from its
+    /// checkpoint. Chunks that are already cached, chunks whose worker fails, and chunks that
+    /// no worker has started by the time the current thread is free are read using
+    /// `pipeline` instead. The current thread only waits for chunks that a worker is already
+    /// reading.
+    pub fn read_range(
+        &self,
+        pipeline: &Pipeline<dll::Memory>,
+        variables: &[Variable],
+        frames: Range<u32>,
+    ) -> Result<Vec<Vec<Value>>, Error> {
+        pipeline.read_range_with(variables, frames, |variables, paths, frames| {
+            self.read_paths(pipeline, variables, paths, frames)
+        })
+    }
+
+    fn read_paths(
+        &self,
+        pipeline: &Pipeline<dll::Memory>,
+        variables: &[Variable],
+        paths: &[GlobalDataPath],
+        frames: Range<u32>,
+    ) -> Result<Vec<Vec<Value>>, Error> {
+        let timeline = pipeline.timeline();
+        let chunk_starts = self.chunk_starts(&timeline.cached_frames(), frames.clone());
+        let chunk_ends = chunk_starts.iter().skip(1).copied().chain(Some(frames.end));
+
+        let mut pending = Vec::new();
+        for ((&start, end), (sender, _)) in chunk_starts.iter().zip(chunk_ends).zip(&self.workers) {
+            let chunk = start..end;
+            let job = if timeline.is_range_cached(paths, chunk.clone()) {
+                None
+            } else {
+                self.send_job(pipeline, sender, variables, chunk.clone())?
+            };
+            pending.push((chunk, job));
+        }
+
+        let first_end = chunk_starts.first().copied().unwrap_or(frames.end);
+        let mut columns = timeline.read_range(paths, frames.start..first_end)?;
+
+        // Take back the chunks that no worker has started, e.g. because it is still loading
+        let mut chunk_results = Vec::new();
+        for (chunk, job) in pending.iter_mut().rev() {
+            let unclaimed = job
+                .as_ref()
+                .map_or(true, |(_, claimed)| !claimed.swap(true, Ordering::AcqRel));
+            if unclaimed {
+                *job = None;
+                chunk_results.push(Some(timeline.read_range(paths, chunk.clone())?));
+            } else {
+                chunk_results.push(None);
+            }
+        }
+        chunk_results.reverse();
+
+        for ((chunk, job), chunk_result) in pending.into_iter().zip(chunk_results) {
+            let chunk_columns = match (chunk_result, job) {
+                (Some(chunk_columns), _) => chunk_columns,
+                (None, Some((receiver, _))) => {
+                    let result = receiver
+                        .recv()
+                        .unwrap_or_else(|_| Err(SM64ErrorCause::WorkerFailed.into()));
+                    match result {
+                        Ok(chunk_columns) => {
+                            timeline.cache_range(paths, chunk.start, &chunk_columns);
+                            chunk_columns
+                        }
+                        Err(error) => {
+                            self.errors.borrow_mut().push(error);
+                            timeline.read_range(paths, chunk)?
+                        }
+                    }
+                }
+                (None, None) => unreachable!(),
+            };
+            for (column, values) in columns.iter_mut().zip(chunk_columns) {
+                column.extend(values);
+            }
+        }
+        Ok(columns)
+    }
+
+    /// Choose the frames where each worker's chunk of `frames` begins.
+    ///
+    /// The chunks start at checkpoints so that workers don't need to simulate from the
+    /// start of the game. Frames before the first chunk are read on the current thread.
+    fn chunk_starts(&self, checkpoints: &[u32], frames: Range<u32>) -> Vec<u32> {
+        let mut checkpoints: Vec<u32> = checkpoints
+            .iter()
+            .copied()
+            .filter(|&frame| frame > frames.start && frame < frames.end)
+            .collect();
+        checkpoints.sort_unstable();
+        checkpoints.dedup();
+
+        let num_chunks = self.workers.len() as u64 + 1;
+        let length = (frames.end - frames.start) as u64;
+        let mut starts: Vec<u32> = Vec::new();
+        for index in 1..num_chunks {
+            let ideal_start = frames.start + (length * index / num_chunks) as u32;
+            let start = checkpoints
+                .iter()
+                .copied()
+                .take_while(|&frame| frame <= ideal_start)
+                .last();
+            if let Some(start) = start {
+                if starts.last().map_or(true, |&last| start > last) {
+                    starts.push(start);
+                }
+            }
+        }
+        starts
+    }
+
+    /// Send a chunk to a worker, returning None if its checkpoint isn't available.
+    ///
+    /// Returns the receiver for the result along with the job's claim flag. If the worker
+    /// has stopped, the receiver holds an error.
+    fn send_job(
+        &self,
+        pipeline: &Pipeline<dll::Memory>,
+        sender: &Sender<Job>,
+        variables: &[Variable],
+        frames: Range<u32>,
+    ) -> Result<Option<PendingJob>, Error> {
+        let timeline = pipeline.timeline();
+        let checkpoint = match timeline.checkpoint_data(frames.start)? {
+            Some(checkpoint) => checkpoint,
+            None => return Ok(None),
+        };
+        let (result, receiver) = mpsc::channel();
+        let claimed = Arc::new(AtomicBool::new(false));
+        let job = Job {
+            edits: pipeline.edits().clone(),
+            variables: variables.to_vec(),
+            frames,
+            checkpoint,
+            base_address: timeline.memory().base_address(),
+            claimed: Arc::clone(&claimed),
+            result,
+        };
+        if let Err(SendError(job)) = sender.send(job) {
+            job.claimed.store(true, Ordering::Release);
+            job.result
+                .send(Err(SM64ErrorCause::WorkerFailed.into()))
+                .ok();
+        }
+        Ok(Some((receiver, claimed)))
+    }
+}
+
+/// Load a worker's copy of the DLL, and check that checkpoints from the main pipeline can be
+/// loaded into it without simulating them.
+///
+/// # Safety
+///
+/// See `dll::Memory::load_instance`.
+unsafe fn load_worker(
+    dll_path: &str,
+    storage: SlotStorage,
+    power_on_data: &[u8],
+) -> Result<Pipeline<dll::Memory>, Error> {
+    let mut pipeline = load_dll_pipeline_instance(dll_path, 0, storage)?;
+    if !pipeline.timeline_mut().check_relocation(power_on_data)? {
+        return Err(SM64ErrorCause::WorkerRelocationFailed.into());
+    }
+    Ok(pipeline)
+}
+
+impl Drop for WorkerPool {
+    fn drop(&mut self) {
+        for (sender, handle) in self.workers.drain(..) {
+            drop(sender);
+            handle.join().ok();
+        }
+    }
+}
+
+/// Read the global paths of `variables` on each frame, translating addresses so that they
+/// point into the DLL loaded at `base_address`.
+fn read_relocated(
+    pipeline: &Pipeline<dll::Memory>,
+    variables: &[Variable],
+    frames: Range<u32>,
+    base_address: Address,
+) -> Result<Vec<Vec<Value>>, Error> {
+    let data_variables = pipeline.data_variables();
+    let mut paths = Vec::new();
+    for variable in variables {
+        if let Some(path) = data_variables.global_path(variable)? {
+            paths.push(path.clone());
+        }
+    }
+
+    let offset = base_address
+        .0
+        .wrapping_sub(pipeline.timeline().memory().base_address().0);
+    let mut columns = pipeline.timeline().read_range(&paths, frames)?;
+    if offset != 0 {
+        for value in columns.iter_mut().flatten() {
+            relocate(value, offset);
+        }
+    }
+    Ok(columns)
+}
+
+/// Move non-null addresses by `offset` bytes.
+fn relocate(value: &mut Value, offset: usize) {
+    match value {
+        Value::Address(address) if address.0 != 0 => {
+            address.0 = address.0.wrapping_add(offset);
+        }
+        Value::Struct { fields } => {
+            for field in fields.values_mut() {
+                relocate(field, offset);
+            }
+        }
+        Value::Array(elements) => {
+            for element in elements {
+                relocate(element, offset);
+            }
+        }
+        _ => {}
+    }
+}
@@ -0,0 +1,349 @@
+//! On-disk storage of slot contents that persists between sessions.
+
+use memmap::Mmap;
+use std::{
+    collections::{BTreeMap, VecDeque},
+    fs::{self, File},
+    hash::Hasher,
+    io, mem,
+    path::{Path, PathBuf},
+    sync::{
+        mpsc::{self, Sender},
+        Arc, Mutex,
+    },
+    thread::{self, JoinHandle},
+};
+
+/// Incremented whenever the archived data would be interpreted differently.
+const FORMAT_VERSION: u32 = 5;
+
+/// The maximum number of archived edit versions to keep for a single frame.
+const MAX_VERSIONS_PER_FRAME: usize = 3;
+
+/// The maximum total size of the snapshots in an archive.
+///
+/// The oldest snapshots are removed first when the archive grows past this size.
+const MAX_ARCHIVE_BYTES: u64 = 4 * 1024 * 1024 * 1024;
+
+/// A directory of slot snapshots, keyed by frame and a hash of the edits up to that frame.
+///
+/// Snapshots are written to disk on a background thread, and are read back using memory
+/// mapped files. The archive also keeps the power-on state of each program instance that
+/// wrote to it, keyed by the address the program was loaded at, so that relocation from
+/// that instance can be checked without simulating.
+///
+/// Hashes that are used as keys should be computed using `StableHasher`, since they need
+/// to match between sessions.
+#[derive(Debug)]
+pub struct SlotArchive {
+    directory: PathBuf,
+    /// The edit hashes archived for each frame, from oldest to newest.
+    entries: BTreeMap<u32, Vec<u64>>,
+    /// The frame, edit hash, and size of each snapshot, from oldest to newest.
+    history: VecDeque<(u32, u64, u64)>,
+    /// The total size of the archived snapshots.
+    byte_size: u64,
+    /// The addresses that a power-on state is archived for.
+    power_on_addresses: Vec<u64>,
+    writer: Option<(Sender<ArchiveRequest>, JoinHandle<()>)>,
+    /// Errors from the background thread since the last call to `take_errors`.
+    errors: Arc<Mutex<Vec<io::Error>>>,
+}
+
+#[derive(Debug)]
+enum ArchiveRequest {
+    Write { path: PathBuf, data: Vec<u8> },
+    Remove { path: PathBuf },
+    RemoveDirectory { path: PathBuf },
+}
+
+impl SlotArchive {
+    /// Open or create an archive within `directory`.
+    ///
+    /// `program_hash` should identify the program whose memory is being archived, since
+    /// snapshots from a different program are meaningless.
+    ///
+    /// Archives in `directory` for other programs or format versions are deleted, and the
+    /// oldest snapshots are deleted if the archive is over its size budget.
+    pub fn open(directory: impl AsRef<Path>, program_hash: u64) -> io::Result<Self> {
+        let archive_name = format!("v{}-{:016x}", FORMAT_VERSION, program_hash);
+        let root = directory.as_ref();
+        let directory = root.join(&archive_name);
+        fs::create_dir_all(&directory)?;
+
+        let mut removed_paths = Vec::new();
+        let mut removed_directories = Vec::new();
+        for entry in fs::read_dir(root)? {
+            let entry = entry?;
+            let file_name = entry.file_name();
+            let is_other_archive = file_name
+                .to_str()
+                .map_or(false, |name| name != archive_name && is_archive_name(name));
+            if is_other_archive && entry.file_type()?.is_dir() {
+                removed_directories.push(entry.path());
+            }
+        }
+
+        let mut files: Vec<(u32, u64, u64, _)> = Vec::new();
+        let mut power_on_addresses = Vec::new();
+        for entry in fs::read_dir(&directory)? {
+            let entry = entry?;
+            let file_name = entry.file_name();
+            if let Some(address) = file_name.to_str().and_then(parse_power_on_file_name) {
+                power_on_addresses.push(address);
+            } else if let Some((frame, edits_hash)) = file_name.to_str().and_then(parse_file_name) {
+                let metadata = entry.metadata()?;
+                files.push((frame, edits_hash, metadata.len(), metadata.modified()?));
+            } else if entry.path().extension().map_or(false, |ext| ext == "tmp") {
+                // Left behind by a session that exited while writing
+                removed_paths.push(entry.path());
+            }
+        }
+        files.sort_by_key(|(_, _, _, modified)| *modified);
+
+        let errors = Arc::new(Mutex::new(Vec::new()));
+        let writer_errors = Arc::clone(&errors);
+        let (sender, receiver) = mpsc::channel();
+        let handle = thread::spawn(move || {
+            for request in receiver {
+                let result = match request {
+                    ArchiveRequest::Write { path, data } => {
+                        // Write to a temporary file so that a partial snapshot is never read
+                        let temp_path = path.with_extension("tmp");
+                        fs::write(&temp_path, data).and_then(|_| fs::rename(&temp_path, &path))
+                    }
+                    ArchiveRequest::Remove { path } => match fs::remove_file(&path) {
+                        // The snapshot may have failed to be written
+                        Err(error) if error.kind() == io::ErrorKind::NotFound => Ok(()),
+                        result => result,
+                    },
+                    ArchiveRequest::RemoveDirectory { path } => fs::remove_dir_all(&path),
+                };
+                if let Err(error) = result {
+                    writer_errors.lock().unwrap().push(error);
+                }
+            }
+        });
+        for path in removed_directories {
+            sender.send(ArchiveRequest::RemoveDirectory { path }).ok();
+        }
+        for path in removed_paths {
+            sender.send(ArchiveRequest::Remove { path }).ok();
+        }
+
+        let mut archive = Self {
+            directory,
+            entries: BTreeMap::new(),
+            history: VecDeque::new(),
+            byte_size: 0,
+            power_on_addresses,
+            writer: Some((sender, handle)),
+            errors,
+        };
+        for (frame, edits_hash, size, _) in files {
+            archive.add_entry(frame, edits_hash, size);
+        }
+        archive.remove_over_budget();
+        Ok(archive)
+    }
+
+    fn path(&self, frame: u32, edits_hash: u64) -> PathBuf {
+        self.directory
+            .join(format!("{:08}-{:016x}.slot", frame, edits_hash))
+    }
+
+    fn power_on_path(&self, address: u64) -> PathBuf {
+        self.directory
+            .join(format!("power-on-{:016x}.slot", address))
+    }
+
+    /// Archive the power-on state of the program instance loaded at `address`, if it isn't
+    /// archived already.
+    pub fn insert_power_on(&mut self, address: u64, data: Vec<u8>) {
+        if self.power_on_addresses.contains(&address) {
+            return;
+        }
+        self.power_on_addresses.push(address);
+        let path = self.power_on_path(address);
+        if let Some((sender, _)) = &self.writer {
+            sender.send(ArchiveRequest::Write { path, data }).ok();
+        }
+    }
+
+    /// Map the archived power-on states into memory.
+    pub fn power_on_states(&self) -> Vec<Mmap> {
+        self.power_on_addresses
+            .iter()
+            .filter_map(|&address| {
+                let file = File::open(self.power_on_path(address)).ok()?;
+                unsafe { Mmap::map(&file).ok() }
+            })
+            .collect()
+    }
+
+    /// Return true if a snapshot has been archived for the given frame and edits.
+    pub fn contains(&self, frame: u32, edits_hash: u64) -> bool {
+        self.entries
+            .get(&frame)
+            .map_or(false, |hashes| hashes.contains(&edits_hash))
+    }
+
+    /// Return the archived frames in the range `start..=end`, latest first.
+    pub fn frames_in(&self, start: u32, end: u32) -> impl Iterator<Item = u32> + '_ {
+        self.entries
+            .range(start..=end)
+            .rev()
+            .map(|(&frame, _)| frame)
+    }
+
+    /// Archive a snapshot in the background.
+    ///
+    /// If the frame has too many archived versions, or the archive is over its size budget,
+    /// the oldest snapshots are removed.
+    pub fn insert(&mut self, frame: u32, edits_hash: u64, data: Vec<u8>) {
+        if self.contains(frame, edits_hash) {
+            return;
+        }
+        let path = self.path(frame, edits_hash);
+        self.add_entry(frame, edits_hash, data.len() as u64);
+        if let Some((sender, _)) = &self.writer {
+            sender.send(ArchiveRequest::Write { path, data }).ok();
+        }
+        self.remove_over_budget();
+    }
+
+    /// Record a snapshot, removing the oldest version of the frame if it has too many.
+    fn add_entry(&mut self, frame: u32, edits_hash: u64, size: u64) {
+        self.history.push_back((frame, edits_hash, size));
+        self.byte_size += size;
+
+        let hashes = self.entries.entry(frame).or_default();
+        hashes.push(edits_hash);
+        if hashes.len() > MAX_VERSIONS_PER_FRAME {
+            let removed_hash = hashes[0];
+            self.remove_entry(frame, removed_hash);
+        }
+    }
+
+    /// Remove the oldest snapshots until the archive fits in its size budget.
+    fn remove_over_budget(&mut self) {
+        while self.byte_size > MAX_ARCHIVE_BYTES {
+            match self.history.front() {
+                Some(&(frame, edits_hash, _)) => self.remove_entry(frame, edits_hash),
+                None => break,
+            }
+        }
+    }
+
+    /// Forget a snapshot and delete its file in the background.
+    fn remove_entry(&mut self, frame: u32, edits_hash: u64) {
+        if let Some(hashes) = self.entries.get_mut(&frame) {
+            hashes.retain(|&hash| hash != edits_hash);
+            if hashes.is_empty() {
+                self.entries.remove(&frame);
+            }
+        }
+        if let Some(index) = self
+            .history
+            .iter()
+            .position(|&(f, hash, _)| f == frame && hash == edits_hash)
+        {
+            let (_, _, size) = self.history.remove(index).unwrap();
+            self.byte_size -= size;
+        }
+
+        let path = self.path(frame, edits_hash);
+        if let Some((sender, _)) = &self.writer {
+            sender.send(ArchiveRequest::Remove { path }).ok();
+        }
+    }
+
+    /// Return the errors that occurred while writing or removing files in the background
+    /// since the last call.
+    ///
+    /// A snapshot that failed to be written is treated as missing.
+    pub fn take_errors(&self) -> Vec<io::Error> {
+        mem::take(&mut *self.errors.lock().unwrap())
+    }
+
+    /// Map an archived snapshot into memory.
+    ///
+    /// Returns None if the snapshot doesn't exist or hasn't finished being written yet.
+    pub fn get(&self, frame: u32, edits_hash: u64) -> Option<Mmap> {
+        if !self.contains(frame, edits_hash) {
+            return None;
+        }
+        let file = File::open(self.path(frame, edits_hash)).ok()?;
+        // Archive files are only replaced by renaming, never modified in place
+        unsafe { Mmap::map(&file).ok() }
+    }
+}
+
+impl Drop for SlotArchive {
+    fn drop(&mut self) {
+        // Finish pending writes
+        if let Some((sender, handle)) = self.writer.take() {
+            drop(sender);
+            handle.join().ok();
+        }
+    }
+}
+
+/// A 64-bit FNV-1a hasher, for hashes that are stored on disk.
+///
+/// Unlike `DefaultHasher`, its output is guaranteed not to change between Rust releases.
+#[derive(Debug, Clone, Copy)]
+pub struct StableHasher(u64);
+
+impl StableHasher {
+    pub fn new() -> Self {
+        Self(0xcbf2_9ce4_8422_2325)
+    }
+}
+
+impl Default for StableHasher {
+    fn default() -> Self {
+        Self::new()
+    }
+}
+
+impl Hasher for StableHasher {
+    fn write(&mut self, bytes: &[u8]) {
+        for &byte in bytes {
+            self.0 ^= byte as u64;
+            self.0 = self.0.wrapping_mul(0x0000_0100_0000_01b3);
+        }
+    }
+
+    fn finish(&self) -> u64 {
+        self.0
+    }
+}
+
+/// Return true if `name` has the form of an archive directory for any program and format.
+fn is_archive_name(name: &str) -> bool {
+    let rest = match name.strip_prefix('v') {
+        Some(rest) => rest,
+        None => return false,
+    };
+    let mut parts = rest.splitn(2, '-');
+    let version = parts.next().and_then(|part| part.parse::<u32>().ok());
+    let hash = parts
+        .next()
+        .filter(|part| part.len() == 16)
+        .and_then(|part| u64::from_str_radix(part, 16).ok());
+    version.is_some() && hash.is_some()
+}
+
+fn parse_power_on_file_name(file_name: &str) -> Option<u64> {
+    let address = file_name.strip_prefix("power-on-")?.strip_suffix(".slot")?;
+    u64::from_str_radix(address, 16).ok()
+}
+
+fn parse_file_name(file_name: &str) -> Option<(u32, u64)> {
+    let stem = file_name.strip_suffix(".slot")?;
+    let mut parts = stem.splitn(2, '-');
+    let frame = parts.next()?.parse().ok()?;
+    let edits_hash = u64::from_str_radix(parts.next()?, 16).ok()?;
+    Some((frame, edits_hash))
+}
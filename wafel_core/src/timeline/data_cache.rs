@@ -1,36 +1,114 @@
 use super::State;
-use crate::{data_path::GlobalDataPath, memory::Value};
-use deepsize::{known_deep_size, DeepSizeOf};
+use crate::{
+    data_path::GlobalDataPath,
+    memory::{Address, IntValue, Value},
+};
 use lru::LruCache;
-use std::collections::HashMap;
+use std::{
+    collections::{BTreeMap, BTreeSet, HashMap},
+    convert::TryFrom,
+    mem,
+    ops::Range,
+};
+
+/// The maximum number of consecutive frames stored for each path.
+const MAX_COLUMN_FRAMES: u32 = 16384;
+
+/// The minimum number of frames that a column grows by at once when extended backward.
+///
+/// Backward growth moves every entry, so columns grow by at least their current length to
+/// keep repeated growth amortized O(1) per frame.
+const COLUMN_GROW_FRAMES: u32 = 64;
+
+/// The default limit on the size of the cached values.
+pub const DEFAULT_DATA_CACHE_BUDGET: usize = 64 * 1024 * 1024;
+
+/// A single column may use at most this fraction of the byte budget, so that a path with
+/// large values doesn't push out every other path.
+const MAX_COLUMN_BUDGET_FRACTION: usize = 4;
+
+/// Column ends are indexed rounded up to a multiple of this many frames, so that a column
+/// that grows one frame at a time only needs to be reindexed occasionally.
+const COLUMN_END_GRANULARITY: u32 = 64;
 
 /// A cache for data path accesses, with the goal of minimizing calls to `SlotManager#frame`.
 ///
 /// Besides caching individual values, it also preloads certain paths as soon as a
 /// frame is requested for the first time.
+///
+/// Values are stored by path, in a column indexed by frame. Most paths hold integers or
+/// floats, which are stored unboxed. The addresses of paths are cached in separate columns,
+/// so that they are invalidated along with the values.
+///
+/// The total size of the columns is kept within a byte budget by evicting stale data first,
+/// and then the least recently used columns.
+///
+/// Columns are indexed by the frame that they end on, so invalidating the frames after an
+/// edit only visits the columns that hold some of those frames, and takes time proportional
+/// to the number of entries being invalidated.
 #[derive(Debug)]
 pub struct DataCache {
     path_intern: HashMap<String, usize>,
     path_unintern: HashMap<usize, GlobalDataPath>,
+    /// The column keys used for path addresses, which share a key space with `path_intern`.
+    address_intern: HashMap<String, usize>,
     hot_paths: LruCache<usize, ()>,
-    cache: LruCache<u32, HashMap<usize, Value>>,
+    columns: LruCache<usize, Column>,
+    /// An upper bound on the end frame of each column, rounded up to a multiple of
+    /// `COLUMN_END_GRANULARITY`.
+    column_ends: HashMap<usize, u32>,
+    /// The entries of `column_ends` as (end, path key), ordered by end frame.
+    columns_by_end: BTreeSet<(u32, usize)>,
+    /// The parts of columns that were invalidated but may become valid again, keyed by
+    /// invalidation generation and path.
+    ///
+    /// Generations increase over time, so the oldest stale data comes first.
+    stale: BTreeMap<(usize, usize), Column>,
+    byte_budget: usize,
+    /// The total size of `columns` and `stale`.
+    byte_size: usize,
+    stats: DataCacheStats,
+}
+
+/// Counters describing the effectiveness of a `DataCache`.
+#[derive(Debug, Clone, Copy, Default, PartialEq, Eq)]
+pub struct DataCacheStats {
+    /// The number of values that were found in the cache.
+    pub hits: usize,
+    /// The number of values that were requested but not cached.
+    pub misses: usize,
+    /// The number of values that were dropped to stay within the byte budget.
+    pub evictions: usize,
 }
 
 impl DataCache {
-    pub fn new() -> Self {
+    pub fn new(byte_budget: usize) -> Self {
         Self {
             path_intern: HashMap::new(),
             path_unintern: HashMap::new(),
+            address_intern: HashMap::new(),
             hot_paths: LruCache::new(100),
-            cache: LruCache::new(100),
+            columns: LruCache::unbounded(),
+            column_ends: HashMap::new(),
+            columns_by_end: BTreeSet::new(),
+            stale: BTreeMap::new(),
+            byte_budget,
+            byte_size: 0,
+            stats: DataCacheStats::default(),
         }
     }
 
+    /// Change the byte budget, evicting data if necessary.
+    pub fn set_byte_budget(&mut self, byte_budget: usize) {
+        self.byte_budget = byte_budget;
+        self.evict_to_budget(None);
+    }
+
     fn intern(&mut self, path: &GlobalDataPath) -> usize {
         match self.path_intern.get(path.source()) {
             Some(&key) => key,
             None => {
-                let key = self.path_intern.len();
+                let key = self.path_intern.len() + self.address_intern.len();
                 self.path_intern.insert(path.source().to_owned(), key);
                 self.path_unintern.insert(key, path.clone());
                 key
@@ -38,6 +116,17 @@ impl DataCache {
         }
     }
 
+    fn intern_address(&mut self, path: &GlobalDataPath) -> usize {
+        match self.address_intern.get(path.source()) {
+            Some(&key) => key,
+            None => {
+                let key = self.path_intern.len() + self.address_intern.len();
+                self.address_intern.insert(path.source().to_owned(), key);
+                key
+            }
+        }
+    }
+
     fn unintern(&self, key: usize) -> &GlobalDataPath {
         self.path_unintern.get(&key).unwrap()
     }
@@ -45,59 +134,1146 @@ impl DataCache {
     pub fn get(&mut self, frame: u32, path: &GlobalDataPath) -> Option<Value> {
         let path_key = self.intern(path);
         self.hot_paths.put(path_key, ());
-        self.cache
-            .get(&frame)
-            .and_then(|cache| cache.get(&path_key))
-            .cloned()
+        let value = self
+            .columns
+            .get(&path_key)
+            .and_then(|column| column.get(frame));
+        self.record_lookup(value.is_some());
+        value
+    }
+
+    /// Return the cached value of `path` on each frame in `frames`.
+    pub fn get_range(&mut self, frames: Range<u32>, path: &GlobalDataPath) -> Vec<Option<Value>> {
+        let path_key = self.intern(path);
+        self.hot_paths.put(path_key, ());
+        let values: Vec<Option<Value>> = match self.columns.get(&path_key) {
+            Some(column) => frames.map(|frame| column.get(frame)).collect(),
+            None => frames.map(|_| None).collect(),
+        };
+        for value in &values {
+            self.record_lookup(value.is_some());
+        }
+        values
+    }
+
+    /// Return true if `path` is cached on every frame in `frames`.
+    ///
+    /// Unlike `get_range`, this doesn't count as a lookup or make the path hot.
+    pub fn contains_range(&self, frames: Range<u32>, path: &GlobalDataPath) -> bool {
+        let column = self
+            .path_intern
+            .get(path.source())
+            .and_then(|path_key| self.columns.peek(path_key));
+        match column {
+            Some(column) => frames.into_iter().all(|frame| column.is_valid(frame)),
+            None => frames.start >= frames.end,
+        }
+    }
+
+    /// Return the cached address of `path` on the given frame.
+    ///
+    /// Address lookups don't make the path hot, since preloading only reads values.
+    pub fn get_address(&mut self, frame: u32, path: &GlobalDataPath) -> Option<Option<Address>> {
+        let path_key = self.intern_address(path);
+        let address = self
+            .columns
+            .get(&path_key)
+            .and_then(|column| column.get(frame))
+            .map(|value| match value {
+                Value::Address(address) => Some(address),
+                _ => None,
+            });
+        self.record_lookup(address.is_some());
+        address
+    }
+
+    pub fn insert_address(&mut self, frame: u32, path: &GlobalDataPath, address: Option<Address>) {
+        let path_key = self.intern_address(path);
+        let value = match address {
+            Some(address) => Value::Address(address),
+            None => Value::Null,
+        };
+        self.insert_key(frame, path_key, value);
+    }
+
+    fn record_lookup(&mut self, hit: bool) {
+        if hit {
+            self.stats.hits += 1;
+        } else {
+            self.stats.misses += 1;
+        }
     }
 
     pub fn insert(&mut self, frame: u32, path: &GlobalDataPath, value: Value) {
         let path_key = self.intern(path);
-        let cache = match self.cache.get_mut(&frame) {
-            Some(cache) => cache,
-            None => {
-                self.cache.put(frame, HashMap::new());
-                self.cache.peek_mut(&frame).unwrap()
-            }
+        self.insert_key(frame, path_key, value);
+    }
+
+    fn insert_key(&mut self, frame: u32, path_key: usize, value: Value) {
+        if !self.columns.contains(&path_key) {
+            self.columns.put(path_key, Column::new());
+        }
+        let column = self.columns.get_mut(&path_key).unwrap();
+        let old_size = column.byte_size();
+
+        self.stats.evictions += column.insert(frame, value);
+        while column.byte_size() > self.byte_budget / MAX_COLUMN_BUDGET_FRACTION && column.len() > 1
+        {
+            self.stats.evictions += column.shrink_around(frame);
+        }
+
+        self.byte_size = self.byte_size + column.byte_size() - old_size;
+        let end = column.end();
+        if self
+            .column_ends
+            .get(&path_key)
+            .map_or(true, |&indexed| end > indexed)
+        {
+            self.index_column_end(path_key, Some(end));
+        }
+        self.evict_to_budget(Some(path_key));
+    }
+
+    /// Update the indexed end of a column, or remove it from the index if `end` is None.
+    fn index_column_end(&mut self, path_key: usize, end: Option<u32>) {
+        let indexed_end = end.map(|end| {
+            let granularity = COLUMN_END_GRANULARITY;
+            end.saturating_add(granularity - 1) / granularity * granularity
+        });
+        let old_end = match indexed_end {
+            Some(indexed_end) => self.column_ends.insert(path_key, indexed_end),
+            None => self.column_ends.remove(&path_key),
         };
-        cache.insert(path_key, value);
+        if old_end != indexed_end {
+            if let Some(old_end) = old_end {
+                self.columns_by_end.remove(&(old_end, path_key));
+            }
+            if let Some(indexed_end) = indexed_end {
+                self.columns_by_end.insert((indexed_end, path_key));
+            }
+        }
     }
 
-    pub fn preload_frame(&mut self, state: &impl State) {
-        if self.cache.contains(&state.frame()) {
-            return;
+    /// Return the keys of the columns that may hold entries at or after `frame`.
+    fn columns_ending_after(&self, frame: u32) -> Vec<usize> {
+        self.columns_by_end
+            .range((frame.saturating_add(1), 0)..)
+            .map(|&(_, path_key)| path_key)
+            .collect()
+    }
+
+    /// Evict data until the byte budget is met, keeping the column for `keep_path_key`.
+    fn evict_to_budget(&mut self, keep_path_key: Option<usize>) {
+        while self.byte_size > self.byte_budget {
+            if let Some(&key) = self.stale.keys().next() {
+                let column = self.stale.remove(&key).unwrap();
+                self.byte_size -= column.byte_size();
+                self.stats.evictions += column.count_valid();
+                continue;
+            }
+            match self.columns.pop_lru() {
+                Some((path_key, column)) if Some(path_key) == keep_path_key => {
+                    // Every other column has been evicted
+                    self.columns.put(path_key, column);
+                    break;
+                }
+                Some((path_key, column)) => {
+                    self.byte_size -= column.byte_size();
+                    self.stats.evictions += column.count_valid();
+                    self.index_column_end(path_key, None);
+                }
+                None => break,
+            }
         }
-        let mut cache = HashMap::new();
-        for (&path_key, ()) in &self.hot_paths {
+    }
+
+    /// Return true if `path` has been read recently enough to be preloaded on new frames.
+    pub fn is_hot(&self, path: &GlobalDataPath) -> bool {
+        self.path_intern
+            .get(path.source())
+            .map_or(false, |path_key| self.hot_paths.contains(path_key))
+    }
+
+    /// Return true if every hot path has been loaded on the given frame.
+    pub fn contains_frame(&self, frame: u32) -> bool {
+        self.hot_paths.iter().all(|(path_key, ())| {
+            self.columns
+                .peek(path_key)
+                .map_or(false, |column| column.is_valid(frame))
+        })
+    }
+
+    pub fn preload_frame(&mut self, state: &impl State) {
+        let frame = state.frame();
+        let missing_keys: Vec<usize> = self
+            .hot_paths
+            .iter()
+            .map(|(&path_key, ())| path_key)
+            .filter(|path_key| {
+                !self
+                    .columns
+                    .peek(path_key)
+                    .map_or(false, |column| column.is_valid(frame))
+            })
+            .collect();
+        for path_key in missing_keys {
             let path = self.unintern(path_key);
             // Ignore errors so that they can get caught when the path is directly requested
             if let Ok(value) = state.path_read(path) {
-                cache.insert(path_key, value);
+                self.insert_key(frame, path_key, value);
             }
         }
-        self.cache.put(state.frame(), cache);
     }
 
-    pub fn invalidate_frame(&mut self, invalidated_frame: u32) {
-        let invalidated_keys: Vec<u32> = self
-            .cache
-            .iter()
-            .filter(|(&frame, _)| frame >= invalidated_frame)
-            .map(|(&frame, _)| frame)
+    /// Invalidate frames starting at `invalidated_frame`, but keep their data in case the
+    /// frames become valid again in the given generation.
+    pub fn invalidate_frame(&mut self, invalidated_frame: u32, generation: usize) {
+        for path_key in self.columns_ending_after(invalidated_frame) {
+            let column = match self.columns.peek_mut(&path_key) {
+                Some(column) => column,
+                None => continue,
+            };
+            let old_size = column.byte_size();
+            let tail = column.split_off(invalidated_frame);
+            let end = column.end();
+            self.byte_size = self.byte_size + column.byte_size() - old_size;
+            if let Some(tail) = tail {
+                self.byte_size += tail.byte_size();
+                if let Some(replaced) = self.stale.insert((generation, path_key), tail) {
+                    self.byte_size -= replaced.byte_size();
+                }
+            }
+            self.index_column_end(path_key, Some(end));
+        }
+        self.evict_to_budget(None);
+    }
+
+    /// Drop the data invalidated in `generation`, once it can no longer become valid.
+    pub fn drop_generation(&mut self, generation: usize) {
+        let keys: Vec<(usize, usize)> = self
+            .stale
+            .range((generation, 0)..=(generation, usize::MAX))
+            .map(|(&key, _)| key)
             .collect();
+        for key in keys {
+            if let Some(tail) = self.stale.remove(&key) {
+                self.byte_size -= tail.byte_size();
+            }
+        }
+    }
 
-        for frame in invalidated_keys {
-            self.cache.pop(&frame);
+    /// Remove the cached values and addresses on every frame in `frames`.
+    ///
+    /// Stale data is kept. This takes time proportional to the number of frames in the
+    /// window for each column that overlaps it.
+    pub fn drop_frames(&mut self, frames: Range<u32>) {
+        for path_key in self.columns_ending_after(frames.start) {
+            let column = match self.columns.peek_mut(&path_key) {
+                Some(column) => column,
+                None => continue,
+            };
+            let old_size = column.byte_size();
+            column.clear_range(frames.clone());
+            let end = column.end();
+            self.byte_size -= old_size - column.byte_size();
+            self.index_column_end(path_key, Some(end));
+        }
+    }
+
+    /// Restore the data invalidated in `generation` for frames at or after `frame`.
+    ///
+    /// The frames before `frame` have usually been reloaded since the invalidation, so the
+    /// restored entries start where the column ends and are appended to it in one step.
+    pub fn revalidate(&mut self, generation: usize, frame: u32) {
+        let revalidated_keys: Vec<(usize, usize)> = self
+            .stale
+            .range((generation, 0)..=(generation, usize::MAX))
+            .map(|(&key, _)| key)
+            .collect();
+
+        for key in revalidated_keys {
+            let mut tail = match self.stale.remove(&key) {
+                Some(tail) => tail,
+                None => continue,
+            };
+            self.byte_size -= tail.byte_size();
+            if frame > tail.start {
+                tail = match tail.split_off(frame) {
+                    Some(tail) => tail,
+                    None => continue,
+                };
+            }
+            let path_key = key.1;
+
+            if !self.columns.contains(&path_key) {
+                self.columns.put(path_key, Column::new());
+            }
+            let column = self.columns.get_mut(&path_key).unwrap();
+            let old_size = column.byte_size();
+            let tail_start = tail.start;
+            match column.append(tail) {
+                Ok(()) => {
+                    while column.byte_size() > self.byte_budget / MAX_COLUMN_BUDGET_FRACTION
+                        && column.len() > 1
+                    {
+                        self.stats.evictions += column.shrink_around(tail_start);
+                    }
+                    self.byte_size = self.byte_size + column.byte_size() - old_size;
+                    let end = column.end();
+                    self.index_column_end(path_key, Some(end));
+                    self.evict_to_budget(Some(path_key));
+                }
+                Err(tail) => {
+                    for (tail_frame, value) in tail.values() {
+                        self.insert_key(tail_frame, path_key, value);
+                    }
+                }
+            }
         }
     }
 
     pub fn byte_size(&self) -> usize {
-        let mut entries: HashMap<u32, HashMap<usize, Value>> = HashMap::new();
-        for (frame, cache) in &self.cache {
-            entries.insert(*frame, cache.clone());
+        self.byte_size
+    }
+
+    pub fn stats(&self) -> DataCacheStats {
+        self.stats
+    }
+}
+
+/// The values of a single path on a range of consecutive frames.
+#[derive(Debug, Clone)]
+struct Column {
+    /// The frame of the first entry.
+    start: u32,
+    data: ColumnData,
+    /// One bit per entry, set if the entry holds a value.
+    valid: Vec<u64>,
+    /// The heap memory owned by boxed values.
+    heap_bytes: usize,
+}
+
+/// Column entries, unboxed when every value has the same primitive type.
+///
+/// Entries that aren't valid hold an arbitrary value.
+#[derive(Debug, Clone)]
+enum ColumnData {
+    Int(Vec<i64>),
+    Float(Vec<f64>),
+    Value(Vec<Value>),
+}
+
+impl Column {
+    fn new() -> Self {
+        Self {
+            start: 0,
+            data: ColumnData::Int(Vec::new()),
+            valid: Vec::new(),
+            heap_bytes: 0,
+        }
+    }
+
+    fn len(&self) -> u32 {
+        match &self.data {
+            ColumnData::Int(values) => values.len() as u32,
+            ColumnData::Float(values) => values.len() as u32,
+            ColumnData::Value(values) => values.len() as u32,
+        }
+    }
+
+    /// The frame after the column's last entry.
+    fn end(&self) -> u32 {
+        self.start + self.len()
+    }
+
+    fn index(&self, frame: u32) -> Option<usize> {
+        if frame >= self.start && frame - self.start < self.len() {
+            Some((frame - self.start) as usize)
+        } else {
+            None
+        }
+    }
+
+    fn is_valid(&self, frame: u32) -> bool {
+        self.index(frame).map_or(false, |index| {
+            self.valid[index / 64] & (1 << (index % 64)) != 0
+        })
+    }
+
+    fn get(&self, frame: u32) -> Option<Value> {
+        if !self.is_valid(frame) {
+            return None;
+        }
+        let index = (frame - self.start) as usize;
+        Some(match &self.data {
+            ColumnData::Int(values) => Value::Int(values[index] as IntValue),
+            ColumnData::Float(values) => Value::Float(values[index]),
+            ColumnData::Value(values) => values[index].clone(),
+        })
+    }
+
+    /// Set the value on `frame`, returning the number of valid entries that were dropped to
+    /// make room for it.
+    fn insert(&mut self, frame: u32, value: Value) -> usize {
+        let (index, dropped) = self.reserve(frame);
+
+        let fits = match (&self.data, &value) {
+            (ColumnData::Int(_), Value::Int(int)) => i64::try_from(*int).is_ok(),
+            (ColumnData::Float(_), Value::Float(_)) => true,
+            (ColumnData::Value(_), _) => true,
+            _ => false,
+        };
+        if !fits {
+            // An empty column takes the type of its first value
+            let is_empty = self.valid.iter().all(|&word| word == 0);
+            let len = self.len() as usize;
+            self.data = match &value {
+                Value::Int(int) if is_empty && i64::try_from(*int).is_ok() => {
+                    ColumnData::Int(vec![0; len])
+                }
+                Value::Float(_) if is_empty => ColumnData::Float(vec![0.0; len]),
+                _ => ColumnData::Value(self.values_vec()),
+            };
+        }
+
+        match (&mut self.data, value) {
+            (ColumnData::Int(values), Value::Int(int)) => values[index] = int as i64,
+            (ColumnData::Float(values), Value::Float(float)) => values[index] = float,
+            (ColumnData::Value(values), value) => {
+                self.heap_bytes -= value_heap_size(&values[index]);
+                self.heap_bytes += value_heap_size(&value);
+                values[index] = value;
+            }
+            _ => unreachable!(),
+        }
+        self.valid[index / 64] |= 1 << (index % 64);
+        dropped
+    }
+
+    /// Convert the entries to boxed values.
+    fn values_vec(&self) -> Vec<Value> {
+        match &self.data {
+            ColumnData::Int(values) => values
+                .iter()
+                .map(|&int| Value::Int(int as IntValue))
+                .collect(),
+            ColumnData::Float(values) => values.iter().map(|&float| Value::Float(float)).collect(),
+            ColumnData::Value(values) => values.clone(),
+        }
+    }
+
+    /// Grow the column to include `frame`, returning its index and the number of valid
+    /// entries that were dropped.
+    ///
+    /// If the column would exceed `MAX_COLUMN_FRAMES`, entries are dropped from the end
+    /// furthest from `frame`.
+    ///
+    /// Growing forward extends the entries in place, and dropping entries from the front
+    /// removes at least a quarter of the column at once, so inserting frames in increasing
+    /// order takes amortized O(1) time per frame.
+    fn reserve(&mut self, frame: u32) -> (usize, usize) {
+        if let Some(index) = self.index(frame) {
+            return (index, 0);
+        }
+        let len = self.len();
+        let mut dropped = 0;
+        if len == 0 {
+            self.start = frame;
+        } else if frame < self.start {
+            let grow_frames = COLUMN_GROW_FRAMES.max(len);
+            let start = frame.saturating_sub(grow_frames - 1);
+            let old_count = self.count_valid();
+            self.resize(start, (self.start + len).min(start + MAX_COLUMN_FRAMES));
+            return (
+                (frame - self.start) as usize,
+                old_count - self.count_valid(),
+            );
+        } else if frame - self.start >= MAX_COLUMN_FRAMES {
+            let excess = frame - self.start + 1 - MAX_COLUMN_FRAMES;
+            let count = (excess.max(MAX_COLUMN_FRAMES / 4) + 63) / 64 * 64;
+            if count >= len {
+                dropped = self.count_valid();
+                *self = Self::new();
+                self.start = frame;
+            } else {
+                dropped = self.drop_front(count);
+            }
+        }
+        self.extend_to(frame + 1);
+        ((frame - self.start) as usize, dropped)
+    }
+
+    /// Extend the column in place so that it ends at `end`.
+    fn extend_to(&mut self, end: u32) {
+        let len = (end - self.start) as usize;
+        match &mut self.data {
+            ColumnData::Int(values) => values.resize(len, 0),
+            ColumnData::Float(values) => values.resize(len, 0.0),
+            ColumnData::Value(values) => values.resize(len, Value::Null),
+        }
+        self.valid.resize((len + 63) / 64, 0);
+    }
+
+    /// Remove the first `count` entries, where `count` is a multiple of 64 that is less than
+    /// the column's length.
+    ///
+    /// Returns the number of valid entries that were removed.
+    fn drop_front(&mut self, count: u32) -> usize {
+        let count = count as usize;
+        match &mut self.data {
+            ColumnData::Int(values) => {
+                values.drain(..count);
+            }
+            ColumnData::Float(values) => {
+                values.drain(..count);
+            }
+            ColumnData::Value(values) => {
+                for value in values.drain(..count) {
+                    self.heap_bytes -= value_heap_size(&value);
+                }
+            }
+        }
+        self.start += count as u32;
+        self.valid
+            .drain(..count / 64)
+            .map(|word| word.count_ones() as usize)
+            .sum()
+    }
+
+    /// Change the frame range of the column to `start..end`, keeping overlapping entries.
+    fn resize(&mut self, start: u32, end: u32) {
+        let len = end.saturating_sub(start) as usize;
+        let old_start = self.start;
+        let old_len = self.len();
+        let overlap_start = start.max(old_start);
+        let overlap_end = end.min(old_start + old_len);
+
+        let mut valid = vec![0u64; (len + 63) / 64];
+        let mut data = match &self.data {
+            ColumnData::Int(_) => ColumnData::Int(vec![0; len]),
+            ColumnData::Float(_) => ColumnData::Float(vec![0.0; len]),
+            ColumnData::Value(_) => ColumnData::Value(vec![Value::Null; len]),
+        };
+        for frame in overlap_start..overlap_end {
+            let old_index = (frame - old_start) as usize;
+            let new_index = (frame - start) as usize;
+            if self.valid[old_index / 64] & (1 << (old_index % 64)) != 0 {
+                valid[new_index / 64] |= 1 << (new_index % 64);
+            }
+            match (&mut data, &mut self.data) {
+                (ColumnData::Int(new), ColumnData::Int(old)) => new[new_index] = old[old_index],
+                (ColumnData::Float(new), ColumnData::Float(old)) => new[new_index] = old[old_index],
+                (ColumnData::Value(new), ColumnData::Value(old)) => {
+                    new[new_index] = mem::replace(&mut old[old_index], Value::Null)
+                }
+                _ => unreachable!(),
+            }
+        }
+
+        self.heap_bytes = match &data {
+            ColumnData::Value(values) => values.iter().map(value_heap_size).sum(),
+            _ => 0,
+        };
+        self.start = start;
+        self.data = data;
+        self.valid = valid;
+    }
+
+    /// Halve the column's frame range, keeping the entries closest to `frame`.
+    ///
+    /// Returns the number of valid entries that were dropped.
+    fn shrink_around(&mut self, frame: u32) -> usize {
+        let old_count = self.count_valid();
+        let len = (self.len() / 2).max(1);
+        let end = self.start + self.len();
+        let start = frame.saturating_sub(len / 2).max(self.start).min(end - len);
+        self.resize(start, start + len);
+        old_count - self.count_valid()
+    }
+
+    /// Return the number of valid entries.
+    fn count_valid(&self) -> usize {
+        self.valid
+            .iter()
+            .map(|word| word.count_ones() as usize)
+            .sum()
+    }
+
+    /// Remove the entries at and after `frame`, returning them as a new column if any are
+    /// valid.
+    ///
+    /// This takes time proportional to the number of removed entries.
+    fn split_off(&mut self, frame: u32) -> Option<Column> {
+        let len = self.len() as usize;
+        let index = (frame.saturating_sub(self.start) as usize).min(len);
+        if index == len {
+            return None;
+        }
+
+        let data = match &mut self.data {
+            ColumnData::Int(values) => ColumnData::Int(values.split_off(index)),
+            ColumnData::Float(values) => ColumnData::Float(values.split_off(index)),
+            ColumnData::Value(values) => ColumnData::Value(values.split_off(index)),
+        };
+        let heap_bytes = match &data {
+            ColumnData::Value(values) => values.iter().map(value_heap_size).sum(),
+            _ => 0,
+        };
+        self.heap_bytes -= heap_bytes;
+
+        let tail = Column {
+            start: self.start + index as u32,
+            data,
+            valid: split_off_bits(&mut self.valid, index, len),
+            heap_bytes,
+        };
+        self.shrink_if_sparse();
+        if tail.count_valid() == 0 {
+            None
+        } else {
+            Some(tail)
+        }
+    }
+
+    /// Remove the values on `frames`, returning the number of valid entries removed.
+    ///
+    /// A window that reaches the end of the column is truncated, and otherwise its entries
+    /// are marked invalid.
+    fn clear_range(&mut self, frames: Range<u32>) -> usize {
+        let end_frame = self.start + self.len();
+        let start = frames.start.max(self.start);
+        let end = frames.end.min(end_frame);
+        if start >= end {
+            return 0;
+        }
+        if end == end_frame {
+            return self.split_off(start).map_or(0, |tail| tail.count_valid());
+        }
+
+        let mut removed = 0;
+        for index in (start - self.start) as usize..(end - self.start) as usize {
+            let mask = 1 << (index % 64);
+            if self.valid[index / 64] & mask != 0 {
+                self.valid[index / 64] &= !mask;
+                removed += 1;
+                if let ColumnData::Value(values) = &mut self.data {
+                    self.heap_bytes -= value_heap_size(&values[index]);
+                    values[index] = Value::Null;
+                }
+            }
+        }
+        removed
+    }
+
+    /// Append the entries of `tail`, which must start at or after the column's end.
+    ///
+    /// The tail is returned if it overlaps the column, holds a different kind of entry, or
+    /// would make the column longer than `MAX_COLUMN_FRAMES`.
+    fn append(&mut self, tail: Column) -> Result<(), Column> {
+        if self.count_valid() == 0 {
+            *self = tail;
+            return Ok(());
+        }
+        if tail.start < self.end()
+            || tail.end() - self.start > MAX_COLUMN_FRAMES
+            || mem::discriminant(&self.data) != mem::discriminant(&tail.data)
+        {
+            return Err(tail);
+        }
+
+        self.extend_to(tail.start);
+        let offset = self.len() as usize;
+        let tail_len = tail.len() as usize;
+        match (&mut self.data, tail.data) {
+            (ColumnData::Int(values), ColumnData::Int(tail_values)) => values.extend(tail_values),
+            (ColumnData::Float(values), ColumnData::Float(tail_values)) => {
+                values.extend(tail_values)
+            }
+            (ColumnData::Value(values), ColumnData::Value(tail_values)) => {
+                values.extend(tail_values)
+            }
+            _ => unreachable!(),
+        }
+        self.heap_bytes += tail.heap_bytes;
+
+        self.valid.resize((offset + tail_len + 63) / 64, 0);
+        for tail_index in 0..tail_len {
+            if tail.valid[tail_index / 64] & (1 << (tail_index % 64)) != 0 {
+                let index = offset + tail_index;
+                self.valid[index / 64] |= 1 << (index % 64);
+            }
+        }
+        Ok(())
+    }
+
+    /// Return the valid entries along with their frames.
+    fn values(&self) -> impl Iterator<Item = (u32, Value)> + '_ {
+        (self.start..self.start + self.len())
+            .filter_map(move |frame| Some((frame, self.get(frame)?)))
+    }
+
+    /// Release unused capacity once it is well above the column's length, so that the
+    /// memory held by a column stays proportional to its `byte_size`.
+    ///
+    /// Only shrinking when less than a quarter of the capacity is used keeps the cost
+    /// amortized when a column is split and regrown repeatedly.
+    fn shrink_if_sparse(&mut self) {
+        let (len, capacity) = match &self.data {
+            ColumnData::Int(values) => (values.len(), values.capacity()),
+            ColumnData::Float(values) => (values.len(), values.capacity()),
+            ColumnData::Value(values) => (values.len(), values.capacity()),
+        };
+        if len < capacity / 4 {
+            match &mut self.data {
+                ColumnData::Int(values) => values.shrink_to_fit(),
+                ColumnData::Float(values) => values.shrink_to_fit(),
+                ColumnData::Value(values) => values.shrink_to_fit(),
+            }
+            self.valid.shrink_to_fit();
+        }
+    }
+
+    /// The number of bytes used by the column's entries.
+    ///
+    /// This counts entries rather than allocated capacity, so that the size only depends on
+    /// the column's frame range and not on how it grew or was split.
+    fn byte_size(&self) -> usize {
+        let data_size = match &self.data {
+            ColumnData::Int(values) => values.len() * mem::size_of::<i64>(),
+            ColumnData::Float(values) => values.len() * mem::size_of::<f64>(),
+            ColumnData::Value(values) => values.len() * mem::size_of::<Value>(),
+        };
+        data_size + self.valid.len() * mem::size_of::<u64>() + self.heap_bytes
+    }
+}
+
+/// Remove bits `index..len` from a bitmap, returning them as a new bitmap.
+fn split_off_bits(bits: &mut Vec<u64>, index: usize, len: usize) -> Vec<u64> {
+    let tail_len = len - index;
+    let shift = index % 64;
+    let mut tail: Vec<u64> = (index / 64..index / 64 + (tail_len + 63) / 64)
+        .map(|word| {
+            let high = match shift {
+                0 => 0,
+                _ => bits.get(word + 1).map_or(0, |&next| next << (64 - shift)),
+            };
+            bits[word] >> shift | high
+        })
+        .collect();
+    if tail_len % 64 != 0 {
+        if let Some(last) = tail.last_mut() {
+            *last &= (1 << (tail_len % 64)) - 1;
+        }
+    }
+
+    bits.truncate((index + 63) / 64);
+    if index % 64 != 0 {
+        if let Some(last) = bits.last_mut() {
+            *last &= (1 << (index % 64)) - 1;
         }
-        entries.deep_size_of()
+    }
+    tail
+}
+
+/// Estimate the heap memory owned by a value.
+fn value_heap_size(value: &Value) -> usize {
+    match value {
+        Value::String(string) => string.capacity(),
+        Value::Struct { fields } => fields
+            .iter()
+            .map(|(name, field)| {
+                mem::size_of::<(String, Value)>() + name.capacity() + value_heap_size(field)
+            })
+            .sum(),
+        Value::Array(elements) => elements
+            .iter()
+            .map(|element| mem::size_of::<Value>() + value_heap_size(element))
+            .sum(),
+        _ => 0,
     }
 }
 
-known_deep_size!(0, Value);
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use std::time::Instant;
+
+    fn int_at(column: &Column, frame: u32) -> Option<IntValue> {
+        match column.get(frame) {
+            Some(Value::Int(int)) => Some(int),
+            _ => None,
+        }
+    }
+
+    fn int_column(frames: Range<u32>) -> Column {
+        let mut column = Column::new();
+        for frame in frames {
+            column.insert(frame, Value::Int(frame.into()));
+        }
+        column
+    }
+
+    /// The size of the cache computed from scratch, which `byte_size` should always match.
+    fn accounted_size(cache: &DataCache) -> usize {
+        let columns: usize = cache
+            .columns
+            .iter()
+            .map(|(_, column)| column.byte_size())
+            .sum();
+        let stale: usize = cache.stale.values().map(Column::byte_size).sum();
+        columns + stale
+    }
+
+    fn cached_int(cache: &DataCache, path_key: usize, frame: u32) -> Option<IntValue> {
+        cache
+            .columns
+            .peek(&path_key)
+            .and_then(|column| int_at(column, frame))
+    }
+
+    #[test]
+    fn split_off_bits_within_word() {
+        let mut bits = vec![u64::MAX, u64::MAX, 0b101];
+        let tail = split_off_bits(&mut bits, 70, 131);
+
+        assert_eq!(bits, vec![u64::MAX, (1 << 6) - 1]);
+        assert_eq!(tail.len(), 1);
+        // Bits 70..128 were set, followed by bits 128 and 130
+        assert_eq!(tail[0], (1 << 58) - 1 | 1 << 58 | 1 << 60);
+    }
+
+    #[test]
+    fn split_off_bits_at_word_boundary() {
+        let mut bits = vec![1, 2, 3];
+        let tail = split_off_bits(&mut bits, 128, 192);
+
+        assert_eq!(bits, vec![1, 2]);
+        assert_eq!(tail, vec![3]);
+    }
+
+    #[test]
+    fn split_off_bits_empty_head() {
+        let mut bits = vec![0b1010];
+        let tail = split_off_bits(&mut bits, 0, 4);
+
+        assert!(bits.is_empty());
+        assert_eq!(tail, vec![0b1010]);
+    }
+
+    #[test]
+    fn column_split_off() {
+        let mut column = int_column(10..210);
+        let tail = column.split_off(150).unwrap();
+
+        assert_eq!(column.start, 10);
+        assert_eq!(column.end(), 150);
+        assert_eq!(column.count_valid(), 140);
+        assert_eq!(int_at(&column, 149), Some(149));
+        assert_eq!(int_at(&column, 150), None);
+
+        assert_eq!(tail.start, 150);
+        assert_eq!(tail.end(), 210);
+        assert_eq!(tail.count_valid(), 60);
+        assert_eq!(int_at(&tail, 150), Some(150));
+        assert_eq!(int_at(&tail, 209), Some(209));
+        assert_eq!(int_at(&tail, 149), None);
+    }
+
+    #[test]
+    fn column_split_off_outside_entries() {
+        let mut column = int_column(10..20);
+        assert!(column.split_off(20).is_none());
+        assert_eq!(column.end(), 20);
+
+        let tail = column.split_off(0).unwrap();
+        assert_eq!(column.len(), 0);
+        assert_eq!(tail.count_valid(), 10);
+    }
+
+    #[test]
+    fn column_split_off_invalid_tail() {
+        let mut column = int_column(0..100);
+        column.clear_range(50..99);
+        column.clear_range(99..100);
+        assert_eq!(column.end(), 99);
+
+        assert!(column.split_off(50).is_none());
+        assert_eq!(column.end(), 50);
+        assert_eq!(column.count_valid(), 50);
+    }
+
+    #[test]
+    fn column_split_off_moves_heap_bytes() {
+        let mut column = Column::new();
+        for frame in 0..10 {
+            column.insert(frame, Value::String("x".repeat(frame as usize + 1)));
+        }
+        let heap_bytes = column.heap_bytes;
+        let tail = column.split_off(6).unwrap();
+
+        let tail_heap_bytes: usize = tail
+            .values()
+            .map(|(_, value)| value_heap_size(&value))
+            .sum();
+        assert_eq!(tail.heap_bytes, tail_heap_bytes);
+        assert_eq!(column.heap_bytes + tail.heap_bytes, heap_bytes);
+    }
+
+    #[test]
+    fn column_clear_range_middle() {
+        let mut column = int_column(0..100);
+        let removed = column.clear_range(20..30);
+
+        assert_eq!(removed, 10);
+        assert_eq!(column.end(), 100);
+        assert_eq!(int_at(&column, 19), Some(19));
+        assert_eq!(int_at(&column, 20), None);
+        assert_eq!(int_at(&column, 29), None);
+        assert_eq!(int_at(&column, 30), Some(30));
+
+        // Clearing again finds nothing to remove
+        assert_eq!(column.clear_range(20..30), 0);
+    }
+
+    #[test]
+    fn column_clear_range_truncates_end() {
+        let mut column = int_column(0..100);
+        let removed = column.clear_range(80..200);
+
+        assert_eq!(removed, 20);
+        assert_eq!(column.end(), 80);
+        assert_eq!(column.count_valid(), 80);
+    }
+
+    #[test]
+    fn column_clear_range_outside_entries() {
+        let mut column = int_column(50..100);
+        assert_eq!(column.clear_range(0..50), 0);
+        assert_eq!(column.clear_range(100..150), 0);
+        assert_eq!(column.count_valid(), 50);
+    }
+
+    #[test]
+    fn column_clear_range_releases_heap_bytes() {
+        let mut column = Column::new();
+        for frame in 0..10 {
+            column.insert(frame, Value::String("abcd".to_owned()));
+        }
+        column.clear_range(2..5);
+
+        let heap_bytes: usize = column
+            .values()
+            .map(|(_, value)| value_heap_size(&value))
+            .sum();
+        assert_eq!(column.heap_bytes, heap_bytes);
+        assert_eq!(column.count_valid(), 7);
+    }
+
+    #[test]
+    fn revalidate_restores_invalidated_frames() {
+        let mut cache = DataCache::new(DEFAULT_DATA_CACHE_BUDGET);
+        for path_key in 0..2 {
+            for frame in 0..100 {
+                cache.insert_key(frame, path_key, Value::Int(frame.into()));
+            }
+        }
+
+        cache.invalidate_frame(50, 1);
+        assert_eq!(cached_int(&cache, 0, 49), Some(49));
+        assert_eq!(cached_int(&cache, 0, 50), None);
+        assert_eq!(cached_int(&cache, 1, 99), None);
+        assert_eq!(cache.byte_size(), accounted_size(&cache));
+
+        cache.revalidate(1, 0);
+        assert_eq!(cached_int(&cache, 0, 50), Some(50));
+        assert_eq!(cached_int(&cache, 1, 99), Some(99));
+        assert!(cache.stale.is_empty());
+        assert_eq!(cache.byte_size(), accounted_size(&cache));
+    }
+
+    #[test]
+    fn revalidate_from_converged_frame() {
+        let mut cache = DataCache::new(DEFAULT_DATA_CACHE_BUDGET);
+        for frame in 0..100 {
+            cache.insert_key(frame, 0, Value::Int(frame.into()));
+        }
+
+        cache.invalidate_frame(50, 1);
+        cache.revalidate(1, 70);
+        assert_eq!(cached_int(&cache, 0, 60), None);
+        assert_eq!(cached_int(&cache, 0, 70), Some(70));
+        assert_eq!(cached_int(&cache, 0, 99), Some(99));
+        assert_eq!(cache.byte_size(), accounted_size(&cache));
+    }
+
+    #[test]
+    fn revalidate_after_reload() {
+        let mut cache = DataCache::new(DEFAULT_DATA_CACHE_BUDGET);
+        for path_key in 0..2 {
+            for frame in 0..100 {
+                cache.insert_key(frame, path_key, Value::Int(frame.into()));
+            }
+        }
+
+        cache.invalidate_frame(50, 1);
+        for path_key in 0..2 {
+            for frame in 50..60 {
+                cache.insert_key(frame, path_key, Value::Int(1000 + IntValue::from(frame)));
+            }
+        }
+        // The first column's tail starts where it ends, and the second's overlaps it
+        cache.revalidate(1, 60);
+        assert_eq!(cached_int(&cache, 0, 59), Some(1059));
+        assert_eq!(cached_int(&cache, 0, 60), Some(60));
+        assert_eq!(cached_int(&cache, 0, 99), Some(99));
+        assert_eq!(cache.byte_size(), accounted_size(&cache));
+
+        cache.invalidate_frame(50, 2);
+        for frame in 50..60 {
+            cache.insert_key(frame, 0, Value::Int(2000 + IntValue::from(frame)));
+        }
+        cache.revalidate(2, 55);
+        assert_eq!(cached_int(&cache, 0, 54), Some(2054));
+        assert_eq!(cached_int(&cache, 0, 55), Some(1055));
+        assert_eq!(cached_int(&cache, 0, 99), Some(99));
+        assert_eq!(cache.byte_size(), accounted_size(&cache));
+    }
+
+    #[test]
+    fn column_append() {
+        let mut column = int_column(0..100);
+        let tail = column.split_off(70).unwrap();
+        column.clear_range(60..70);
+        assert_eq!(column.end(), 60);
+
+        column.append(tail).unwrap();
+        assert_eq!(column.end(), 100);
+        assert_eq!(column.count_valid(), 90);
+        assert_eq!(int_at(&column, 59), Some(59));
+        assert_eq!(int_at(&column, 60), None);
+        assert_eq!(int_at(&column, 70), Some(70));
+        assert_eq!(int_at(&column, 99), Some(99));
+    }
+
+    #[test]
+    fn column_append_rejects_overlap_and_mixed_kinds() {
+        let mut column = int_column(0..100);
+        let overlapping = int_column(90..110);
+        assert!(column.append(overlapping).is_err());
+
+        let mut floats = Column::new();
+        floats.insert(100, Value::Float(1.0));
+        assert!(column.append(floats).is_err());
+        assert_eq!(column.end(), 100);
+        assert_eq!(column.count_valid(), 100);
+    }
+
+    #[test]
+    fn revalidate_other_generation_is_ignored() {
+        let mut cache = DataCache::new(DEFAULT_DATA_CACHE_BUDGET);
+        for frame in 0..100 {
+            cache.insert_key(frame, 0, Value::Int(frame.into()));
+        }
+
+        cache.invalidate_frame(50, 1);
+        cache.revalidate(2, 0);
+        assert_eq!(cached_int(&cache, 0, 50), None);
+
+        cache.drop_generation(1);
+        cache.revalidate(1, 0);
+        assert_eq!(cached_int(&cache, 0, 50), None);
+        assert_eq!(cache.byte_size(), accounted_size(&cache));
+    }
+
+    #[test]
+    fn byte_size_tracks_columns_and_stale_data() {
+        let mut cache = DataCache::new(DEFAULT_DATA_CACHE_BUDGET);
+        for frame in 0..300 {
+            cache.insert_key(frame, 0, Value::Int(frame.into()));
+            cache.insert_key(frame, 1, Value::Float(frame.into()));
+            cache.insert_key(frame, 2, Value::String(frame.to_string()));
+        }
+        assert_eq!(cache.byte_size(), accounted_size(&cache));
+
+        cache.invalidate_frame(200, 1);
+        assert_eq!(cache.byte_size(), accounted_size(&cache));
+        cache.invalidate_frame(100, 2);
+        assert_eq!(cache.byte_size(), accounted_size(&cache));
+
+        cache.drop_frames(20..40);
+        assert_eq!(cache.byte_size(), accounted_size(&cache));
+        cache.drop_frames(90..1000);
+        assert_eq!(cache.byte_size(), accounted_size(&cache));
+
+        cache.revalidate(2, 0);
+        assert_eq!(cache.byte_size(), accounted_size(&cache));
+        cache.drop_generation(1);
+        assert_eq!(cache.byte_size(), accounted_size(&cache));
+    }
+
+    #[test]
+    fn byte_size_stays_within_budget() {
+        let budget = 64 * 1024;
+        let mut cache = DataCache::new(budget);
+        for path_key in 0..8 {
+            for frame in 0..5000 {
+                cache.insert_key(frame, path_key, Value::Int(frame.into()));
+            }
+        }
+        assert!(cache.byte_size() <= budget);
+        assert!(cache.stats().evictions > 0);
+        assert_eq!(cache.byte_size(), accounted_size(&cache));
+
+        cache.set_byte_budget(budget / 4);
+        assert!(cache.byte_size() <= budget / 4);
+        assert_eq!(cache.byte_size(), accounted_size(&cache));
+    }
+
+    /// Measure invalidation and reloading with 10k cached frames while a slider is dragged
+    /// back and forth, which edits the same frame repeatedly.
+    ///
+    /// Run with `cargo test --release -- --ignored --nocapture`.
+    #[test]
+    #[ignore]
+    fn bench_drag_updates() {
+        const NUM_FRAMES: u32 = 10_000;
+        const NUM_PATHS: usize = 20;
+        const NUM_UPDATES: usize = 1000;
+
+        let mut cache = DataCache::new(DEFAULT_DATA_CACHE_BUDGET);
+        for path_key in 0..NUM_PATHS {
+            for frame in 0..NUM_FRAMES {
+                cache.insert_key(frame, path_key, Value::Int(frame.into()));
+            }
+        }
+
+        let edited_frame = NUM_FRAMES / 2;
+        let start_time = Instant::now();
+        for generation in 1..=NUM_UPDATES {
+            cache.invalidate_frame(edited_frame, generation);
+            // Reload the visible rows after the edit
+            for path_key in 0..NUM_PATHS {
+                for frame in edited_frame..edited_frame + 30 {
+                    cache.insert_key(frame, path_key, Value::Int(generation as IntValue));
+                }
+            }
+            // Every other update returns to the previous value, restoring the stale data
+            if generation % 2 == 0 {
+                cache.revalidate(generation - 1, edited_frame + 30);
+            }
+            if generation > 2 {
+                cache.drop_generation(generation - 2);
+            }
+        }
+        let elapsed = start_time.elapsed();
+
+        assert_eq!(cache.byte_size(), accounted_size(&cache));
+        println!(
+            "{} drag updates over {} frames: {:?} per update, {} KB cached",
+            NUM_UPDATES,
+            NUM_FRAMES,
+            elapsed / NUM_UPDATES as u32,
+            cache.byte_size() / 1024,
+        );
+    }
+}
@@ -1,9 +1,15 @@
 //! The core abstraction for random access to frames in a simulation (rewinding etc).
 
+pub use archive::{SlotArchive, StableHasher};
+pub use data_cache::DataCacheStats;
+pub use replay::{EvictionPolicy, ReplayCost, TraceEvent};
+pub use slot_manager::{BalanceStats, RequestStats, SlotStorage};
 pub use state::*;
 pub use timeline_impl::*;
 
+mod archive;
 mod data_cache;
+mod replay;
 mod slot_manager;
 mod slot_state_impl;
 mod state;
@@ -0,0 +1,265 @@
+//! Offline replay of recorded frame requests, for comparing slot eviction policies.
+
+use super::slot_manager::{slot_utility, CostModel, Hotspot, HIT_DECAY};
+use derive_more::Display;
+use std::{collections::HashMap, ops::Range};
+
+/// The maximum number of events kept in a request trace.
+pub(super) const MAX_TRACE_EVENTS: usize = 1_000_000;
+
+/// Requests that advance at least this many frames leave a checkpoint at the requested frame.
+const CHECKPOINT_DISTANCE: u32 = 16;
+
+/// The seed for `EvictionPolicy::Random`, fixed so that replays are reproducible.
+const RANDOM_SEED: u64 = 0x9e37_79b9_7f4a_7c15;
+
+/// An event recorded by `SlotManager::start_request_trace`.
+#[derive(Debug, Clone, PartialEq)]
+pub enum TraceEvent {
+    /// Each frame in the range was requested in order, starting with a request for the
+    /// first frame.
+    Request(Range<u32>),
+    /// A hotspot was set.
+    SetHotspot {
+        /// The name of the hotspot.
+        name: String,
+        /// The window of frames covered by the hotspot.
+        frames: Range<u32>,
+        /// The weight of the hotspot.
+        weight: f32,
+    },
+    /// A hotspot was deleted.
+    DeleteHotspot(String),
+    /// Frames at and after the given frame were invalidated by an edit.
+    Invalidate(u32),
+}
+
+/// A rule for choosing which valid slot to evict when all slots are in use.
+#[derive(Debug, Display, Clone, Copy, PartialEq, Eq)]
+pub enum EvictionPolicy {
+    /// Evict the slot with the lowest expected utility, as `SlotManager` does.
+    #[display(fmt = "utility")]
+    Utility,
+    /// Evict a slot chosen uniformly at random. This is the policy that utility-based
+    /// eviction replaced.
+    #[display(fmt = "random")]
+    Random,
+    /// Evict the slot furthest from any hotspot, with distances scaled down for hotspots
+    /// with higher weights.
+    #[display(fmt = "hotspot-distance")]
+    HotspotDistance,
+    /// Evict the least recently used slot.
+    #[display(fmt = "lru")]
+    LeastRecentlyUsed,
+}
+
+impl EvictionPolicy {
+    /// Every policy, for comparing them against each other.
+    pub const ALL: [EvictionPolicy; 4] = [
+        EvictionPolicy::Utility,
+        EvictionPolicy::Random,
+        EvictionPolicy::HotspotDistance,
+        EvictionPolicy::LeastRecentlyUsed,
+    ];
+}
+
+/// The simulated work done while replaying a trace.
+#[derive(Debug, Clone, Copy, Default, PartialEq)]
+pub struct ReplayCost {
+    /// The number of frame advances.
+    pub advances: usize,
+    /// The number of slot copies.
+    pub copies: usize,
+    /// The estimated time in seconds, based on the measured cost of copies and advances.
+    pub time: f64,
+}
+
+#[derive(Debug)]
+struct SimSlot {
+    frame: u32,
+    hits: f64,
+    last_used: usize,
+}
+
+/// A simplified model of a `SlotManager` that only tracks which frames its slots hold.
+#[derive(Debug)]
+struct Simulation<'a> {
+    num_slots: usize,
+    policy: EvictionPolicy,
+    costs: &'a CostModel,
+    slots: Vec<SimSlot>,
+    base: Option<u32>,
+    hotspots: HashMap<String, Hotspot>,
+    time: usize,
+    cost: ReplayCost,
+    /// The state of the xorshift generator used by `EvictionPolicy::Random`.
+    rng_state: u64,
+}
+
+/// Replay `trace` using `num_slots` backup slots and the given eviction policy, returning
+/// the work that serving its requests would take.
+///
+/// Each request is served from the base slot or the cheapest slot before it, as estimated
+/// by `costs`. Requests that advance at least `CHECKPOINT_DISTANCE` frames save a slot at
+/// the requested frame, evicting a slot chosen by `policy` if all of them are in use.
+///
+/// This doesn't model housekeeping, so the absolute numbers are not comparable to a live
+/// timeline, but the same trace can be replayed under different policies to compare them.
+pub(super) fn replay_trace(
+    trace: &[TraceEvent],
+    num_slots: usize,
+    policy: EvictionPolicy,
+    costs: &CostModel,
+) -> ReplayCost {
+    let mut simulation = Simulation {
+        num_slots,
+        policy,
+        costs,
+        slots: Vec::new(),
+        base: None,
+        hotspots: HashMap::new(),
+        time: 0,
+        cost: ReplayCost::default(),
+        rng_state: RANDOM_SEED,
+    };
+    for event in trace {
+        match event {
+            TraceEvent::Request(frames) => simulation.request(frames.clone()),
+            TraceEvent::SetHotspot {
+                name,
+                frames,
+                weight,
+            } => {
+                simulation
+                    .hotspots
+                    .insert(name.clone(), Hotspot::new(frames.clone(), *weight));
+            }
+            TraceEvent::DeleteHotspot(name) => {
+                simulation.hotspots.remove(name);
+            }
+            TraceEvent::Invalidate(frame) => simulation.invalidate(*frame),
+        }
+    }
+    simulation.cost.time = costs.cost(
+        simulation.cost.copies as u32,
+        simulation.cost.advances as u32,
+    );
+    simulation.cost
+}
+
+impl Simulation<'_> {
+    fn request(&mut self, frames: Range<u32>) {
+        if frames.start >= frames.end {
+            return;
+        }
+        let frame = frames.start;
+        self.time += 1;
+        for slot in &mut self.slots {
+            slot.hits *= HIT_DECAY;
+        }
+
+        if self.base != Some(frame) {
+            let nearest = self
+                .slots
+                .iter()
+                .enumerate()
+                .filter(|(_, slot)| slot.frame <= frame)
+                .max_by_key(|(_, slot)| slot.frame)
+                .map(|(index, slot)| (index, slot.frame));
+            // The power-on slot is always available
+            let copy_frame = nearest.map_or(0, |(_, slot_frame)| slot_frame);
+
+            let advances = match self.base {
+                Some(base_frame)
+                    if base_frame <= frame
+                        && self.costs.cost(0, frame - base_frame)
+                            <= self.costs.cost(1, frame - copy_frame) =>
+                {
+                    frame - base_frame
+                }
+                _ => {
+                    self.cost.copies += 1;
+                    if let Some((index, _)) = nearest {
+                        self.slots[index].hits += 1.0;
+                        self.slots[index].last_used = self.time;
+                    }
+                    frame - copy_frame
+                }
+            };
+            self.cost.advances += advances as usize;
+
+            if advances >= CHECKPOINT_DISTANCE {
+                self.save(frame);
+            }
+        }
+
+        self.cost.advances += (frames.end - frames.start - 1) as usize;
+        self.base = Some(frames.end - 1);
+    }
+
+    fn save(&mut self, frame: u32) {
+        let slot = SimSlot {
+            frame,
+            hits: 0.0,
+            last_used: self.time,
+        };
+        if self.slots.len() < self.num_slots {
+            self.slots.push(slot);
+        } else if let Some(index) = self.eviction_candidate() {
+            self.slots[index] = slot;
+        }
+    }
+
+    fn eviction_candidate(&mut self) -> Option<usize> {
+        let slots = self.slots.iter().enumerate();
+        match self.policy {
+            EvictionPolicy::Random => match self.slots.len() {
+                0 => None,
+                len => Some((self.next_random() % len as u64) as usize),
+            },
+            EvictionPolicy::Utility => {
+                let mut valid_frames: Vec<u32> = self.slots.iter().map(|slot| slot.frame).collect();
+                valid_frames.sort_unstable();
+                slots
+                    .map(|(index, slot)| {
+                        let utility = slot_utility(
+                            slot.hits,
+                            slot.frame,
+                            &valid_frames,
+                            &self.hotspots,
+                            self.costs,
+                        );
+                        (utility, index)
+                    })
+                    .min_by(|(utility1, _), (utility2, _)| utility1.partial_cmp(utility2).unwrap())
+                    .map(|(_, index)| index)
+            }
+            EvictionPolicy::HotspotDistance => slots
+                .max_by_key(|(_, slot)| {
+                    self.hotspots
+                        .values()
+                        .map(|hotspot| hotspot.weighted_distance(slot.frame))
+                        .min()
+                        .unwrap_or(0)
+                })
+                .map(|(index, _)| index),
+            EvictionPolicy::LeastRecentlyUsed => slots
+                .min_by_key(|(_, slot)| slot.last_used)
+                .map(|(index, _)| index),
+        }
+    }
+
+    fn next_random(&mut self) -> u64 {
+        self.rng_state ^= self.rng_state << 13;
+        self.rng_state ^= self.rng_state >> 7;
+        self.rng_state ^= self.rng_state << 17;
+        self.rng_state
+    }
+
+    fn invalidate(&mut self, invalidated_frame: u32) {
+        self.slots.retain(|slot| slot.frame < invalidated_frame);
+        if self.base.map_or(false, |frame| frame >= invalidated_frame) {
+            self.base = None;
+        }
+    }
+}
@@ -1,13 +1,20 @@
 //! Implementation of timeline algorithm.
 
-use super::{slot_state_impl::SlotStateImpl, Controller, SlotState, SlotStateMut};
-use crate::{error::Error, memory::Memory};
-use itertools::{iproduct, Itertools};
-use rand::seq::SliceRandom;
+use super::{
+    replay::{self, EvictionPolicy, ReplayCost, TraceEvent, MAX_TRACE_EVENTS},
+    slot_state_impl::SlotStateImpl,
+    Controller, SlotArchive, SlotState, SlotStateMut,
+};
+use crate::{
+    error::Error,
+    memory::{Address, Memory},
+};
+use itertools::Itertools;
 use std::{
     cell::{RefCell, RefMut},
     collections::{HashMap, HashSet},
-    iter,
+    io, iter, mem,
+    ops::Range,
     time::{Duration, Instant},
 };
 
@@ -17,6 +24,14 @@ struct SlotWrapper<S> {
     index: SlotIndex,
     slot: S,
     is_base: bool,
+    /// Whether the slot holds a full copy that delta slots can be stored against.
+    is_keyframe: bool,
+    /// Whether the slot was compressed using `Memory::compress_slot`.
+    ///
+    /// Compressed slots must be copied to the base slot before they can be read.
+    is_compressed: bool,
+    /// A decaying count of the requests that started from this slot.
+    hits: f64,
     frame: Frame,
 }
 
@@ -31,6 +46,125 @@ enum Frame {
     PowerOn,
     /// The slot's contents are unknown or invalid.
     Unknown,
+    /// The slot held the data for `frame` before an edit invalidated it.
+    ///
+    /// The slot becomes valid again if the simulation converges to the same state.
+    Stale {
+        frame: u32,
+        /// The `StaleGeneration` that the slot was invalidated in.
+        generation: usize,
+    },
+}
+
+/// A group of slots that were invalidated by the same edit.
+#[derive(Debug, Clone, Copy)]
+struct StaleGeneration {
+    id: usize,
+    /// The `Controller::edits_hash` of the edits that the slots were valid for.
+    edits_hash: Option<u64>,
+    /// The frame after the last frame whose edits may differ between the stale slots and the
+    /// current edits.
+    edited_end: u32,
+}
+
+/// How backup slots store their contents.
+#[derive(Debug, Clone, Copy, PartialEq, Eq)]
+pub enum SlotStorage {
+    /// Every backup slot holds a full copy of slot memory.
+    Full,
+    /// Backup slots hold a page diff against a nearby keyframe slot.
+    ///
+    /// A backup becomes a new keyframe when there is no keyframe within `keyframe_interval`
+    /// frames before it.
+    Delta {
+        /// The maximum distance between a delta slot and its keyframe.
+        keyframe_interval: u32,
+    },
+}
+
+/// A window of frames that should be fast to access.
+#[derive(Debug, Clone, Copy, PartialEq)]
+pub(super) struct Hotspot {
+    /// The first frame in the window.
+    start: u32,
+    /// The frame after the last frame in the window.
+    end: u32,
+    /// How often the window is accessed relative to other hotspots.
+    weight: f32,
+}
+
+impl Hotspot {
+    pub(super) fn new(frames: Range<u32>, weight: f32) -> Self {
+        Self {
+            start: frames.start,
+            end: frames.end.max(frames.start + 1),
+            weight,
+        }
+    }
+
+    /// The number of frames between `frame` and the window.
+    fn distance(&self, frame: u32) -> u32 {
+        if frame < self.start {
+            self.start - frame
+        } else if frame >= self.end {
+            frame - (self.end - 1)
+        } else {
+            0
+        }
+    }
+
+    /// The distance to the window, scaled down for hotspots that are accessed more often.
+    pub(super) fn weighted_distance(&self, frame: u32) -> i64 {
+        (self.distance(frame) as f64 / self.weight.max(f32::EPSILON) as f64) as i64
+    }
+}
+
+/// A summary of the work done by one call to `SlotManager::balance_distribution`.
+#[derive(Debug, Clone, Copy, Default, PartialEq, Eq)]
+pub struct BalanceStats {
+    /// The number of slots that were saved at a new target frame.
+    pub slots_placed: usize,
+    /// The number of target frames that got no slot, because every slot was in use by
+    /// another target frame.
+    pub slots_unplaced: usize,
+    /// The number of slots that were compressed.
+    pub slots_compressed: usize,
+    /// The number of frame advances.
+    pub advances: usize,
+    /// The number of slot copies.
+    pub copies: usize,
+}
+
+/// Measurements of the slot copying done to serve frame requests.
+#[derive(Debug, Clone, Copy, Default, PartialEq, Eq)]
+pub struct RequestStats {
+    /// The number of frames requested.
+    pub requests: usize,
+    /// The total number of bytes that slot copies covered while serving the requests, i.e.
+    /// the bytes they would have moved without skipping unchanged pages.
+    pub bytes_requested: usize,
+    /// The total number of bytes that slot copies moved while serving the requests.
+    pub bytes_copied: usize,
+    /// The largest number of bytes moved while serving a single request.
+    pub max_bytes_copied: usize,
+}
+
+impl RequestStats {
+    fn record(&mut self, bytes_requested: usize, bytes_copied: usize) {
+        self.requests += 1;
+        self.bytes_requested += bytes_requested;
+        self.bytes_copied += bytes_copied;
+        self.max_bytes_copied = self.max_bytes_copied.max(bytes_copied);
+    }
+}
+
+/// Checkpoints that were invalidated by an edit and are being recreated in the background.
+#[derive(Debug)]
+struct Refill {
+    /// The frames that still need a checkpoint, from last to first.
+    pending: Vec<u32>,
+    /// The number of frames in the refill when it started.
+    total: usize,
 }
 
 /// Container to keep track of allocated slots and their contents.
@@ -44,6 +178,71 @@ struct Slots<M: Memory> {
     num_advances: usize,
     /// Debug stat counting number of slot copies.
     num_copies: usize,
+    /// Bytes copied per request since the last call to `SlotManager::take_request_stats`.
+    request_stats: RequestStats,
+    /// Measured costs used to choose between slots.
+    costs: CostModel,
+    /// Snapshots on disk that act as additional read-only slots.
+    archive: Option<SlotArchive>,
+    /// Generations of stale slots that can still become valid.
+    stale_generations: Vec<StaleGeneration>,
+    next_generation: usize,
+    /// Generations that converged since the last call to `SlotManager::take_converged`,
+    /// along with the frame that they converged on.
+    converged: Vec<(usize, u32)>,
+    /// Generations that were forgotten since the last call to
+    /// `SlotManager::take_dropped_generations`, and so can no longer become valid.
+    dropped_generations: Vec<usize>,
+    /// Whether slot data taken from the program instance at each address can be loaded
+    /// into this one, as determined by `check_relocation`.
+    relocation_checks: HashMap<Address, bool>,
+    /// Whether frames are being requested in increasing order, e.g. during forward playback.
+    sequential: bool,
+    /// The events recorded since `SlotManager::start_request_trace`, if tracing.
+    trace: Option<Vec<TraceEvent>>,
+}
+
+/// Online estimates of the time taken by a slot copy and a frame advance.
+///
+/// Each estimate is an exponential moving average of measured run times.
+#[derive(Debug, Clone, Copy)]
+pub(super) struct CostModel {
+    /// Estimated time in seconds to copy a slot into the base slot.
+    copy: f64,
+    /// Estimated time in seconds to advance the base slot one frame.
+    advance: f64,
+}
+
+impl CostModel {
+    /// Weight given to each new sample.
+    const SMOOTHING: f64 = 0.05;
+
+    fn new() -> Self {
+        // Start with the ratio of the former hardcoded cost function until measurements
+        // are available
+        Self {
+            copy: 0.01,
+            advance: 0.001,
+        }
+    }
+
+    fn record_copy(&mut self, duration: Duration) {
+        self.copy += Self::SMOOTHING * (duration.as_secs_f64() - self.copy);
+    }
+
+    fn record_advance(&mut self, duration: Duration) {
+        self.advance += Self::SMOOTHING * (duration.as_secs_f64() - self.advance);
+    }
+
+    /// The estimated time to perform the given number of copies and frame advances.
+    pub(super) fn cost(&self, copies: u32, updates: u32) -> f64 {
+        copies as f64 * self.copy + updates as f64 * self.advance
+    }
+
+    /// The number of frame advances that take as long as a single copy.
+    fn copy_ratio(&self) -> f64 {
+        self.copy / self.advance.max(f64::EPSILON)
+    }
 }
 
 #[derive(Debug, Clone, Copy, PartialEq, Eq, Hash)]
@@ -54,6 +253,15 @@ enum SlotIndex {
 }
 
 impl<M: Memory> Slots<M> {
+    /// Add an event to the request trace, if one is being recorded.
+    fn record(&mut self, event: TraceEvent) {
+        if let Some(trace) = &mut self.trace {
+            if trace.len() < MAX_TRACE_EVENTS {
+                trace.push(event);
+            }
+        }
+    }
+
     fn get(&self, index: SlotIndex) -> &SlotWrapper<M::Slot> {
         match index {
             SlotIndex::PowerOn => &self.power_on,
@@ -81,6 +289,31 @@ impl<M: Memory> Slots<M> {
     fn iter_mut(&mut self) -> impl Iterator<Item = &mut SlotWrapper<M::Slot>> {
         iter::once(&mut self.base).chain(self.backups.iter_mut())
     }
+
+    /// Allocate a new backup slot and return its index.
+    fn push_backup(&mut self, slot: M::Slot) -> SlotIndex {
+        let index = SlotIndex::Backup(self.backups.len());
+        self.backups.push(SlotWrapper {
+            index,
+            slot,
+            is_base: false,
+            is_keyframe: false,
+            is_compressed: false,
+            hits: 0.0,
+            frame: Frame::Unknown,
+        });
+        index
+    }
+
+    /// Free the backup slot with the given index.
+    ///
+    /// The last backup slot takes the index of the removed slot.
+    fn remove_backup(&mut self, index: usize) {
+        self.backups.swap_remove(index);
+        if let Some(moved_slot) = self.backups.get_mut(index) {
+            moved_slot.index = SlotIndex::Backup(index);
+        }
+    }
 }
 
 fn copy_slot<M: Memory>(
@@ -97,13 +330,77 @@ fn copy_slot<M: Memory>(
             (dst, src)
         };
 
+        let start_time = Instant::now();
         memory.copy_slot(&mut dst.slot, &src.slot)?;
         dst.frame = src.frame;
+        dst.is_compressed = false;
+        // Decompression would skew the estimate for regular copies
+        if !src.is_compressed {
+            slots.costs.record_copy(start_time.elapsed());
+        }
         slots.num_copies = slots.num_copies.wrapping_add(1);
     }
     Ok(())
 }
 
+/// Copy a slot into a backup slot, storing it as a diff against a keyframe if possible.
+///
+/// In delta storage mode, the nearest keyframe at most `keyframe_interval` frames before the
+/// source frame is used. If there is none, the backup becomes a new keyframe.
+fn save_slot<M: Memory>(
+    memory: &M,
+    storage: SlotStorage,
+    slots: &mut Slots<M>,
+    dst_index: SlotIndex,
+    src_index: SlotIndex,
+) -> Result<(), Error> {
+    let keyframe_interval = match storage {
+        SlotStorage::Full => return copy_slot(memory, slots, dst_index, src_index),
+        SlotStorage::Delta { keyframe_interval } => keyframe_interval,
+    };
+    if dst_index == src_index {
+        return Ok(());
+    }
+
+    let src_frame = match slots.get(src_index).frame {
+        Frame::At(frame) => frame,
+        _ => 0,
+    };
+    let keyframe_index: Option<SlotIndex> = slots
+        .backups
+        .iter()
+        .filter(|slot| slot.is_keyframe && !slot.is_compressed && slot.index != dst_index)
+        .filter_map(|slot| match slot.frame {
+            Frame::At(frame) if frame <= src_frame && src_frame - frame < keyframe_interval => {
+                Some((frame, slot.index))
+            }
+            _ => None,
+        })
+        .max_by_key(|(frame, _)| *frame)
+        .map(|(_, index)| index);
+
+    let (dst, src, keyframe) = unsafe {
+        let src = slots.get(src_index) as *const _;
+        let keyframe = keyframe_index.map(|index| slots.get(index) as *const _);
+        let dst = slots.get_mut(dst_index);
+        let src: &SlotWrapper<_> = &*src;
+        let keyframe: Option<&SlotWrapper<_>> = keyframe.map(|keyframe| &*keyframe);
+        (dst, src, keyframe)
+    };
+
+    memory.copy_slot_delta(
+        &mut dst.slot,
+        &src.slot,
+        keyframe.map(|keyframe| &keyframe.slot),
+    )?;
+    dst.frame = src.frame;
+    dst.is_keyframe = keyframe.is_none();
+    dst.is_compressed = false;
+    dst.hits = 0.0;
+    slots.num_copies = slots.num_copies.wrapping_add(1);
+    Ok(())
+}
+
 /// Advance the base slot's frame and apply controller edits.
 ///
 /// The base slot's frame must not equal Frame::Unknown.
@@ -120,11 +417,13 @@ fn advance_frame<M: Memory, C: Controller<M>>(
             new_frame = 0;
         }
         Frame::At(frame) => {
+            let start_time = Instant::now();
             memory.advance_base_slot(&mut base.slot)?;
+            slots.costs.record_advance(start_time.elapsed());
             new_frame = frame + 1;
             slots.num_advances = slots.num_advances.wrapping_add(1);
         }
-        _ => panic!("base.frame = Frame::Unknown"),
+        _ => panic!("base.frame = {:?}", base.frame),
     };
 
     base.frame = Frame::At(new_frame);
@@ -134,9 +433,210 @@ fn advance_frame<M: Memory, C: Controller<M>>(
         slot: &mut base.slot,
     })?;
 
+    check_convergence(memory, slots)?;
+    Ok(())
+}
+
+/// Compare the base slot to the stale slots on the same frame, and revalidate the stale
+/// generation that it matches.
+///
+/// A generation can only converge once the base slot is past the frames whose edits differ,
+/// since otherwise its later slots would still be affected by the edits.
+fn check_convergence<M: Memory>(memory: &M, slots: &mut Slots<M>) -> Result<(), Error> {
+    if slots.stale_generations.is_empty() {
+        return Ok(());
+    }
+    let base_frame = match slots.base.frame {
+        Frame::At(frame) => frame,
+        _ => return Ok(()),
+    };
+
+    let stale_generations = &slots.stale_generations;
+    let candidates: Vec<(SlotIndex, usize)> = slots
+        .backups
+        .iter()
+        .filter_map(|slot| match slot.frame {
+            Frame::Stale { frame, generation } if frame == base_frame => {
+                Some((slot.index, generation))
+            }
+            _ => None,
+        })
+        .filter(|(_, generation)| {
+            stale_generations.iter().any(|stale_generation| {
+                stale_generation.id == *generation
+                    && stale_generation.edited_end <= base_frame.saturating_add(1)
+            })
+        })
+        .collect();
+    if candidates.is_empty() {
+        return Ok(());
+    }
+
+    let base_fingerprint = memory.slot_fingerprint(&slots.base.slot)?;
+    for (index, generation) in candidates {
+        if memory.slot_fingerprint(&slots.get(index).slot)? == base_fingerprint {
+            for slot in slots.backups.iter_mut() {
+                if let Frame::Stale {
+                    frame,
+                    generation: slot_generation,
+                } = slot.frame
+                {
+                    if slot_generation == generation && frame >= base_frame {
+                        slot.frame = Frame::At(frame);
+                    }
+                }
+            }
+            slots.converged.push((generation, base_frame));
+        }
+    }
     Ok(())
 }
 
+/// Save the state in the base slot to a backup slot, returning the backup's index.
+///
+/// An existing uncompressed backup on the same frame is reused. Otherwise the backup with the
+/// least expected value is overwritten. Returns None if the base slot doesn't hold a frame or
+/// there are no backup slots.
+fn save_base_slot<M: Memory>(
+    memory: &M,
+    storage: SlotStorage,
+    slots: &mut Slots<M>,
+    hotspots: &HashMap<String, Hotspot>,
+) -> Result<Option<SlotIndex>, Error> {
+    let base_frame = match slots.base.frame {
+        frame @ Frame::At(_) => frame,
+        _ => return Ok(None),
+    };
+    let existing = slots
+        .backups
+        .iter()
+        .find(|slot| slot.frame == base_frame && !slot.is_compressed);
+    if let Some(slot) = existing {
+        return Ok(Some(slot.index));
+    }
+
+    match eviction_candidate(slots, hotspots, EvictionLevel::Valid, |_| true) {
+        Some(dest_slot) => {
+            save_slot(memory, storage, slots, dest_slot, SlotIndex::Base)?;
+            Ok(Some(dest_slot))
+        }
+        None => Ok(None),
+    }
+}
+
+/// Load the latest archived state after `start_frame` and at or before `requested_frame`
+/// into the base slot.
+///
+/// Returns false if there is no such state or if loading it isn't expected to be faster
+/// than `max_cost`.
+fn load_archived_slot<M: Memory, C: Controller<M>>(
+    memory: &M,
+    controller: &C,
+    slots: &mut Slots<M>,
+    start_frame: u32,
+    requested_frame: u32,
+    max_cost: f64,
+) -> Result<bool, Error> {
+    let archive = match &slots.archive {
+        Some(archive) if start_frame < requested_frame => archive,
+        _ => return Ok(false),
+    };
+    // Archived data that can't be relocated would need to be simulated anyway
+    let archived = archive
+        .frames_in(start_frame + 1, requested_frame)
+        .take_while(|&frame| slots.costs.cost(1, requested_frame - frame) < max_cost)
+        .find_map(|frame| {
+            let edits_hash = controller.edits_hash(frame)?;
+            let data = archive.get(frame, edits_hash)?;
+            let address = memory.slot_data_address(&data).ok()?;
+            if is_relocation_trusted(memory, slots, address) {
+                Some((frame, data))
+            } else {
+                None
+            }
+        });
+
+    match archived {
+        Some((frame, data)) => {
+            load_slot_data(memory, controller, slots, frame, &data)?;
+            Ok(true)
+        }
+        None => Ok(false),
+    }
+}
+
+/// Return true if slot data taken from the program instance at `address` can be loaded
+/// without simulating it.
+///
+/// This is the case if the data doesn't need to be relocated, or if `check_relocation`
+/// succeeded for that instance.
+fn is_relocation_trusted<M: Memory>(memory: &M, slots: &Slots<M>, address: Address) -> bool {
+    address == memory.base_address() || slots.relocation_checks.get(&address) == Some(&true)
+}
+
+/// Check whether slot data from another instance of the program can be relocated into this
+/// one, given the power-on state of that instance as returned by `Memory::slot_data`.
+///
+/// Relocation can corrupt values that look like pointers. The power-on states of the two
+/// instances are only equal if relocation restores every word, which makes it likely that
+/// later states are restored as well. The result is remembered for later loads from the
+/// same instance. The base slot is left at power-on.
+fn check_relocation<M: Memory>(
+    memory: &M,
+    slots: &mut Slots<M>,
+    power_on_data: &[u8],
+) -> Result<bool, Error> {
+    let address = memory.slot_data_address(power_on_data)?;
+    if is_relocation_trusted(memory, slots, address) {
+        return Ok(true);
+    }
+    if let Some(&valid) = slots.relocation_checks.get(&address) {
+        return Ok(valid);
+    }
+
+    memory.load_slot_data(&mut slots.base.slot, power_on_data)?;
+    slots.base.frame = Frame::Unknown;
+    let valid = memory.slot_fingerprint(&slots.base.slot)?
+        == memory.slot_fingerprint(&slots.power_on.slot)?;
+    copy_slot(memory, slots, SlotIndex::Base, SlotIndex::PowerOn)?;
+
+    slots.relocation_checks.insert(address, valid);
+    Ok(valid)
+}
+
+/// Load data returned by `Memory::slot_data` into the base slot as the state on `frame`.
+///
+/// If the data comes from another instance of the program that `check_relocation` hasn't
+/// succeeded for, the frame is simulated from power-on instead. Either way the base slot
+/// ends up holding the state on `frame`.
+fn load_slot_data<M: Memory, C: Controller<M>>(
+    memory: &M,
+    controller: &C,
+    slots: &mut Slots<M>,
+    frame: u32,
+    data: &[u8],
+) -> Result<(), Error> {
+    let address = memory.slot_data_address(data)?;
+    if !is_relocation_trusted(memory, slots, address) {
+        copy_slot(memory, slots, SlotIndex::Base, SlotIndex::PowerOn)?;
+        while slots.base.frame != Frame::At(frame) {
+            advance_frame(memory, controller, slots)?;
+        }
+        return Ok(());
+    }
+
+    let start_time = Instant::now();
+    memory.load_slot_data(&mut slots.base.slot, data)?;
+    slots.base.frame = Frame::At(frame);
+    slots.num_copies = slots.num_copies.wrapping_add(1);
+    slots.costs.record_copy(start_time.elapsed());
+    Ok(())
+}
+
+/// Load the requested frame into a slot, returning its index.
+///
+/// The number of bytes covered and copied to serve the request is recorded in the slots'
+/// request stats.
 fn request_frame<M: Memory, C: Controller<M>>(
     memory: &M,
     controller: &C,
@@ -144,13 +644,45 @@ fn request_frame<M: Memory, C: Controller<M>>(
     requested_frame: u32,
     require_base: bool,
 ) -> Result<SlotIndex, Error> {
+    let start_bytes_requested = memory.num_bytes_requested();
+    let start_bytes_copied = memory.num_bytes_copied();
+    let result = load_frame(memory, controller, slots, requested_frame, require_base);
+    slots.request_stats.record(
+        memory
+            .num_bytes_requested()
+            .wrapping_sub(start_bytes_requested),
+        memory.num_bytes_copied().wrapping_sub(start_bytes_copied),
+    );
+    result
+}
+
+fn load_frame<M: Memory, C: Controller<M>>(
+    memory: &M,
+    controller: &C,
+    slots: &mut Slots<M>,
+    requested_frame: u32,
+    require_base: bool,
+) -> Result<SlotIndex, Error> {
+    // Fast path for playback: advance the base slot in place without considering other slots
+    if slots.sequential {
+        if let Frame::At(base_frame) = slots.base.frame {
+            if base_frame <= requested_frame && requested_frame - base_frame <= MAX_SEQUENTIAL_STEP
+            {
+                while slots.base.frame != Frame::At(requested_frame) {
+                    advance_frame(memory, controller, slots)?;
+                }
+                return Ok(SlotIndex::Base);
+            }
+        }
+    }
+
     // Function to compute the number of copies and updates that would be required to reach
     // the requested frame from a given slot
     let work_from = |slot: &SlotWrapper<M::Slot>| -> (u32, u32) {
         let slot_frame = match slot.frame {
             Frame::At(frame) => frame,
             Frame::PowerOn => 0,
-            Frame::Unknown => unimplemented!(),
+            Frame::Unknown | Frame::Stale { .. } => unimplemented!(),
         };
         if slot_frame == requested_frame {
             return (0, 0);
@@ -162,9 +694,10 @@ fn request_frame<M: Memory, C: Controller<M>>(
     };
 
     // Computes an approximate time cost of updating a slot to the requested frame
-    let cost_from = |slot: &SlotWrapper<M::Slot>| -> u32 {
+    let costs = slots.costs;
+    let cost_from = |slot: &SlotWrapper<M::Slot>| -> f64 {
         let (copies, updates) = work_from(slot);
-        10 * copies + updates
+        costs.cost(copies, updates)
     };
 
     // Find the slot with the lowest cost
@@ -173,30 +706,295 @@ fn request_frame<M: Memory, C: Controller<M>>(
         .filter(|slot| match slot.frame {
             Frame::At(frame) => frame <= requested_frame,
             Frame::PowerOn => true,
-            Frame::Unknown => false,
+            Frame::Unknown | Frame::Stale { .. } => false,
         })
-        .min_by_key(|slot| cost_from(slot))
+        .min_by(|slot1, slot2| cost_from(slot1).partial_cmp(&cost_from(slot2)).unwrap())
         .unwrap(); // power_on_slot is always included
 
     // Fast path (avoids a copy when nearest_slot is not the base slot)
-    let use_nearest_slot =
-        nearest_slot.frame == Frame::At(requested_frame) && (!require_base || nearest_slot.is_base);
+    let use_nearest_slot = nearest_slot.frame == Frame::At(requested_frame)
+        && (!require_base || nearest_slot.is_base)
+        && !nearest_slot.is_compressed;
 
+    let nearest_slot_index = nearest_slot.index;
     let result_slot = if use_nearest_slot {
-        nearest_slot
+        slots.get_mut(nearest_slot_index).hits += 1.0;
+        nearest_slot_index
     } else {
-        // Copy to base slot
-        let nearest_slot_index = nearest_slot.index;
-        copy_slot(memory, slots, SlotIndex::Base, nearest_slot_index)?;
+        // Copy to base slot, unless there is a closer state in the archive
+        let nearest_slot_frame = match nearest_slot.frame {
+            Frame::At(frame) => frame,
+            _ => 0,
+        };
+        let nearest_slot_cost = cost_from(nearest_slot);
+        if !load_archived_slot(
+            memory,
+            controller,
+            slots,
+            nearest_slot_frame,
+            requested_frame,
+            nearest_slot_cost,
+        )? {
+            copy_slot(memory, slots, SlotIndex::Base, nearest_slot_index)?;
+            slots.get_mut(nearest_slot_index).hits += 1.0;
+        }
 
         // Advance base slot to requested frame
         while slots.base.frame != Frame::At(requested_frame) {
             advance_frame(memory, controller, slots)?;
         }
-        &slots.base
+        SlotIndex::Base
     };
 
-    Ok(result_slot.index)
+    Ok(result_slot)
+}
+
+/// The furthest ahead of the base slot that a request can be during playback and still be
+/// served by advancing the base slot in place.
+const MAX_SEQUENTIAL_STEP: u32 = 16;
+
+/// The interval between checkpoints saved from the base slot during forward playback.
+const PLAYBACK_CHECKPOINT_INTERVAL: u32 = 120;
+
+/// The factor that slot hit counts are multiplied by on each call to `balance_distribution`.
+pub(super) const HIT_DECAY: f64 = 0.99;
+
+/// The distance in frames at which a hotspot contributes half of its weight to the demand
+/// for a slot.
+const HOTSPOT_DEMAND_SCALE: f64 = 100.0;
+
+/// The expected time saved by keeping a valid backup slot at `frame`.
+///
+/// Without the slot, requests that it would serve advance from the previous valid slot
+/// instead, so each one costs the frames between the two slots. The demand for the slot
+/// combines `hits`, the slot's recent hits, with the weighted proximity of each hotspot.
+///
+/// `valid_frames` is the sorted list of frames held by valid slots.
+pub(super) fn slot_utility(
+    hits: f64,
+    frame: u32,
+    valid_frames: &[u32],
+    hotspots: &HashMap<String, Hotspot>,
+    costs: &CostModel,
+) -> f64 {
+    let position = match valid_frames.binary_search(&frame) {
+        Ok(position) | Err(position) => position,
+    };
+    let prev_frame = position
+        .checked_sub(1)
+        .map_or(0, |position| valid_frames[position]);
+    let saved_cost = costs.cost(0, frame.saturating_sub(prev_frame));
+
+    let demand = hits
+        + hotspots
+            .values()
+            .map(|hotspot| {
+                hotspot.weight as f64 * HOTSPOT_DEMAND_SCALE
+                    / (HOTSPOT_DEMAND_SCALE + hotspot.distance(frame) as f64)
+            })
+            .sum::<f64>();
+    demand * saved_cost
+}
+
+/// The kinds of backup slot that may be overwritten when choosing a destination slot.
+#[derive(Debug, Clone, Copy, PartialEq, Eq, PartialOrd, Ord)]
+enum EvictionLevel {
+    /// Only slots that don't hold any state.
+    Invalid,
+    /// Invalid slots and stale slots.
+    Stale,
+    /// Any slot.
+    Valid,
+}
+
+/// Choose a backup slot to evict among those accepted by `is_available`.
+///
+/// Invalid slots are chosen first. If `level` allows it, the least recently invalidated
+/// stale slot is chosen next, followed by the valid slot with the lowest `slot_utility`.
+fn eviction_candidate<M: Memory>(
+    slots: &Slots<M>,
+    hotspots: &HashMap<String, Hotspot>,
+    level: EvictionLevel,
+    is_available: impl Fn(SlotIndex) -> bool,
+) -> Option<SlotIndex> {
+    let available = || slots.backups.iter().filter(|slot| is_available(slot.index));
+
+    if let Some(slot) = available().find(|slot| slot.frame == Frame::Unknown) {
+        return Some(slot.index);
+    }
+    if level < EvictionLevel::Stale {
+        return None;
+    }
+    let oldest_stale = available()
+        .filter_map(|slot| match slot.frame {
+            Frame::Stale { generation, .. } => Some((generation, slot.index)),
+            _ => None,
+        })
+        .min_by_key(|(generation, _)| *generation);
+    if let Some((_, index)) = oldest_stale {
+        return Some(index);
+    }
+    if level < EvictionLevel::Valid {
+        return None;
+    }
+
+    let valid_frames: Vec<u32> = slots
+        .iter()
+        .filter(|slot| !slot.is_base)
+        .filter_map(|slot| match slot.frame {
+            Frame::At(frame) => Some(frame),
+            Frame::PowerOn => Some(0),
+            Frame::Unknown | Frame::Stale { .. } => None,
+        })
+        .sorted()
+        .collect();
+    available()
+        .filter_map(|slot| match slot.frame {
+            Frame::At(frame) => Some((
+                slot_utility(slot.hits, frame, &valid_frames, hotspots, &slots.costs),
+                slot.index,
+            )),
+            _ => None,
+        })
+        .min_by(|(utility1, _), (utility2, _)| utility1.partial_cmp(utility2).unwrap())
+        .map(|(_, index)| index)
+}
+
+/// The minimum distance between archived states with the same edits.
+const ARCHIVE_INTERVAL: u32 = 3000;
+
+/// The maximum number of stale generations to keep, in case their edits are restored.
+const MAX_STALE_GENERATIONS: usize = 16;
+
+/// Slots at least this many frames from every hotspot are compressed.
+///
+/// This covers the slots placed at the coarsest alignments, which are rarely copied from.
+const COLD_SLOT_DISTANCE: u32 = 1000;
+
+/// Upper bound on the number of backup slots, regardless of the memory budget.
+const MAX_BACKUP_SLOTS: usize = 4096;
+
+/// The coarsest alignment used for placing slots around a hotspot.
+const MAX_ALIGNMENT: u32 = 14005;
+
+/// Return up to `levels` alignments, starting with 1 and then growing geometrically from
+/// `min_alignment` to `MAX_ALIGNMENT`.
+///
+/// Slots are placed at each hotspot rounded down to each alignment, so more levels give
+/// denser coverage behind the hotspot. Spacing slots closer than the number of frame
+/// advances that a copy costs is wasteful, so `min_alignment` should be based on that.
+fn alignment_ladder(levels: usize, min_alignment: f64) -> Vec<u32> {
+    let min_alignment = min_alignment.max(2.0).min(MAX_ALIGNMENT as f64);
+    let ratio = match levels {
+        0..=2 => 1.0,
+        _ => (MAX_ALIGNMENT as f64 / min_alignment).powf(1.0 / (levels - 2) as f64),
+    };
+    iter::once(1)
+        .chain(
+            (0..levels.saturating_sub(1))
+                .map(|level| (min_alignment * ratio.powi(level as i32)).round() as u32),
+        )
+        .dedup()
+        .collect()
+}
+
+/// The minimum spacing between slots placed within a hotspot's window.
+const MIN_WINDOW_SPACING: u32 = 4;
+
+/// The maximum number of slots per hotspot used for reverse playback checkpoints.
+const MAX_REVERSE_CHECKPOINTS: usize = 32;
+
+/// The binomial coefficient `n choose k`, saturating at `u32::MAX`.
+fn binomial(n: usize, k: usize) -> u64 {
+    let mut result: u64 = 1;
+    for i in 1..=k.min(n - k) as u64 {
+        result = result * (n as u64 - i + 1) / i;
+        if result >= u32::MAX as u64 {
+            return u32::MAX as u64;
+        }
+    }
+    result
+}
+
+/// Return checkpoint frames for playing backward from `end` to `start` using at most
+/// `checkpoints` slots, assuming that a slot is already available at `start`.
+///
+/// This follows the binomial checkpointing schedule used by revolve: with `s` checkpoints,
+/// `binomial(s + t, s)` frames can be reversed while advancing each frame at most `t` times.
+/// Each checkpoint is placed as early as possible while leaving a range that the remaining
+/// checkpoints can reverse with the same number of advances per frame. The checkpoints are
+/// therefore dense near `end` and sparse near `start`.
+fn reverse_checkpoints(start: u32, end: u32, checkpoints: usize) -> Vec<u32> {
+    if checkpoints == 0 || end <= start + 1 {
+        return Vec::new();
+    }
+    let length = (end - start) as u64;
+    let repetitions = (1..)
+        .find(|&t| binomial(checkpoints + t, checkpoints) >= length)
+        .unwrap();
+
+    let mut frames = Vec::new();
+    let mut position = start;
+    for remaining in (0..checkpoints).rev() {
+        if end <= position + 1 {
+            break;
+        }
+        let remaining_length = binomial(remaining + repetitions, remaining) as u32;
+        position = end.saturating_sub(remaining_length).max(position + 1);
+        frames.push(position);
+    }
+    frames
+}
+
+/// Checkpoints placed for playing backward through a hotspot.
+#[derive(Debug, Clone)]
+struct ReverseSchedule {
+    /// The frame of the slot that the schedule starts from.
+    start: u32,
+    /// The latest playhead position that the schedule covers.
+    end: u32,
+    /// The number of checkpoints that the schedule may use.
+    checkpoints: usize,
+    /// The checkpoint frames, in increasing order.
+    frames: Vec<u32>,
+}
+
+impl ReverseSchedule {
+    fn new(start: u32, end: u32, checkpoints: usize) -> Self {
+        Self {
+            start,
+            end,
+            checkpoints,
+            frames: reverse_checkpoints(start, end, checkpoints),
+        }
+    }
+
+    /// Update the schedule for a playhead that moved to `playhead`.
+    ///
+    /// As in revolve, once the playhead moves back past a checkpoint, that checkpoint's slot
+    /// is reused to schedule the range between the playhead and the closest remaining
+    /// checkpoint. Returns false if the schedule doesn't cover the playhead, in which case
+    /// a new schedule should be started.
+    fn advance(&mut self, playhead: u32, checkpoints: usize) -> bool {
+        if playhead > self.end || playhead <= self.start || checkpoints != self.checkpoints {
+            return false;
+        }
+        let kept = self
+            .frames
+            .iter()
+            .take_while(|&&frame| frame < playhead)
+            .count();
+        if kept < self.frames.len() {
+            self.frames.truncate(kept);
+            let segment_start = self.frames.last().copied().unwrap_or(self.start);
+            self.frames.extend(reverse_checkpoints(
+                segment_start,
+                playhead,
+                checkpoints - kept,
+            ));
+        }
+        true
+    }
 }
 
 #[derive(Debug)]
@@ -208,7 +1006,21 @@ pub struct SlotManager<M: Memory, C: Controller<M>> {
     /// Since conceptually these are mostly used a cache of the state on various frames,
     /// we use interior mutability.
     slots: RefCell<Slots<M>>,
-    hotspots: HashMap<String, u32>,
+    storage: SlotStorage,
+    /// The maximum number of bytes that backup slots should use.
+    ///
+    /// This is lowered below `max_slot_memory_budget` while the system is low on memory.
+    slot_memory_budget: usize,
+    /// The budget that was given when the manager was created.
+    max_slot_memory_budget: usize,
+    /// The number of bytes used by a full backup slot.
+    full_slot_bytes: usize,
+    hotspots: HashMap<String, Hotspot>,
+    /// The current playback speed, where negative values mean playing backward.
+    play_speed: f32,
+    /// Checkpoint schedules for playing backward, by hotspot name.
+    reverse_schedules: HashMap<String, ReverseSchedule>,
+    refill: Option<Refill>,
 }
 
 impl<M: Memory, C: Controller<M>> SlotManager<M, C> {
@@ -216,35 +1028,31 @@ impl<M: Memory, C: Controller<M>> SlotManager<M, C> {
         memory: M,
         base_slot: M::Slot,
         controller: C,
-        num_backup_slots: usize,
+        slot_memory_budget: usize,
+        storage: SlotStorage,
     ) -> Result<Self, Error> {
         let base_slot = SlotWrapper {
             index: SlotIndex::Base,
             slot: base_slot,
             is_base: true,
+            is_keyframe: false,
+            is_compressed: false,
+            hits: 0.0,
             frame: Frame::PowerOn,
         };
 
+        let bytes_before_power_on = memory.backup_slot_bytes();
         let mut power_on_slot = SlotWrapper {
             index: SlotIndex::PowerOn,
             slot: memory.create_backup_slot()?,
             is_base: false,
+            is_keyframe: false,
+            is_compressed: false,
+            hits: 0.0,
             frame: Frame::PowerOn,
         };
         memory.copy_slot(&mut power_on_slot.slot, &base_slot.slot)?;
-
-        let backup_slots: Vec<_> = iter::repeat_with(|| memory.create_backup_slot())
-            .take(num_backup_slots)
-            .collect::<Result<Vec<M::Slot>, Error>>()?
-            .into_iter()
-            .enumerate()
-            .map(|(index, slot)| SlotWrapper {
-                index: SlotIndex::Backup(index),
-                slot,
-                is_base: false,
-                frame: Frame::Unknown,
-            })
-            .collect();
+        let full_slot_bytes = memory.backup_slot_bytes() - bytes_before_power_on;
 
         Ok(Self {
             memory,
@@ -252,11 +1060,28 @@ impl<M: Memory, C: Controller<M>> SlotManager<M, C> {
             slots: RefCell::new(Slots {
                 power_on: power_on_slot,
                 base: base_slot,
-                backups: backup_slots,
+                backups: Vec::new(),
                 num_advances: 0,
                 num_copies: 0,
+                request_stats: RequestStats::default(),
+                costs: CostModel::new(),
+                archive: None,
+                stale_generations: Vec::new(),
+                next_generation: 0,
+                converged: Vec::new(),
+                dropped_generations: Vec::new(),
+                relocation_checks: HashMap::new(),
+                sequential: false,
+                trace: None,
             }),
+            storage,
+            slot_memory_budget,
+            max_slot_memory_budget: slot_memory_budget,
+            full_slot_bytes,
             hotspots: HashMap::new(),
+            play_speed: 0.0,
+            reverse_schedules: HashMap::new(),
+            refill: None,
         })
     }
 
@@ -281,6 +1106,7 @@ impl<M: Memory, C: Controller<M>> SlotManager<M, C> {
             .try_borrow_mut()
             .expect("only one state can be requested at a time");
 
+        slots.record(TraceEvent::Request(frame..frame + 1));
         let slot_index = request_frame(
             &self.memory,
             &self.controller,
@@ -309,6 +1135,7 @@ impl<M: Memory, C: Controller<M>> SlotManager<M, C> {
     ) -> Result<impl SlotStateMut<Memory = M> + 'a, Error> {
         let slots = self.slots.get_mut();
 
+        slots.record(TraceEvent::Request(frame..frame + 1));
         let slot_index = request_frame(&self.memory, &self.controller, slots, frame, require_base)?;
 
         let slot_wrapper = slots.get_mut(slot_index);
@@ -340,25 +1167,169 @@ impl<M: Memory, C: Controller<M>> SlotManager<M, C> {
         self.slot_state_mut(frame, true)
     }
 
-    /// Perform housekeeping to keep the hotspots fast to scroll near.
-    pub fn balance_distribution(&mut self, max_run_time: Duration) -> Result<(), Error> {
+    /// Call `func` with the state of each frame in `frames`, in order.
+    ///
+    /// The first frame is requested as usual, and then the base slot is advanced through the
+    /// rest of the range.
+    ///
+    /// During forward playback the base slot is at the playhead, and the next request is
+    /// expected to advance it in place. So it is saved to a backup slot before the range
+    /// moves it, and restored afterward.
+    pub fn for_each_frame(
+        &self,
+        frames: Range<u32>,
+        mut func: impl FnMut(&SlotStateImpl<'_, M, &mut M::Slot>) -> Result<(), Error>,
+    ) -> Result<(), Error> {
+        if frames.is_empty() {
+            return Ok(());
+        }
+        let mut slots = self
+            .slots
+            .try_borrow_mut()
+            .expect("only one state can be requested at a time");
+
+        slots.record(TraceEvent::Request(frames.clone()));
+        let moves_base = slots.base.frame != Frame::At(frames.start) || frames.len() > 1;
+        let playhead_slot = if slots.sequential && moves_base {
+            save_base_slot(&self.memory, self.storage, &mut slots, &self.hotspots)?
+        } else {
+            None
+        };
+
+        request_frame(
+            &self.memory,
+            &self.controller,
+            &mut slots,
+            frames.start,
+            true,
+        )?;
+        for frame in frames.clone() {
+            if frame != frames.start {
+                advance_frame(&self.memory, &self.controller, &mut slots)?;
+            }
+            assert!(slots.base.frame == Frame::At(frame));
+            func(&SlotStateImpl {
+                memory: &self.memory,
+                frame,
+                slot: &mut slots.base.slot,
+            })?;
+        }
+
+        if let Some(playhead_slot) = playhead_slot {
+            copy_slot(&self.memory, &mut slots, SlotIndex::Base, playhead_slot)?;
+        }
+        Ok(())
+    }
+
+    /// Return the expected number of bytes that one more backup slot would use.
+    fn expected_slot_bytes(&self) -> usize {
+        let slots = self.slots.borrow();
+        match self.storage {
+            SlotStorage::Delta { .. } if !slots.backups.is_empty() => {
+                // Power-on slot is included in backup_slot_bytes
+                let backup_bytes = self
+                    .memory
+                    .backup_slot_bytes()
+                    .saturating_sub(self.full_slot_bytes);
+                (backup_bytes / slots.backups.len()).max(1)
+            }
+            _ => self.full_slot_bytes.max(1),
+        }
+    }
+
+    /// Allocate a new backup slot if it fits in the memory budget.
+    fn try_grow(&mut self) -> Result<Option<SlotIndex>, Error> {
+        let expected_bytes = self.memory.backup_slot_bytes() + self.expected_slot_bytes();
+        if expected_bytes > self.slot_memory_budget {
+            return Ok(None);
+        }
+        let slot = match self.storage {
+            SlotStorage::Full => self.memory.create_backup_slot()?,
+            SlotStorage::Delta { .. } => self.memory.create_delta_slot()?,
+        };
+        Ok(Some(self.slots.get_mut().push_backup(slot)))
+    }
+
+    /// Free backup slots until the memory budget is met.
+    ///
+    /// Invalid slots are freed first, followed by stale slots from oldest to newest, and then
+    /// the slots furthest from any hotspot.
+    fn shrink_to_budget(&mut self) {
         let slots = self.slots.get_mut();
+        while self.memory.backup_slot_bytes() > self.slot_memory_budget && !slots.backups.is_empty()
+        {
+            match eviction_candidate(slots, &self.hotspots, EvictionLevel::Valid, |_| true) {
+                Some(SlotIndex::Backup(index)) => slots.remove_backup(index),
+                _ => break,
+            }
+        }
+    }
 
+    /// Lower the memory budget so that at least `reserve_bytes` of physical memory stays
+    /// available to the rest of the system.
+    ///
+    /// `available_bytes` is the physical memory that is currently available. Backup slots
+    /// that no longer fit are freed immediately. The budget never exceeds the one given to
+    /// `new`, and goes back up to it once memory is available again.
+    pub fn reserve_memory(&mut self, available_bytes: usize, reserve_bytes: usize) {
+        let backup_bytes = self.memory.backup_slot_bytes();
+        let headroom_budget = (backup_bytes + available_bytes).saturating_sub(reserve_bytes);
+        self.slot_memory_budget = self.max_slot_memory_budget.min(headroom_budget);
+        self.shrink_to_budget();
+    }
+
+    /// Perform housekeeping to keep the hotspots fast to scroll near.
+    ///
+    /// The backup slots that fit in the memory budget are divided between hotspots in
+    /// proportion to their weights. Slots are allocated and freed as needed.
+    ///
+    /// Frames in a window are assumed to be accessed uniformly, so the expected number of
+    /// advances is minimized by spacing part of a hotspot's slots evenly through its window.
+    /// The rest are placed at `alignment_ladder` positions before the window, which keeps
+    /// the frames leading up to it cheap to reach.
+    ///
+    /// While playing backward, part of each hotspot's slots are instead placed using
+    /// `reverse_checkpoints` between the end of the window and the closest earlier slot.
+    /// The schedule is updated as the playhead moves back past its checkpoints, so that
+    /// freed slots are reused for the range still ahead of the playhead.
+    /// While playing forward, the base slot is left to advance in place, and is only saved
+    /// to a backup every `PLAYBACK_CHECKPOINT_INTERVAL` frames. Range reads and preloads
+    /// return the base slot to the playhead afterward (see `for_each_frame`), so the
+    /// playhead doesn't need slots of its own.
+    ///
+    /// No new work is started once `max_run_time` has elapsed.
+    pub fn balance_distribution(&mut self, max_run_time: Duration) -> Result<BalanceStats, Error> {
         let start_time = Instant::now();
+        let (start_advances, start_copies) = {
+            let slots = self.slots.get_mut();
+            (slots.num_advances, slots.num_copies)
+        };
+        let mut stats = BalanceStats::default();
 
-        let alignments = vec![1, 15, 40, 145, 410, 1505, 4010, 14005];
-        let target_frames: Vec<u32> = iproduct!(self.hotspots.values(), alignments.iter())
-            .map(|(hotspot, alignment)| hotspot - (hotspot % alignment))
-            .sorted()
-            .dedup()
-            .collect();
+        for slot in self.slots.get_mut().iter_mut() {
+            slot.hits *= HIT_DECAY;
+        }
+
+        // Placing target frames would move the base slot away from the playback position, so
+        // during forward playback only checkpoints of the base slot are saved
+        let target_frames = if self.slots.get_mut().sequential {
+            if self.save_playback_checkpoint()? {
+                stats.slots_placed += 1;
+            }
+            Vec::new()
+        } else {
+            self.target_frames()
+        };
 
         let mut used_slots: HashSet<SlotIndex> = HashSet::new();
         for target_frame in target_frames {
-            if start_time.elapsed() > max_run_time {
+            if start_time.elapsed() > max_run_time
+                || self.memory.backup_slot_bytes() > self.slot_memory_budget
+            {
                 break;
             }
 
+            let slots = self.slots.get_mut();
             let matching_slot: Option<&SlotWrapper<M::Slot>> = slots
                 .iter()
                 .find(|slot| !slot.is_base && slot.frame == Frame::At(target_frame));
@@ -369,25 +1340,362 @@ impl<M: Memory, C: Controller<M>> SlotManager<M, C> {
 
             let source_slot =
                 request_frame(&self.memory, &self.controller, slots, target_frame, false)?;
-            let available_slots: Vec<SlotIndex> = slots
-                .iter_mut()
-                .filter(|slot| {
-                    !slot.is_base && slot.index != source_slot && !used_slots.contains(&slot.index)
-                })
-                .map(|slot| slot.index)
-                .collect();
-            let dest_slot = available_slots.choose(&mut rand::thread_rng()).cloned();
+            let dest_slot =
+                self.choose_dest_slot(source_slot, &used_slots, EvictionLevel::Valid)?;
 
+            let slots = self.slots.get_mut();
             match dest_slot {
-                Some(dest_slot) => copy_slot(&self.memory, slots, dest_slot, source_slot)?,
-                None => eprintln!("Using suboptimal number of slots"), // TODO: Logger
+                Some(dest_slot) => {
+                    save_slot(&self.memory, self.storage, slots, dest_slot, source_slot)?;
+                    used_slots.insert(dest_slot);
+                    stats.slots_placed += 1;
+                }
+                None => stats.slots_unplaced += 1,
             }
-            // TODO: Add dest_slot to used_slots?
         }
 
+        self.archive_slots(start_time, max_run_time)?;
+        stats.slots_compressed = self.compress_cold_slots(start_time, max_run_time)?;
+        self.shrink_to_budget();
+
+        let slots = self.slots.get_mut();
+        stats.advances = slots.num_advances.wrapping_sub(start_advances);
+        stats.copies = slots.num_copies.wrapping_sub(start_copies);
+        Ok(stats)
+    }
+
+    /// Return the frames that backup slots should be placed at, in increasing order.
+    fn target_frames(&mut self) -> Vec<u32> {
+        let affordable_slots =
+            (self.slot_memory_budget / self.expected_slot_bytes()).min(MAX_BACKUP_SLOTS);
+        let total_weight: f32 = self.hotspots.values().map(|hotspot| hotspot.weight).sum();
+
+        let slots = self.slots.get_mut();
+        let copy_ratio = slots.costs.copy_ratio();
+        let hotspots = &self.hotspots;
+        self.reverse_schedules
+            .retain(|name, _| hotspots.contains_key(name));
+
+        let mut target_frames: Vec<u32> = Vec::new();
+        for (name, hotspot) in hotspots {
+            let mut levels =
+                ((affordable_slots as f32 * hotspot.weight / total_weight) as usize).max(1);
+
+            if self.play_speed < 0.0 {
+                let num_checkpoints = (levels / 2).min(MAX_REVERSE_CHECKPOINTS);
+                levels -= num_checkpoints;
+
+                // The schedule follows the playhead at the end of the window
+                let playhead = hotspot.end - 1;
+                let schedule = self.reverse_schedules.get_mut(name);
+                let is_current = schedule.map_or(false, |schedule| {
+                    schedule.advance(playhead, num_checkpoints)
+                });
+                if !is_current {
+                    let start = slots
+                        .iter()
+                        .filter(|slot| !slot.is_base)
+                        .filter_map(|slot| match slot.frame {
+                            Frame::At(frame) if frame < playhead => Some(frame),
+                            _ => None,
+                        })
+                        .max()
+                        .unwrap_or(0);
+                    self.reverse_schedules.insert(
+                        name.clone(),
+                        ReverseSchedule::new(start, playhead, num_checkpoints),
+                    );
+                }
+                target_frames.extend(&self.reverse_schedules[name].frames);
+            }
+
+            // Spacing is a function of the window length only, so the slots stay in place
+            // while the window scrolls
+            let window_len = hotspot.end - hotspot.start;
+            let num_window_slots = (levels / 2).min((window_len / MIN_WINDOW_SPACING) as usize);
+            if num_window_slots > 0 {
+                levels -= num_window_slots;
+                let spacing = (window_len + num_window_slots as u32 - 1) / num_window_slots as u32;
+                let first = hotspot.start - hotspot.start % spacing;
+                target_frames.extend((first..hotspot.end).step_by(spacing as usize));
+            }
+
+            target_frames.extend(
+                alignment_ladder(levels, copy_ratio)
+                    .into_iter()
+                    .map(|alignment| hotspot.start - hotspot.start % alignment),
+            );
+        }
+        target_frames.into_iter().sorted().dedup().collect()
+    }
+
+    /// Save the base slot to a backup if playback has moved far enough past the last
+    /// checkpoint, returning true if it was saved.
+    ///
+    /// The base slot is only copied from, so playback can continue advancing it in place.
+    fn save_playback_checkpoint(&mut self) -> Result<bool, Error> {
+        let slots = self.slots.get_mut();
+        let base_frame = match slots.base.frame {
+            Frame::At(frame) => frame,
+            _ => return Ok(false),
+        };
+        let has_recent_checkpoint = slots.iter().any(|slot| match slot.frame {
+            Frame::At(frame) => {
+                !slot.is_base
+                    && frame <= base_frame
+                    && base_frame - frame < PLAYBACK_CHECKPOINT_INTERVAL
+            }
+            _ => false,
+        });
+        if has_recent_checkpoint {
+            return Ok(false);
+        }
+
+        match self.choose_dest_slot(SlotIndex::Base, &HashSet::new(), EvictionLevel::Valid)? {
+            Some(dest_slot) => {
+                save_slot(
+                    &self.memory,
+                    self.storage,
+                    self.slots.get_mut(),
+                    dest_slot,
+                    SlotIndex::Base,
+                )?;
+                Ok(true)
+            }
+            None => Ok(false),
+        }
+    }
+
+    /// Choose a backup slot to save `source_slot` into, excluding `used_slots`.
+    ///
+    /// Invalid slots are preferred, and otherwise a new slot is allocated if it fits in the
+    /// memory budget. Stale slots are kept in case their edits are restored, so they (and
+    /// then valid slots) are only overwritten after that, as allowed by `level`.
+    fn choose_dest_slot(
+        &mut self,
+        source_slot: SlotIndex,
+        used_slots: &HashSet<SlotIndex>,
+        level: EvictionLevel,
+    ) -> Result<Option<SlotIndex>, Error> {
+        let is_available = |index: SlotIndex| index != source_slot && !used_slots.contains(&index);
+
+        let dest_slot = eviction_candidate(
+            self.slots.get_mut(),
+            &self.hotspots,
+            EvictionLevel::Invalid,
+            is_available,
+        );
+        if dest_slot.is_some() {
+            return Ok(dest_slot);
+        }
+        if let Some(dest_slot) = self.try_grow()? {
+            return Ok(Some(dest_slot));
+        }
+        if level > EvictionLevel::Invalid {
+            return Ok(eviction_candidate(
+                self.slots.get_mut(),
+                &self.hotspots,
+                level,
+                is_available,
+            ));
+        }
+        Ok(None)
+    }
+
+    /// Recreate checkpoints that were invalidated by the last edits, until `max_run_time` has
+    /// elapsed.
+    ///
+    /// The checkpoints are recreated from first to last, so the base slot only needs to be
+    /// advanced forward between them. Checkpoints are only saved into invalid slots or new
+    /// slots within the memory budget. Once neither is available the refill pauses, and it
+    /// continues on a later call if memory has been freed. Valid and stale slots are never
+    /// overwritten, so that undoing the edits can reuse the stale states.
+    ///
+    /// `func` is called with the state of each saved frame, and its run time counts toward
+    /// `max_run_time`.
+    pub fn refill(
+        &mut self,
+        max_run_time: Duration,
+        mut func: impl FnMut(&SlotStateImpl<'_, M, &mut M::Slot>),
+    ) -> Result<(), Error> {
+        let start_time = Instant::now();
+
+        while start_time.elapsed() <= max_run_time {
+            let target_frame = match self.refill.as_mut().and_then(|refill| refill.pending.pop()) {
+                Some(frame) => frame,
+                None => {
+                    self.refill = None;
+                    break;
+                }
+            };
+
+            let slots = self.slots.get_mut();
+            let is_valid = slots
+                .iter()
+                .any(|slot| !slot.is_base && slot.frame == Frame::At(target_frame));
+            if is_valid {
+                continue;
+            }
+
+            // Check before simulating the frame, and keep it for when memory is freed
+            if !self.can_refill() {
+                if let Some(refill) = &mut self.refill {
+                    refill.pending.push(target_frame);
+                }
+                break;
+            }
+
+            let slots = self.slots.get_mut();
+            let source_slot =
+                request_frame(&self.memory, &self.controller, slots, target_frame, false)?;
+            let dest_slot = match self.choose_dest_slot(
+                source_slot,
+                &HashSet::new(),
+                EvictionLevel::Invalid,
+            )? {
+                Some(dest_slot) if self.memory.backup_slot_bytes() <= self.slot_memory_budget => {
+                    dest_slot
+                }
+                _ => {
+                    if let Some(refill) = &mut self.refill {
+                        refill.pending.push(target_frame);
+                    }
+                    break;
+                }
+            };
+            save_slot(
+                &self.memory,
+                self.storage,
+                self.slots.get_mut(),
+                dest_slot,
+                source_slot,
+            )?;
+            func(&SlotStateImpl {
+                memory: &self.memory,
+                frame: target_frame,
+                slot: &mut self.slots.get_mut().get_mut(source_slot).slot,
+            });
+        }
+
+        Ok(())
+    }
+
+    /// Return true if a refilled checkpoint can be saved without overwriting a valid or
+    /// stale slot.
+    fn can_refill(&self) -> bool {
+        let backup_bytes = self.memory.backup_slot_bytes();
+        let has_invalid_slot = self
+            .slots
+            .borrow()
+            .backups
+            .iter()
+            .any(|slot| slot.frame == Frame::Unknown);
+        backup_bytes <= self.slot_memory_budget
+            && (has_invalid_slot
+                || backup_bytes + self.expected_slot_bytes() <= self.slot_memory_budget)
+    }
+
+    /// Return the fraction of the current refill that is complete, or None if no refill is
+    /// in progress.
+    pub fn refill_progress(&self) -> Option<f32> {
+        self.refill
+            .as_ref()
+            .map(|refill| 1.0 - refill.pending.len() as f32 / refill.total.max(1) as f32)
+    }
+
+    /// Stop recreating invalidated checkpoints.
+    pub fn cancel_refill(&mut self) {
+        self.refill = None;
+    }
+
+    /// Save backup slots to the archive so that later sessions can start from them, until
+    /// `max_run_time` has elapsed since `start_time`.
+    ///
+    /// A slot is archived if there is no archived state with the current edits within
+    /// `ARCHIVE_INTERVAL` frames before it. Snapshots are taken from existing backup slots
+    /// during housekeeping, so that advancing the base slot is never held up by them.
+    fn archive_slots(&mut self, start_time: Instant, max_run_time: Duration) -> Result<(), Error> {
+        let controller = &self.controller;
+        let slots = self.slots.get_mut();
+        let archive = match &mut slots.archive {
+            Some(archive) => archive,
+            None => return Ok(()),
+        };
+
+        let candidates: Vec<(u32, usize)> = slots
+            .backups
+            .iter()
+            .enumerate()
+            .filter_map(|(index, slot)| match slot.frame {
+                Frame::At(frame) if frame >= ARCHIVE_INTERVAL => Some((frame, index)),
+                _ => None,
+            })
+            .sorted()
+            .collect();
+
+        for (frame, index) in candidates {
+            if start_time.elapsed() > max_run_time {
+                break;
+            }
+            let edits_hash = match controller.edits_hash(frame) {
+                Some(edits_hash) => edits_hash,
+                None => continue,
+            };
+            let has_nearby_snapshot =
+                archive
+                    .frames_in(frame + 1 - ARCHIVE_INTERVAL, frame)
+                    .any(|archived_frame| {
+                        controller
+                            .edits_hash(archived_frame)
+                            .map_or(false, |hash| archive.contains(archived_frame, hash))
+                    });
+            if !has_nearby_snapshot {
+                let data = self.memory.slot_data(&slots.backups[index].slot)?;
+                archive.insert(frame, edits_hash, data);
+            }
+        }
         Ok(())
     }
 
+    /// Compress backup slots that are unlikely to be used soon, until `max_run_time` has
+    /// elapsed since `start_time`.
+    ///
+    /// Slots far from every hotspot and stale slots are compressed. Keyframes are kept
+    /// uncompressed since delta slots share their pages.
+    ///
+    /// Returns the number of slots that were compressed.
+    fn compress_cold_slots(
+        &mut self,
+        start_time: Instant,
+        max_run_time: Duration,
+    ) -> Result<usize, Error> {
+        let mut num_compressed = 0;
+        let hotspots = &self.hotspots;
+        let slots = self.slots.get_mut();
+        for slot in &mut slots.backups {
+            if start_time.elapsed() > max_run_time {
+                break;
+            }
+            if slot.is_compressed || slot.is_keyframe {
+                continue;
+            }
+            let is_cold = match slot.frame {
+                Frame::At(frame) => hotspots
+                    .values()
+                    .all(|hotspot| hotspot.distance(frame) >= COLD_SLOT_DISTANCE),
+                Frame::Stale { .. } => true,
+                Frame::PowerOn | Frame::Unknown => false,
+            };
+            if is_cold {
+                slot.is_compressed = self.memory.compress_slot(&mut slot.slot)?;
+                if slot.is_compressed {
+                    num_compressed += 1;
+                }
+            }
+        }
+        Ok(num_compressed)
+    }
+
     pub fn memory(&self) -> &M {
         &self.memory
     }
@@ -400,24 +1708,264 @@ impl<M: Memory, C: Controller<M>> SlotManager<M, C> {
         &mut self.controller
     }
 
-    pub fn invalidate_frame(&mut self, invalidated_frame: u32) {
-        for slot in self.slots.get_mut().iter_mut() {
+    /// Invalidate frames starting at `invalidated_frame`.
+    ///
+    /// The invalidated backup slots are kept as a new stale generation, which is returned.
+    /// `edits_hash` identifies the edits that the slots were valid for, so that they can be
+    /// restored if the edits are reverted.
+    pub fn invalidate_frame(&mut self, invalidated_frame: u32, edits_hash: Option<u64>) -> usize {
+        // Later edits may have changed, so the slots can't converge
+        self.invalidate_edited(invalidated_frame, u32::MAX, edits_hash)
+    }
+
+    /// Invalidate frames starting at `edited_start`, where only the edits on frames
+    /// `edited_start..edited_end` changed.
+    ///
+    /// The invalidated backup slots are kept as a new stale generation, which is returned.
+    /// `edits_hash` identifies the edits that the slots were valid for, so that they can be
+    /// restored if the edits are reverted.
+    pub fn invalidate_edited(
+        &mut self,
+        edited_start: u32,
+        edited_end: u32,
+        edits_hash: Option<u64>,
+    ) -> usize {
+        let slots = self.slots.get_mut();
+        slots.record(TraceEvent::Invalidate(edited_start));
+        let generation = slots.next_generation;
+        slots.next_generation += 1;
+
+        if let Frame::At(slot_frame) = slots.base.frame {
+            if slot_frame >= edited_start {
+                slots.base.frame = Frame::Unknown;
+            }
+        }
+        let mut refill_frames: Vec<u32> = Vec::new();
+        for slot in slots.backups.iter_mut() {
             if let Frame::At(slot_frame) = slot.frame {
-                if slot_frame >= invalidated_frame {
-                    slot.frame = Frame::Unknown;
+                if slot_frame >= edited_start {
+                    slot.frame = Frame::Stale {
+                        frame: slot_frame,
+                        generation,
+                    };
+                    refill_frames.push(slot_frame);
                 }
             }
         }
+
+        // Recreate the invalidated checkpoints at their old positions, along with any that
+        // an unfinished refill hadn't reached yet
+        if let Some(refill) = self.refill.take() {
+            refill_frames.extend(refill.pending);
+        }
+        if !refill_frames.is_empty() {
+            let pending: Vec<u32> = refill_frames.into_iter().sorted().dedup().rev().collect();
+            self.refill = Some(Refill {
+                total: pending.len(),
+                pending,
+            });
+        }
+
+        // Older generations now differ from the current edits in the new frames as well
+        for stale_generation in &mut slots.stale_generations {
+            stale_generation.edited_end = stale_generation.edited_end.max(edited_end);
+        }
+        slots.stale_generations.push(StaleGeneration {
+            id: generation,
+            edits_hash,
+            edited_end,
+        });
+
+        let backups = &slots.backups;
+        let dropped_generations = &mut slots.dropped_generations;
+        slots.stale_generations.retain(|stale_generation| {
+            let has_slots = backups.iter().any(|slot| match slot.frame {
+                Frame::Stale {
+                    generation: slot_generation,
+                    ..
+                } => slot_generation == stale_generation.id,
+                _ => false,
+            });
+            if !has_slots {
+                dropped_generations.push(stale_generation.id);
+            }
+            has_slots
+        });
+
+        // Forget the least recently invalidated generations
+        while slots.stale_generations.len() > MAX_STALE_GENERATIONS {
+            let evicted = slots.stale_generations.remove(0);
+            slots.dropped_generations.push(evicted.id);
+            for slot in slots.backups.iter_mut() {
+                if let Frame::Stale { generation, .. } = slot.frame {
+                    if generation == evicted.id {
+                        slot.frame = Frame::Unknown;
+                    }
+                }
+            }
+        }
+
+        generation
     }
 
-    pub fn set_hotspot(&mut self, name: &str, frame: u32) {
-        self.hotspots.insert(name.to_owned(), frame);
+    /// Revalidate the most recent stale generation whose slots were valid for the edits
+    /// identified by `edits_hash`, returning its id.
+    pub fn restore_edits(&mut self, edits_hash: u64) -> Option<usize> {
+        let slots = self.slots.get_mut();
+        let position = slots
+            .stale_generations
+            .iter()
+            .rposition(|stale_generation| stale_generation.edits_hash == Some(edits_hash))?;
+        let restored = slots.stale_generations.remove(position);
+
+        for slot in slots.backups.iter_mut() {
+            if let Frame::Stale { frame, generation } = slot.frame {
+                if generation == restored.id {
+                    slot.frame = Frame::At(frame);
+                }
+            }
+        }
+        Some(restored.id)
+    }
+
+    /// Return the stale generations that converged since the last call, along with the
+    /// frame that each converged on.
+    pub fn take_converged(&self) -> Vec<(usize, u32)> {
+        match self.slots.try_borrow_mut() {
+            Ok(mut slots) => mem::take(&mut slots.converged),
+            // Check again once the slots are no longer in use
+            Err(_) => Vec::new(),
+        }
+    }
+
+    /// Return the generations that were forgotten since the last call.
+    ///
+    /// Data invalidated in these generations can be discarded.
+    pub fn take_dropped_generations(&mut self) -> Vec<usize> {
+        mem::take(&mut self.slots.get_mut().dropped_generations)
+    }
+
+    pub fn set_hotspot(&mut self, name: &str, frames: Range<u32>, weight: f32) {
+        self.slots.get_mut().record(TraceEvent::SetHotspot {
+            name: name.to_owned(),
+            frames: frames.clone(),
+            weight,
+        });
+        self.hotspots
+            .insert(name.to_owned(), Hotspot::new(frames, weight));
     }
 
     pub fn delete_hotspot(&mut self, name: &str) {
+        self.slots
+            .get_mut()
+            .record(TraceEvent::DeleteHotspot(name.to_owned()));
         self.hotspots.remove(name);
     }
 
+    /// Start recording frame requests, hotspot changes and invalidations, replacing any
+    /// previous trace.
+    pub fn start_request_trace(&mut self) {
+        let events = self
+            .hotspots
+            .iter()
+            .map(|(name, hotspot)| TraceEvent::SetHotspot {
+                name: name.clone(),
+                frames: hotspot.start..hotspot.end,
+                weight: hotspot.weight,
+            })
+            .collect();
+        self.slots.get_mut().trace = Some(events);
+    }
+
+    /// Stop recording and return the events recorded since `start_request_trace`.
+    pub fn take_request_trace(&mut self) -> Vec<TraceEvent> {
+        self.slots.get_mut().trace.take().unwrap_or_default()
+    }
+
+    /// Simulate serving the requests in `trace` with `num_slots` backup slots and the given
+    /// eviction policy, using the measured cost of copies and advances.
+    pub fn replay_trace(
+        &self,
+        trace: &[TraceEvent],
+        num_slots: usize,
+        policy: EvictionPolicy,
+    ) -> ReplayCost {
+        replay::replay_trace(trace, num_slots, policy, &self.slots.borrow().costs)
+    }
+
+    /// Use an archive to persist slots on disk.
+    ///
+    /// Snapshots in the archive from other program instances are only loaded if relocation
+    /// from that instance succeeds, which is checked once using its archived power-on state.
+    pub fn set_archive(&mut self, mut archive: SlotArchive) -> Result<(), Error> {
+        let slots = self.slots.get_mut();
+        for power_on_data in archive.power_on_states() {
+            check_relocation(&self.memory, slots, &power_on_data)?;
+        }
+
+        let power_on_data = self.memory.slot_data(&slots.power_on.slot)?;
+        let address = self.memory.base_address();
+        archive.insert_power_on(address.0 as u64, power_on_data);
+        slots.archive = Some(archive);
+        Ok(())
+    }
+
+    /// Return the errors that the archive has encountered since the last call.
+    pub fn take_archive_errors(&self) -> Vec<io::Error> {
+        self.slots
+            .borrow()
+            .archive
+            .as_ref()
+            .map_or_else(Vec::new, |archive| archive.take_errors())
+    }
+
+    pub fn set_play_speed(&mut self, play_speed: f32) {
+        self.play_speed = play_speed;
+        if play_speed >= 0.0 {
+            self.reverse_schedules.clear();
+        }
+        self.slots.get_mut().sequential = play_speed > 0.0;
+    }
+
+    /// Return the contents of a valid slot on `frame` as `Memory::slot_data`, or None if no
+    /// slot currently holds that frame.
+    pub fn checkpoint_data(&self, frame: u32) -> Result<Option<Vec<u8>>, Error> {
+        let slots = self.slots.borrow();
+        match slots.iter().find(|slot| slot.frame == Frame::At(frame)) {
+            Some(slot) => Ok(Some(self.memory.slot_data(&slot.slot)?)),
+            None => Ok(None),
+        }
+    }
+
+    /// Return the contents of the power-on slot as `Memory::slot_data`, for use with
+    /// `check_relocation`.
+    pub fn power_on_data(&self) -> Result<Vec<u8>, Error> {
+        self.memory.slot_data(&self.slots.borrow().power_on.slot)
+    }
+
+    /// Check whether checkpoints from the program instance whose power-on state is
+    /// `power_on_data` can be loaded into this one without simulating them.
+    ///
+    /// See `check_relocation`.
+    pub fn check_relocation(&mut self, power_on_data: &[u8]) -> Result<bool, Error> {
+        check_relocation(&self.memory, self.slots.get_mut(), power_on_data)
+    }
+
+    /// Load the state on `frame` into the base slot from data returned by `checkpoint_data`.
+    ///
+    /// The data may come from another timeline, as long as its edits match this one's up to
+    /// `frame`. If it comes from a copy of the program at a different address that
+    /// `check_relocation` hasn't succeeded for, the frame is simulated instead.
+    pub fn load_checkpoint(&mut self, frame: u32, data: &[u8]) -> Result<(), Error> {
+        load_slot_data(
+            &self.memory,
+            &self.controller,
+            self.slots.get_mut(),
+            frame,
+            data,
+        )
+    }
+
     pub fn cached_frames(&self) -> Vec<u32> {
         self.slots
             .borrow()
@@ -425,7 +1973,7 @@ impl<M: Memory, C: Controller<M>> SlotManager<M, C> {
             .filter_map(|slot| match slot.frame {
                 Frame::At(frame) => Some(frame),
                 Frame::PowerOn => Some(0),
-                Frame::Unknown => None,
+                Frame::Unknown | Frame::Stale { .. } => None,
             })
             .collect()
     }
@@ -437,4 +1985,18 @@ impl<M: Memory, C: Controller<M>> SlotManager<M, C> {
     pub fn num_copies(&self) -> usize {
         self.slots.borrow().num_copies
     }
+
+    /// Return the copy measurements since the last call, and reset them.
+    pub fn take_request_stats(&self) -> RequestStats {
+        match self.slots.try_borrow_mut() {
+            Ok(mut slots) => mem::take(&mut slots.request_stats),
+            // The stats keep accumulating until the slots are no longer in use
+            Err(_) => RequestStats::default(),
+        }
+    }
+
+    pub fn cost_weights(&self) -> (f64, f64) {
+        let costs = self.slots.borrow().costs;
+        (costs.copy, costs.advance)
+    }
 }
@@ -1,15 +1,40 @@
-use super::{data_cache::DataCache, slot_manager::SlotManager, SlotState, SlotStateMut, State};
+use super::{
+    data_cache::{DataCache, DataCacheStats, DEFAULT_DATA_CACHE_BUDGET},
+    slot_manager::SlotManager,
+    BalanceStats, EvictionPolicy, ReplayCost, RequestStats, SlotArchive, SlotState, SlotStateMut,
+    SlotStorage, State, TraceEvent,
+};
 use crate::{
     data_path::GlobalDataPath,
     error::Error,
     memory::{Address, Memory, Value},
 };
-use std::{cell::RefCell, time::Duration};
+use std::{
+    cell::{Cell, RefCell},
+    io,
+    ops::Range,
+    time::Duration,
+};
+
+/// The number of frames loaded at once during reverse playback.
+///
+/// Blocks are aligned to multiples of this size. This should be well below the data cache's
+/// capacity, since the current block and the prefetched one are both kept in it.
+const REVERSE_BLOCK_SIZE: u32 = 30;
 
 /// Applies edits at the end of each frame to control the simulation.
 pub trait Controller<M: Memory> {
     /// Apply edits to the given state.
     fn apply(&self, state: &mut impl SlotStateMut<Memory = M>) -> Result<(), Error>;
+
+    /// Return a hash of the edits that affect the state on the given frame.
+    ///
+    /// Two states on the same frame with equal hashes are assumed to be equal, and
+    /// `edits_hash(u32::MAX)` identifies the edits as a whole. If None is returned, the state
+    /// is not saved to a `SlotArchive` and invalidated states can't be restored.
+    fn edits_hash(&self, _frame: u32) -> Option<u64> {
+        None
+    }
 }
 
 /// An abstraction allowing random access to any frame of the simulation.
@@ -17,6 +42,11 @@ pub trait Controller<M: Memory> {
 pub struct Timeline<M: Memory, C: Controller<M>> {
     slot_manager: SlotManager<M, C>,
     data_cache: RefCell<DataCache>,
+    play_speed: f32,
+    /// The number of frames before and after a data cache miss to preload.
+    preload_window: (u32, u32),
+    /// The last frame read from the data cache while playing backward.
+    reverse_frame: Cell<Option<u32>>,
 }
 
 impl<M: Memory, C: Controller<M>> Timeline<M, C> {
@@ -25,15 +55,28 @@ impl<M: Memory, C: Controller<M>> Timeline<M, C> {
     /// Typically `memory` should be a freshly created `Memory` object.
     /// Otherwise, frame 0 will be defined as whatever the current contents of the
     /// base slot are.
+    ///
+    /// Backup slots are allocated as needed while keeping their total size within
+    /// `slot_memory_budget` bytes. `storage` determines how they store their contents.
     pub fn new(
         memory: M,
         base_slot: M::Slot,
         controller: C,
-        num_backup_slots: usize,
+        slot_memory_budget: usize,
+        storage: SlotStorage,
     ) -> Result<Self, Error> {
         Ok(Self {
-            slot_manager: SlotManager::new(memory, base_slot, controller, num_backup_slots)?,
-            data_cache: RefCell::new(DataCache::new()),
+            slot_manager: SlotManager::new(
+                memory,
+                base_slot,
+                controller,
+                slot_memory_budget,
+                storage,
+            )?,
+            data_cache: RefCell::new(DataCache::new(DEFAULT_DATA_CACHE_BUDGET)),
+            play_speed: 0.0,
+            preload_window: (0, 0),
+            reverse_frame: Cell::new(None),
         })
     }
 
@@ -44,6 +87,20 @@ impl<M: Memory, C: Controller<M>> Timeline<M, C> {
         self.slot_manager.into_parts()
     }
 
+    /// Use an archive to persist slots on disk.
+    ///
+    /// Snapshots are periodically saved to the archive, and are loaded from it when they
+    /// are closer to a requested frame than any slot in memory.
+    pub fn set_archive(&mut self, archive: SlotArchive) -> Result<(), Error> {
+        self.slot_manager.set_archive(archive)
+    }
+
+    /// Return the errors that the archive has encountered while writing snapshots in the
+    /// background since the last call.
+    pub fn take_archive_errors(&self) -> Vec<io::Error> {
+        self.slot_manager.take_archive_errors()
+    }
+
     /// Get the memory that backs this timeline.
     pub fn memory(&self) -> &M {
         self.slot_manager.memory()
@@ -55,11 +112,42 @@ impl<M: Memory, C: Controller<M>> Timeline<M, C> {
     }
 
     /// Get a mutable reference to the controller.
+    ///
+    /// Invalidated states are kept for a while, and become valid again if the edits are
+    /// later reverted.
     pub fn with_controller_mut(&mut self, func: impl FnOnce(&mut C) -> InvalidatedFrames) {
+        let prev_edits_hash = self.controller().edits_hash(u32::MAX);
+
         let invalidated_frames = func(self.slot_manager.controller_mut());
-        if let InvalidatedFrames::StartingAt(frame) = invalidated_frames {
-            self.slot_manager.invalidate_frame(frame);
-            self.data_cache.borrow_mut().invalidate_frame(frame);
+        let (frame, generation) = match invalidated_frames {
+            InvalidatedFrames::StartingAt(frame) => (
+                frame,
+                self.slot_manager.invalidate_frame(frame, prev_edits_hash),
+            ),
+            InvalidatedFrames::Edited { start, end } => (
+                start,
+                self.slot_manager
+                    .invalidate_edited(start, end, prev_edits_hash),
+            ),
+            InvalidatedFrames::None => return,
+        };
+        let mut data_cache = self.data_cache.borrow_mut();
+        data_cache.invalidate_frame(frame, generation);
+        for dropped in self.slot_manager.take_dropped_generations() {
+            data_cache.drop_generation(dropped);
+        }
+
+        if let Some(edits_hash) = self.controller().edits_hash(u32::MAX) {
+            if let Some(restored) = self.slot_manager.restore_edits(edits_hash) {
+                data_cache.revalidate(restored, 0);
+            }
+        }
+    }
+
+    /// Restore cached data for invalidated frames whose states turned out to be unchanged.
+    fn revalidate_converged(&self) {
+        for (generation, frame) in self.slot_manager.take_converged() {
+            self.data_cache.borrow_mut().revalidate(generation, frame);
         }
     }
 
@@ -90,7 +178,34 @@ impl<M: Memory, C: Controller<M>> Timeline<M, C> {
     }
 
     fn path_read_cached(&self, frame: u32, path: &GlobalDataPath) -> Result<Value, Error> {
-        let cached_value = self.data_cache.borrow_mut().get(frame, path);
+        self.revalidate_converged();
+        if self.play_speed < 0.0 {
+            self.reverse_frame.set(Some(frame));
+        }
+
+        // Check before the lookup, since the lookup itself makes the path hot
+        let is_hot = self.data_cache.borrow().is_hot(path);
+        let mut cached_value = self.data_cache.borrow_mut().get(frame, path);
+        if cached_value.is_none() && is_hot && self.play_speed < 0.0 {
+            // Frames are requested in decreasing order, so simulate the rest of the block
+            // leading up to this frame in one forward sweep
+            let block = frame - frame % REVERSE_BLOCK_SIZE..frame + 1;
+            if let Some(missing_frames) = self.uncached_frames(block) {
+                self.preload_frames(missing_frames)?;
+            }
+            cached_value = self.data_cache.borrow_mut().get(frame, path);
+        } else if cached_value.is_none() && is_hot && self.preload_window != (0, 0) {
+            // The path is read repeatedly, e.g. by a visible column in the frame sheet, so
+            // nearby frames are likely to be requested next. Load the ones that aren't
+            // cached yet in the same pass
+            let (frames_before, frames_after) = self.preload_window;
+            let window =
+                frame.saturating_sub(frames_before)..frame.saturating_add(frames_after) + 1;
+            if let Some(missing_frames) = self.uncached_frames(window) {
+                self.preload_frames(missing_frames)?;
+            }
+            cached_value = self.data_cache.borrow_mut().get(frame, path);
+        }
         match cached_value {
             Some(value) => Ok(value),
             None => {
@@ -102,11 +217,180 @@ impl<M: Memory, C: Controller<M>> Timeline<M, C> {
                 let value = state.path_read(path)?;
                 data_cache.insert(frame, path, value.clone());
 
+                // The slot is already loaded, so record the address too in case it's needed
+                if let Ok(address) = state.path_address(path) {
+                    data_cache.insert_address(frame, path, address);
+                }
+
                 Ok(value)
             }
         }
     }
 
+    fn path_address_cached(
+        &self,
+        frame: u32,
+        path: &GlobalDataPath,
+    ) -> Result<Option<Address>, Error> {
+        self.revalidate_converged();
+
+        let cached_address = self.data_cache.borrow_mut().get_address(frame, path);
+        match cached_address {
+            Some(address) => Ok(address),
+            None => {
+                let address = self.frame_uncached(frame)?.path_address(path)?;
+                self.data_cache
+                    .borrow_mut()
+                    .insert_address(frame, path, address);
+                Ok(address)
+            }
+        }
+    }
+
+    /// Return the smallest range containing every frame in `frames` on which some hot path
+    /// isn't cached, or None if they are all cached.
+    fn uncached_frames(&self, frames: Range<u32>) -> Option<Range<u32>> {
+        let data_cache = self.data_cache.borrow();
+        let first = frames
+            .clone()
+            .find(|&frame| !data_cache.contains_frame(frame))?;
+        let last = frames
+            .rev()
+            .find(|&frame| !data_cache.contains_frame(frame))?;
+        Some(first..last + 1)
+    }
+
+    /// Preload the data cache's hot paths on each frame in `frames` in a single forward pass.
+    fn preload_frames(&self, frames: Range<u32>) -> Result<(), Error> {
+        self.slot_manager.for_each_frame(frames, |state| {
+            self.data_cache.borrow_mut().preload_frame(state);
+            Ok(())
+        })
+    }
+
+    /// Load the block before the current reverse playback position, so that playback
+    /// doesn't stall when it reaches it.
+    fn prefetch_reverse_block(&self) -> Result<(), Error> {
+        if let Some(frame) = self.reverse_frame.get() {
+            let block_start = frame - frame % REVERSE_BLOCK_SIZE;
+            if block_start > 0 && !self.data_cache.borrow().contains_frame(block_start - 1) {
+                self.preload_frames(block_start - REVERSE_BLOCK_SIZE..block_start)?;
+            }
+        }
+        Ok(())
+    }
+
+    /// Read each path on every frame in `frames`, returning one column of values per path.
+    ///
+    /// Cached values are used where possible. The remaining frames are loaded in a single
+    /// forward pass, rather than requesting the frame again for each path that is read.
+    pub fn read_range(
+        &self,
+        paths: &[GlobalDataPath],
+        frames: Range<u32>,
+    ) -> Result<Vec<Vec<Value>>, Error> {
+        self.revalidate_converged();
+        let mut rows: Vec<Option<Vec<Value>>> = {
+            let mut data_cache = self.data_cache.borrow_mut();
+            let mut cached_columns: Vec<_> = paths
+                .iter()
+                .map(|path| data_cache.get_range(frames.clone(), path).into_iter())
+                .collect();
+            frames
+                .clone()
+                .map(|_| {
+                    cached_columns
+                        .iter_mut()
+                        .map(|column| column.next().expect("missing cached value"))
+                        .collect()
+                })
+                .collect()
+        };
+
+        let first_missing = rows.iter().position(Option::is_none);
+        let last_missing = rows.iter().rposition(Option::is_none);
+        if let (Some(first), Some(last)) = (first_missing, last_missing) {
+            let missing_frames = frames.start + first as u32..frames.start + last as u32 + 1;
+            self.slot_manager.for_each_frame(missing_frames, |state| {
+                let row = &mut rows[(state.frame() - frames.start) as usize];
+                if row.is_none() {
+                    let values = paths
+                        .iter()
+                        .map(|path| state.path_read(path))
+                        .collect::<Result<Vec<Value>, Error>>()?;
+
+                    let mut data_cache = self.data_cache.borrow_mut();
+                    for (path, value) in paths.iter().zip(&values) {
+                        data_cache.insert(state.frame(), path, value.clone());
+                    }
+                    *row = Some(values);
+                }
+                Ok(())
+            })?;
+        }
+
+        let mut columns: Vec<Vec<Value>> = paths
+            .iter()
+            .map(|_| Vec::with_capacity(rows.len()))
+            .collect();
+        for row in rows {
+            let row = row.expect("frame was not loaded");
+            for (column, value) in columns.iter_mut().zip(row) {
+                column.push(value);
+            }
+        }
+        Ok(columns)
+    }
+
+    /// Return true if every path in `paths` is cached on every frame in `frames`.
+    pub fn is_range_cached(&self, paths: &[GlobalDataPath], frames: Range<u32>) -> bool {
+        self.revalidate_converged();
+        let data_cache = self.data_cache.borrow();
+        paths
+            .iter()
+            .all(|path| data_cache.contains_range(frames.clone(), path))
+    }
+
+    /// Store values that were read elsewhere in the data cache, with one column per path
+    /// starting at `start_frame`.
+    ///
+    /// The values must be the ones `read_range` would have returned, for example values
+    /// read by another timeline with the same edits.
+    pub fn cache_range(&self, paths: &[GlobalDataPath], start_frame: u32, columns: &[Vec<Value>]) {
+        let mut data_cache = self.data_cache.borrow_mut();
+        for (path, column) in paths.iter().zip(columns) {
+            for (frame, value) in (start_frame..).zip(column) {
+                data_cache.insert(frame, path, value.clone());
+            }
+        }
+    }
+
+    /// Return the contents of a backup slot on `frame`, or None if there is no such slot.
+    ///
+    /// The data can be loaded into another timeline using `load_checkpoint`.
+    pub fn checkpoint_data(&self, frame: u32) -> Result<Option<Vec<u8>>, Error> {
+        self.slot_manager.checkpoint_data(frame)
+    }
+
+    /// Return the power-on state, for checking relocation using `check_relocation`.
+    pub fn power_on_data(&self) -> Result<Vec<u8>, Error> {
+        self.slot_manager.power_on_data()
+    }
+
+    /// Check whether checkpoints from another instance of the program can be loaded into
+    /// this timeline without simulating them, given that instance's `power_on_data`.
+    pub fn check_relocation(&mut self, power_on_data: &[u8]) -> Result<bool, Error> {
+        self.slot_manager.check_relocation(power_on_data)
+    }
+
+    /// Load the state on `frame` into the base slot from data returned by `checkpoint_data`,
+    /// so that later frames can be simulated from there.
+    ///
+    /// The data may come from another timeline, as long as the edits match up to `frame`.
+    pub fn load_checkpoint(&mut self, frame: u32, data: &[u8]) -> Result<(), Error> {
+        self.slot_manager.load_checkpoint(frame, data)
+    }
+
     /// Get an immutable view of the base slot.
     ///
     /// This can be used for running internal functions in the base slot if they have no
@@ -135,10 +419,18 @@ impl<M: Memory, C: Controller<M>> Timeline<M, C> {
     /// A hotspot is a hint to the algorithm that scrolling should be smooth near the
     /// given frame.
     ///
-    /// Note that the optimal `num_backup_slots` is proportional to the number
-    /// of hotspots.
+    /// Note that the memory budget is shared between hotspots, so each additional hotspot
+    /// makes scrolling near the others less smooth.
     pub fn set_hotspot(&mut self, name: &str, frame: u32) {
-        self.slot_manager.set_hotspot(name, frame);
+        self.slot_manager.set_hotspot(name, frame..frame + 1, 1.0);
+    }
+
+    /// Set a hotspot with a given name that covers a window of frames.
+    ///
+    /// Every frame in `frames` is treated as equally likely to be accessed. The memory
+    /// budget is divided between hotspots in proportion to `weight`.
+    pub fn set_hotspot_range(&mut self, name: &str, frames: Range<u32>, weight: f32) {
+        self.slot_manager.set_hotspot(name, frames, weight);
     }
 
     /// Delete a hotspot with the given name, if it exists.
@@ -146,9 +438,78 @@ impl<M: Memory, C: Controller<M>> Timeline<M, C> {
         self.slot_manager.delete_hotspot(name);
     }
 
+    /// Set the number of frames around a data cache miss that are preloaded along with it.
+    ///
+    /// On a miss for a path that was already hot, the hot paths on the uncached frames in the
+    /// window are loaded in a single forward pass, instead of requesting each frame separately
+    /// as it is read. Misses for other paths only load the requested frame.
+    pub fn set_preload_window(&mut self, frames_before: u32, frames_after: u32) {
+        self.preload_window = (frames_before, frames_after);
+    }
+
+    /// Set the current playback speed in frames per frame.
+    ///
+    /// While the speed is negative, slots are placed to make playing backward fast, and
+    /// frames are loaded into the data cache in blocks that are simulated forward in one
+    /// pass. While
+    /// it is positive, requests just ahead of the base slot advance it in place, and the
+    /// base slot is periodically saved as a checkpoint instead of being moved to place
+    /// slots around hotspots.
+    pub fn set_play_speed(&mut self, play_speed: f32) {
+        self.slot_manager.set_play_speed(play_speed);
+        self.play_speed = play_speed;
+        if play_speed >= 0.0 {
+            self.reverse_frame.set(None);
+        }
+    }
+
+    /// Lower the slot memory budget so that at least `reserve_bytes` of physical memory
+    /// stays available, given that `available_bytes` is currently available.
+    ///
+    /// This should be called periodically, so that backup slots are freed before the
+    /// system starts swapping, and are allowed to grow again once memory is freed.
+    pub fn reserve_memory(&mut self, available_bytes: usize, reserve_bytes: usize) {
+        self.slot_manager
+            .reserve_memory(available_bytes, reserve_bytes);
+    }
+
     /// Perform housekeeping to improve scrolling near hotspots.
-    pub fn balance_distribution(&mut self, max_run_time: Duration) -> Result<(), Error> {
-        self.slot_manager.balance_distribution(max_run_time)
+    ///
+    /// No new work is started once `max_run_time` has elapsed, so this can be given
+    /// whatever time is left in the current UI frame. During reverse playback, the next
+    /// block of frames is also prefetched.
+    pub fn balance_distribution(&mut self, max_run_time: Duration) -> Result<BalanceStats, Error> {
+        let stats = self.slot_manager.balance_distribution(max_run_time)?;
+        self.prefetch_reverse_block()?;
+        self.revalidate_converged();
+        Ok(stats)
+    }
+
+    /// Recreate checkpoints that were invalidated by the last edits, spending at most
+    /// `max_run_time`.
+    ///
+    /// This walks forward from the edited frame, saving slots at the positions the
+    /// invalidated ones had and preloading the data cache's hot paths on those frames, so
+    /// that scrolling past the edit doesn't need to resimulate on demand. The preloading
+    /// counts toward `max_run_time`.
+    pub fn refill(&mut self, max_run_time: Duration) -> Result<(), Error> {
+        let data_cache = &self.data_cache;
+        self.slot_manager.refill(max_run_time, |state| {
+            data_cache.borrow_mut().preload_frame(state);
+        })?;
+        self.revalidate_converged();
+        Ok(())
+    }
+
+    /// Return the fraction of the current refill that is complete, or None if there are
+    /// no invalidated checkpoints left to recreate.
+    pub fn refill_progress(&self) -> Option<f32> {
+        self.slot_manager.refill_progress()
+    }
+
+    /// Stop recreating invalidated checkpoints until the next edit.
+    pub fn cancel_refill(&mut self) {
+        self.slot_manager.cancel_refill();
     }
 
     /// Return the set of currently loaded frames for debugging purposes.
@@ -166,10 +527,67 @@ impl<M: Memory, C: Controller<M>> Timeline<M, C> {
         self.slot_manager.num_copies()
     }
 
+    /// Return the number of frame requests and the bytes copied to serve them since the
+    /// last call, and reset the counts.
+    pub fn take_request_stats(&self) -> RequestStats {
+        self.slot_manager.take_request_stats()
+    }
+
+    /// Start recording frame requests, hotspot changes and invalidations, for replaying
+    /// them with `replay_request_trace`.
+    pub fn start_request_trace(&mut self) {
+        self.slot_manager.start_request_trace();
+    }
+
+    /// Stop recording and return the events recorded since `start_request_trace`.
+    pub fn take_request_trace(&mut self) -> Vec<TraceEvent> {
+        self.slot_manager.take_request_trace()
+    }
+
+    /// Simulate serving the requests in `trace` with `num_slots` backup slots and the given
+    /// eviction policy.
+    ///
+    /// This only models which frames the slots hold, so it is meant for comparing
+    /// policies on the same trace.
+    pub fn replay_request_trace(
+        &self,
+        trace: &[TraceEvent],
+        num_slots: usize,
+        policy: EvictionPolicy,
+    ) -> ReplayCost {
+        self.slot_manager.replay_trace(trace, num_slots, policy)
+    }
+
+    /// Return the measured time in seconds of a slot copy and of a frame advance.
+    ///
+    /// These are used as weights when choosing which slot to advance from.
+    pub fn cost_weights(&self) -> (f64, f64) {
+        self.slot_manager.cost_weights()
+    }
+
     /// Return the size of the data cache in bytes.
     pub fn data_size_cache(&self) -> usize {
         self.data_cache.borrow().byte_size()
     }
+
+    /// Set the maximum size of the data cache in bytes.
+    pub fn set_data_cache_budget(&mut self, byte_budget: usize) {
+        self.data_cache.get_mut().set_byte_budget(byte_budget);
+    }
+
+    /// Remove the cached data for every frame in `frames`, for example once a window of
+    /// frames is no longer displayed.
+    ///
+    /// Only the entries in the window are touched, so this is cheap even when many frames
+    /// are cached.
+    pub fn drop_cached_frames(&mut self, frames: Range<u32>) {
+        self.data_cache.get_mut().drop_frames(frames);
+    }
+
+    /// Return the data cache's hit, miss, and eviction counts.
+    pub fn data_cache_stats(&self) -> DataCacheStats {
+        self.data_cache.borrow().stats()
+    }
 }
 
 /// A set of frames that should be invalidated after a controller mutation.
@@ -178,6 +596,17 @@ impl<M: Memory, C: Controller<M>> Timeline<M, C> {
 pub enum InvalidatedFrames {
     /// Invalidate states at and after the given frame.
     StartingAt(u32),
+    /// Invalidate states at and after `start`, where only the edits on frames `start..end`
+    /// changed.
+    ///
+    /// Since later edits are unchanged, the invalidated states become valid again if the
+    /// simulation converges to the same state on or after frame `end - 1`.
+    Edited {
+        /// The first frame whose edits changed.
+        start: u32,
+        /// The frame after the last frame whose edits changed.
+        end: u32,
+    },
     /// No frames need to be invalidated.
     None,
 }
@@ -188,20 +617,37 @@ impl InvalidatedFrames {
         *self = InvalidatedFrames::None;
     }
 
-    /// Include `frame` in the set.
+    /// Include `frame` in the set, as a frame whose edits changed.
     pub fn include(&mut self, frame: u32) {
-        match self {
-            Self::StartingAt(prev_frame) => *prev_frame = frame.min(*prev_frame),
-            Self::None => *self = Self::StartingAt(frame),
-        }
+        *self = self.union(Self::Edited {
+            start: frame,
+            end: frame + 1,
+        });
     }
 
     /// The union of two sets of frames.
-    pub fn union(mut self, other: Self) -> Self {
-        if let Self::StartingAt(frame) = other {
-            self.include(frame);
+    pub fn union(self, other: Self) -> Self {
+        match (self, other) {
+            (Self::None, other) | (other, Self::None) => other,
+            (
+                Self::Edited {
+                    start: start1,
+                    end: end1,
+                },
+                Self::Edited {
+                    start: start2,
+                    end: end2,
+                },
+            ) => Self::Edited {
+                start: start1.min(start2),
+                end: end1.max(end2),
+            },
+            (Self::StartingAt(frame1), Self::StartingAt(frame2))
+            | (Self::StartingAt(frame1), Self::Edited { start: frame2, .. })
+            | (Self::Edited { start: frame1, .. }, Self::StartingAt(frame2)) => {
+                Self::StartingAt(frame1.min(frame2))
+            }
         }
-        self
     }
 }
 
@@ -223,11 +669,7 @@ impl<'a, M: Memory, C: Controller<M>> State for TimelineState<'a, M, C> {
     }
 
     fn path_address(&self, path: &GlobalDataPath) -> Result<Option<Address>, Error> {
-        // Uncached for now (could also skip frame request in common case)
-        Ok(self
-            .timeline
-            .frame_uncached(self.frame)?
-            .path_address(path)?)
+        self.timeline.path_address_cached(self.frame, path)
     }
 
     fn path_read(&self, path: &GlobalDataPath) -> Result<Value, Error> {